@@ -0,0 +1,266 @@
+'''Offline batch PETH computation over Open Ephys binary format recordings (and OPETH recordings).
+
+Each session is memory-mapped and streamed in large blocks through the live detection and
+binning code (:class:`replay.Replay`, :class:`eventproc.EventProcessor`), sessions are
+processed in parallel by a pool of worker processes. Memory use does not depend on the
+recording length: data pages are read through the memory map, the collector keeps only a few
+seconds of data and per-trigger spike times are written to disk as they are found.
+
+Outputs for each session (in the output directory, named after the session path):
+
+* ``<name>_peth.npz``: one histogram (channels x bins, spike counts) for each event window,
+  trigger channel and threshold profile, keyed ``<window>_ttl<channel>_p<profile>``
+  (1-based trigger channel), with the bin size, the event windows and the replay statistics,
+* ``<name>_spikes.dat``: :data:`SPIKE_DTYPE` records of all spikes in the event windows
+  (see :func:`load_spikes`).
+
+Usage (see ``opeth-batch --help``)::
+
+    opeth-batch -t 40e-6 --roi -0.05:0.1 -j 8 -o results /data/recordings
+'''
+
+from __future__ import division, print_function
+import os
+import re
+import sys
+import json
+import argparse
+import logging
+import multiprocessing
+import numpy as np
+from collections import OrderedDict
+
+from .replay import Replay
+from .recorder import PreallocatedFile, EVENT_DTYPE, EVENT_TTL
+from .eventproc import MAIN_WINDOW, HISTOGRAM_BINSIZE
+from .colldata import EVENT_ROI
+from .filters import REREF_CAR, REREF_CMR
+
+BATCH_BLOCK = 30000         #: Samples per block streamed through the collector
+OEBIN_NAME = 'structure.oebin'
+
+SPIKE_DTYPE = np.dtype([('trial', '<i4'), ('ttl_channel', '<i2'), ('window', '<i2'), ('profile', '<i2'),
+                        ('channel', '<i2'), ('offset', '<f4')])  #: Spike time record (offset: seconds rel. to the trigger)
+
+class OpenEphysReplay(Replay):
+    '''Replay of an Open Ephys binary format recording (``structure.oebin``, ``continuous.dat``,
+    TTL event arrays), int16 samples are scaled to uV by the ``bit_volts`` of each channel.'''
+
+    def __init__(self, path, stream=0, **kwargs):
+        '''
+        Args:
+            path (str): recording directory (containing ``structure.oebin``)
+            stream (int): index of the continuous stream to be processed
+            kwargs: see :class:`replay.Replay`
+        '''
+        self.stream = stream
+        Replay.__init__(self, path, **kwargs)
+
+    def load(self, path):
+        with open(os.path.join(path, OEBIN_NAME)) as f:
+            oebin = json.load(f)
+        cont = oebin['continuous'][self.stream]
+        folder = os.path.join(path, 'continuous', cont['folder_name'])
+        nch = cont['num_channels']
+
+        self.data = np.memmap(os.path.join(folder, 'continuous.dat'), dtype='<i2', mode='r')
+        self.data = self.data[:len(self.data) // nch * nch].reshape(-1, nch)
+        self.timestamps = self.load_npy(folder, ('sample_numbers.npy', 'timestamps.npy'))
+        self.scale = np.array([ch.get('bit_volts', 1.0) for ch in cont['channels']], dtype=np.float32).reshape(-1, 1)
+        self.header = dict(channels=nch, sampling_rate=int(round(cont['sample_rate'])), samples=len(self.data))
+        self.events = self.load_ttls(path, oebin, cont)
+
+    @staticmethod
+    def load_npy(folder, names, mmap_mode='r'):
+        '''Load the first existing array of `names` (file names differ between format versions).'''
+        for name in names:
+            fname = os.path.join(folder, name)
+            if os.path.exists(fname):
+                return np.load(fname, mmap_mode=mmap_mode)
+        raise IOError("None of %s found in %s" % (", ".join(names), folder))
+
+    def load_ttls(self, path, oebin, cont):
+        '''Rising edges of the TTL lines recorded with the continuous stream as an event table.'''
+        tables = []
+        for ev in oebin.get('events', []):
+            if 'TTL' not in ev['folder_name'] or ev.get('stream_name', cont.get('stream_name')) != cont.get('stream_name'):
+                continue
+            folder = os.path.join(path, 'events', ev['folder_name'])
+            stamps = np.asarray(self.load_npy(folder, ('sample_numbers.npy', 'timestamps.npy'), None))
+            states = np.asarray(self.load_npy(folder, ('states.npy', 'channel_states.npy'), None))
+            rising = states > 0
+            table = np.zeros(np.count_nonzero(rising), dtype=EVENT_DTYPE)
+            table['timestamp'] = stamps[rising]
+            table['kind'] = EVENT_TTL
+            table['channel'] = states[rising] - 1
+            table['event_id'] = 1
+            tables.append(table)
+        return np.concatenate(tables) if tables else np.zeros(0, dtype=EVENT_DTYPE)
+
+    def packet_data(self, start, end):
+        return self.data[start:end].T * self.scale
+
+def find_sessions(paths):
+    '''Recording directories (``structure.oebin``) under the given paths, OPETH recordings are
+    given by their ``.json`` header (or base name).'''
+    sessions = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                if OEBIN_NAME in files:
+                    sessions.append(root)
+                dirs.sort()
+        elif path.endswith('.json'):
+            sessions.append(path[:-len('.json')])
+        elif os.path.exists(path + '.json'):
+            sessions.append(path)
+        else:
+            logger.error("No recording found at %s" % path)
+    return sessions
+
+def session_name(path):
+    '''Output file prefix of a session: its path with separators replaced.'''
+    name = os.path.normpath(os.path.abspath(path)).strip(os.sep)
+    return re.sub(r'[^\w.-]+', '_', name)
+
+def process_session(task):
+    '''Process a single session (worker process entry point).
+
+    Args:
+        task (tuple): session path, output directory and the options dict (see :func:`main`)
+
+    Returns:
+        session path and the replay statistics or the error message
+    '''
+    path, outdir, options = task
+    try:
+        if os.path.isdir(path):
+            replay = OpenEphysReplay(path, stream=options['stream'], event_windows=options['windows'],
+                                     drop_aux=options['drop_aux'])
+        else:
+            replay = Replay(path, event_windows=options['windows'], drop_aux=options['drop_aux'])
+
+        prefix = os.path.join(outdir, session_name(path))
+        spikefile = PreallocatedFile(prefix + '_spikes.dat', SPIKE_DTYPE.itemsize * 65536)
+        window_names = list(options['windows'].keys())
+        nprofiles = len(options['profiles'])
+
+        def on_trial(ttl):
+            sampling_rate = float(replay.header['sampling_rate'])
+            for (name, profile), (win_min, win_max, first_ts, stamps, chs) in replay.eventproc.last_trial.items():
+                if len(stamps) == 0:
+                    continue
+                records = np.zeros(len(stamps), dtype=SPIKE_DTYPE)
+                records['trial'] = replay.eventproc.trialcnt - 1
+                records['ttl_channel'] = ttl.event_channel
+                records['window'] = window_names.index(name)
+                records['profile'] = profile
+                records['channel'] = chs
+                records['offset'] = (stamps - ttl.timestamp) / sampling_rate
+                spikefile.write(records)
+
+        try:
+            peths = replay.run(thresholds=options['threshold'], profiles=options['profiles'],
+                               disabled_channels=options['disabled'], ttl_ch=options['ttl_ch'],
+                               rising_edge=options['rising_edge'], packet=options['block'], on_trial=on_trial,
+                               band=options['band'], reference=options['reference'], group_size=options['group_size'])
+        finally:
+            spikefile.close()
+
+        arrays = OrderedDict()
+        for name, pethset in (peths or {}).items():
+            for ttl_ch, profile in pethset.keys():
+                if profile < nprofiles:
+                    arrays['%s_ttl%d_p%d' % (name, ttl_ch + 1, profile)] = pethset[(ttl_ch, profile)].bins
+        np.savez_compressed(prefix + '_peth.npz', bin_size=HISTOGRAM_BINSIZE, profiles=np.asarray(options['profiles']),
+                            window_names=np.array(window_names), windows=np.array(list(options['windows'].values())),
+                            stats=json.dumps(replay.stats), **arrays)
+        return path, replay.stats
+    except Exception as e:
+        logger.error("Session %s failed: %s" % (path, str(e)))
+        return path, str(e)
+
+def load_spikes(fname):
+    '''Map a spike time file written by the batch processing into memory (1D array of :data:`SPIKE_DTYPE`).'''
+    if os.path.getsize(fname) == 0:
+        return np.zeros(0, dtype=SPIKE_DTYPE)
+    return np.memmap(fname, dtype=SPIKE_DTYPE, mode='r')
+
+def parse_range(text):
+    '''Parse ``start:end`` (seconds).'''
+    start, end = [float(v) for v in text.split(':')]
+    return [start, end]
+
+def parse_channels(text):
+    '''Parse a 1-based channel list like ``1-4, 17`` into 0-based channel indices.'''
+    channels = []
+    for part in re.split(r'[,\s]+', text.strip()):
+        if '-' in part:
+            first, last = [int(v) for v in part.split('-')]
+            channels.extend(range(first - 1, last))
+        elif part:
+            channels.append(int(part) - 1)
+    return channels
+
+def main(argv=None):
+    '''Command line entry point (``opeth-batch``).'''
+    parser = argparse.ArgumentParser(description="Offline PETH computation over Open Ephys binary format "
+                                     "recordings (directories are searched for %s) or OPETH recordings." % OEBIN_NAME)
+    parser.add_argument('sessions', nargs='+', help="recording directories or OPETH recording names")
+    parser.add_argument('-o', '--output', default='.', help="output directory (default: current directory)")
+    parser.add_argument('-t', '--threshold', type=float, default=None,
+                        help="spike threshold in V (absolute value), omit to use recorded OE spikes (OPETH recordings)")
+    parser.add_argument('--profiles', default='1', help="threshold multipliers, e.g. 1,1.5 (default: 1)")
+    parser.add_argument('--rising-edge', action='store_true', help="detect positive threshold crossings")
+    parser.add_argument('--roi', type=parse_range, default=list(EVENT_ROI), help="main event window start:end in seconds")
+    parser.add_argument('--window', action='append', default=[], help="extra event window name:start:end (repeatable)")
+    parser.add_argument('--ttl-channel', type=int, default=None, help="trigger channel (1-based, default: all)")
+    parser.add_argument('--disabled', type=parse_channels, default=[], help="disabled channels, e.g. 33-35")
+    parser.add_argument('--keep-aux', action='store_true', help="keep AUX channels of 35/70 channel recordings")
+    parser.add_argument('--bandpass', type=parse_range, default=None, help="band-pass filter low:high in Hz")
+    parser.add_argument('--reference', choices=[REREF_CAR, REREF_CMR], default=None, help="re-referencing")
+    parser.add_argument('--group-size', type=int, default=0, help="channels sharing a reference (0: all)")
+    parser.add_argument('--stream', type=int, default=0, help="continuous stream index in %s" % OEBIN_NAME)
+    parser.add_argument('--block', type=int, default=BATCH_BLOCK, help="samples per processed block")
+    parser.add_argument('-j', '--jobs', type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
+
+    windows = OrderedDict([(MAIN_WINDOW, args.roi)])
+    for entry in args.window:
+        name, start, end = entry.split(':')
+        windows[name] = [float(start), float(end)]
+
+    options = dict(threshold=args.threshold, profiles=[float(p) for p in args.profiles.split(',')],
+                   rising_edge=args.rising_edge, windows=windows,
+                   ttl_ch=None if args.ttl_channel is None else args.ttl_channel - 1,
+                   disabled=args.disabled, drop_aux=not args.keep_aux, band=args.bandpass,
+                   reference=args.reference, group_size=args.group_size, stream=args.stream, block=args.block)
+
+    sessions = find_sessions(args.sessions)
+    if not sessions:
+        logger.error("No sessions found")
+        return 1
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    tasks = [(path, args.output, options) for path in sessions]
+    failed = 0
+    pool = multiprocessing.Pool(processes=min(args.jobs or multiprocessing.cpu_count(), len(tasks)))
+    try:
+        for path, result in pool.imap_unordered(process_session, tasks):
+            if isinstance(result, dict):
+                print("%s: %.1f s, %d triggers, %.1fx real time" % (path, result['duration'], result['trials'], result['speedup']))
+            else:
+                print("%s: FAILED (%s)" % (path, result))
+                failed += 1
+    finally:
+        pool.close()
+        pool.join()
+    return 1 if failed else 0
+
+logger = logging.getLogger("logger")
+
+if __name__ == '__main__':
+    sys.exit(main())
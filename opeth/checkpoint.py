@@ -0,0 +1,204 @@
+'''Checkpoints of the accumulated analysis state, so that a restarted OPETH continues the
+histograms of a running experiment instead of starting from scratch.
+
+A checkpoint holds the PETHs of all event windows, trigger channels and threshold profiles
+(including the trials of rolling mode), the stored spikes (Open Ephys and detected ones), the
+spike thresholds and the display/processing settings defining the histograms (ROI, event windows,
+threshold profiles, PETH mode). It is a ``.npz`` file of plain arrays (no pickling) plus a JSON
+header, with :data:`CHECKPOINT_VERSION` stored in it: files of other versions are ignored.
+
+Files are written atomically: the checkpoint is written to a temporary file which then replaces
+the previous one, so a crash while writing never leaves a corrupt checkpoint behind. State is
+copied on the caller's thread (:func:`analysis_state`), compression-free writing happens on a
+background thread (:class:`Checkpointer`); loading a large session is a few memory copies.
+'''
+
+from __future__ import division
+import sys
+if sys.version_info.major >= 3:
+    from time import perf_counter as clock
+else:
+    from time import clock
+
+import os
+import time
+import json
+import threading
+import logging
+import numpy as np
+
+from .peth import PETH_ROLLING, PETH_EXPONENTIAL
+
+CHECKPOINT_VERSION = 1          #: Layout version of the checkpoint files
+
+def pack_json(obj):
+    return np.frombuffer(json.dumps(obj).encode('utf-8'), dtype=np.uint8)
+
+def unpack_json(arr):
+    return json.loads(arr.tobytes().decode('utf-8'))
+
+def spikestore_state(store):
+    '''Copy of the spikes of a :class:`colldata.SpikeStore`: 4 x N int64 array (timestamp, channel, unit, profile).'''
+    return np.array([store.ts[:], store.channel[:], store.unit[:], store.profile[:]], dtype=np.int64).reshape(4, -1)
+
+def restore_spikestore(store, spikes):
+    store.clear()
+    store.append(spikes[0], spikes[1], spikes[2], spikes[3])
+
+def pethset_state(pethset, prefix, arrays):
+    '''Add the histograms of a :class:`peth.PethSet` to `arrays` with names starting with `prefix`.'''
+    keys = pethset.keys()
+    arrays[prefix + 'keys'] = np.array(keys, dtype=np.int32).reshape(-1, 2)
+    arrays[prefix + 'bins'] = np.array([pethset[key].bins for key in keys]).reshape(
+                                       len(keys), pethset.nchannels, pethset.nbins)
+    arrays[prefix + 'trials'] = np.array([pethset[key].trials for key in keys], dtype=float)
+    if pethset.mode == PETH_ROLLING:
+        # trials kept for eviction, oldest first
+        lengths, channels, binpos = [], [], []
+        for key in keys:
+            peth = pethset[key]
+            ring = peth.ring[:peth.trials] if peth.trials < peth.window else peth.ring[peth.ring_pos:] + peth.ring[:peth.ring_pos]
+            for trial_channels, trial_binpos in ring:
+                lengths.append(len(trial_channels))
+                channels.append(trial_channels)
+                binpos.append(trial_binpos)
+        arrays[prefix + 'ring_len'] = np.array(lengths, dtype=np.int64)
+        arrays[prefix + 'ring_ch'] = np.concatenate(channels).astype(np.int32) if channels else np.zeros(0, np.int32)
+        arrays[prefix + 'ring_bin'] = np.concatenate(binpos).astype(np.int32) if binpos else np.zeros(0, np.int32)
+
+def restore_pethset(pethset, prefix, arrays):
+    '''Load histograms saved by :func:`pethset_state` into an (empty) :class:`peth.PethSet` of the same size and mode.'''
+    bins = arrays[prefix + 'bins']
+    if bins.shape[1:] != (pethset.nchannels, pethset.nbins):
+        return False
+    if pethset.mode == PETH_ROLLING:
+        ends = np.cumsum(arrays[prefix + 'ring_len'])
+        starts = ends - arrays[prefix + 'ring_len']
+        first = 0
+    for key, key_bins, trials in zip(arrays[prefix + 'keys'], bins, arrays[prefix + 'trials']):
+        peth = pethset[tuple(int(k) for k in key)]
+        peth.bins[:] = key_bins
+        if pethset.mode == PETH_ROLLING:
+            peth.trials = int(trials)
+            for i in range(peth.trials):
+                peth.ring[i] = (arrays[prefix + 'ring_ch'][starts[first + i]:ends[first + i]].astype(int),
+                                arrays[prefix + 'ring_bin'][starts[first + i]:ends[first + i]].astype(int))
+            peth.ring_pos = peth.trials % peth.window
+            first += peth.trials
+        else:
+            peth.trials = float(trials) if pethset.mode == PETH_EXPONENTIAL else int(trials)
+    return True
+
+def analysis_state(header, peths, oe_spikes, detector, thresholds):
+    '''Collect (copy) the analysis state into a dict of arrays.
+
+    Args:
+        header (dict): JSON serializable settings, e.g. channel count, sampling rate, event windows
+        peths (OrderedDict): event window name -> :class:`peth.PethSet`
+        oe_spikes (colldata.SpikeStore): spikes received from Open Ephys
+        detector (colldata.DataProc): spike detector (detected spikes and the incremental search state)
+        thresholds (1D np.ndarray): per channel thresholds
+
+    Returns:
+        dict of arrays to be written by :func:`save_checkpoint`
+    '''
+    header = dict(header, windows=list(peths.keys()),
+                  peth_modes=[(pethset.mode, pethset.window) for pethset in peths.values()],
+                  detected_until=None if detector.detected_until is None else int(detector.detected_until),
+                  saved=time.time())
+    arrays = dict(version=np.array([CHECKPOINT_VERSION]),
+                  header=pack_json(header),
+                  oe_spikes=spikestore_state(oe_spikes),
+                  det_spikes=spikestore_state(detector.spikes),
+                  det_next_search=np.array(detector.next_search, dtype=np.int64),
+                  det_over_threshold=np.array([] if detector.over_threshold is None else detector.over_threshold, dtype=bool),
+                  thresholds=np.array(thresholds, dtype=float))
+    for idx, pethset in enumerate(peths.values()):
+        pethset_state(pethset, 'peth%d_' % idx, arrays)
+    return arrays
+
+def save_checkpoint(fname, arrays):
+    '''Write a checkpoint atomically (temporary file + rename).'''
+    tmpname = fname + '.tmp'
+    with open(tmpname, 'wb') as f:
+        np.savez(f, **arrays)
+        f.flush()
+        os.fsync(f.fileno())
+    if sys.platform.startswith('win') and os.path.exists(fname):
+        os.remove(fname)
+    os.rename(tmpname, fname)
+
+def load_checkpoint(fname):
+    '''Load a checkpoint into memory.
+
+    Returns:
+        header (dict) and the dict of arrays, or None if the file does not exist or is unusable
+    '''
+    if not os.path.isfile(fname):
+        return None
+    try:
+        with np.load(fname, allow_pickle=False) as npz:
+            arrays = dict((name, npz[name]) for name in npz.files)
+        if int(arrays['version'][0]) != CHECKPOINT_VERSION:
+            logger.warning("Checkpoint %s ignored: version %d instead of %d" %
+                           (fname, int(arrays['version'][0]), CHECKPOINT_VERSION))
+            return None
+        return unpack_json(arrays['header']), arrays
+    except Exception as e:
+        logger.error("Unable to load checkpoint %s: %s" % (fname, str(e)))
+        return None
+
+def restore_detector(detector, header, arrays):
+    '''Restore the detected spikes and the incremental search state of a :class:`colldata.DataProc`.'''
+    restore_spikestore(detector.spikes, arrays['det_spikes'])
+    detector.detected_until = header['detected_until']
+    detector.next_search = arrays['det_next_search']
+    detector.over_threshold = arrays['det_over_threshold'] if len(arrays['det_over_threshold']) else None
+
+class Checkpointer(object):
+    '''Writes checkpoints on a background thread, at most one at a time.
+
+    Attributes:
+        fname (str): checkpoint file
+        last_duration (float): time spent writing the last checkpoint in seconds
+    '''
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.thread = None
+        self.last_duration = 0.
+
+    def busy(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def save(self, arrays, wait=False):
+        '''Write a checkpoint of a state collected by :func:`analysis_state`.
+
+        Args:
+            arrays (dict): state to be written
+            wait (bool): write on the calling thread (e.g. at exit)
+
+        Returns:
+            False if the previous checkpoint is still being written (the new one is skipped)
+        '''
+        if self.busy():
+            if not wait:
+                return False
+            self.thread.join()
+        if wait:
+            self.write(arrays)
+        else:
+            self.thread = threading.Thread(target=self.write, args=(arrays,), name="Checkpointer")
+            self.thread.daemon = True
+            self.thread.start()
+        return True
+
+    def write(self, arrays):
+        start = clock()
+        try:
+            save_checkpoint(self.fname, arrays)
+        except (IOError, OSError) as e:
+            logger.error("Unable to write checkpoint %s: %s" % (self.fname, str(e)))
+        self.last_duration = clock() - start
+
+logger = logging.getLogger("logger")
@@ -49,6 +49,7 @@ class CircularBuffer(Sequence):
         self._allocated = allocated
         self._left_index = 0
         self._right_index = 0 # next write position
+        self.compactions = 0  #: Number of times the contents were moved to the start of the allocated space
         
     def append(self, value):
         """Insert an item at the end of the array.
@@ -83,6 +84,7 @@ class CircularBuffer(Sequence):
             
             self._right_index -= self._left_index
             self._left_index = 0
+            self.compactions += 1
         
         # add in the new elements
         if self._append_axis == 0:
@@ -6,8 +6,16 @@
 
 * search for spikes over threshold
 
-Data, TTL and timestamp storage happens in :class:`Collector` class, and
-Spike detection and data compression for raw plotting are performed in :class:`DataProc`.
+* store spike events sent by Open Ephys (when a Spike Detector/Sorter runs upstream)
+
+* keep a low-pass filtered, decimated copy of the data (LFP) for minutes with little memory
+
+* optionally band-pass filter and re-reference (CAR/CMR) the incoming data in place
+
+* record the incoming data and events to binary files (see :mod:`recorder`)
+
+Data, TTL and timestamp storage happens in :class:`Collector` class, spike events are kept in a
+:class:`SpikeStore` and spike detection and data compression for raw plotting are performed in :class:`DataProc`.
 '''
 
 from __future__ import division, print_function
@@ -19,6 +27,7 @@ else:
     
 import time
 import logging
+from timeit import default_timer
 import numpy as np
 import math
 from collections import OrderedDict, deque, defaultdict
@@ -26,21 +35,146 @@ from collections import OrderedDict, deque, defaultdict
 
 from .openephys import generate_ttl
 from .circbuff import CircularBuffer
+from .noise import NoiseEstimator
+from .filters import Decimator, SosFilter, Rereference, bandpass_sos
+from .recorder import SessionRecorder, EVENT_TTL, EVENT_SPIKE
+from .flightrec import KIND_TTL_ACCEPTED, KIND_TTL_DROPPED, TTL_DROP_CHANNEL, TTL_DROP_FUTURE, TTL_DROP_HOLDOFF, TTL_DROP_LOST
 
 EVENT_ROI = (-0.02, 0.05)       #: Region of interest in seconds (+-timestamp range in seconds - neighbourhood of a event that is investigated for spikes)
 
 SAMPLES_PER_SEC = 30000         #: Sampling frequency in Hz
 
+DATA_RETENTION = 2              #: Default amount of data kept in buffers (seconds)
+MIN_BUFFER_CAPACITY = 100000    #: Minimal data buffer capacity (samples)
+
+LFP_SAMPLING_RATE = 1000        #: Target sampling rate of the decimated (LFP) data in Hz
+LFP_RETENTION = 60              #: Amount of decimated data kept in seconds
+PREFILTER_ORDER = 2             #: Butterworth order of each edge of the band-pass prefilter
+
 # default threshold level for spike detection
 SPIKE_THRESHOLD = 0.5
 # holdoff time in seconds (suppress spikes too nearby to each other)
 SPIKE_HOLDOFF = 0.00075         #: Dead time / censoring period (seconds)
 
+SPIKESTORE_CAPACITY = 200000   #: Maximal number of spike events kept in a :class:`SpikeStore`
+
 DBG_TEXT_DUMP = False
 
 if DBG_TEXT_DUMP:
     flog = open('textlog.txt', 'wt')
 
+class SpikeStore(object):
+    '''Columnar storage of spike events: timestamp, channel, sorted unit ID and threshold profile of each spike.
+
+    Columns are stored in separate 1D :class:`circbuff.CircularBuffer` instances so a time range
+    can be selected with vectorized operations. When the capacity is reached the oldest spikes are dropped.
+    Batches are sorted by timestamp when appended, while batches arrive in timestamp order (e.g. from
+    :meth:`DataProc.detect_range`) the timestamp column stays sorted and a range is selected by binary search.
+    '''
+
+    def __init__(self, capacity=SPIKESTORE_CAPACITY):
+        '''
+        Args:
+            capacity (int): maximal number of spikes stored
+        '''
+        self.capacity = capacity
+        self.ts = self._column(np.int64)        #: Spike timestamps (sample index)
+        self.channel = self._column(np.int32)   #: Channel the spike was detected on
+        self.unit = self._column(np.int32)      #: Sorted unit ID (0 if unsorted)
+        self.profile = self._column(np.int32)   #: Threshold profile the spike was detected with (see :meth:`DataProc.detect_range`)
+        self.ordered = True     #: Timestamp column is sorted (no batch arrived earlier than a stored spike)
+
+    def _column(self, dtype):
+        return CircularBuffer(capacity=self.capacity, allocated=self.capacity*2, dtype=dtype,
+                              initial_shape=[self.capacity*2], append_axis=0)
+
+    def __len__(self):
+        return len(self.ts)
+
+    def append(self, ts, channel, unit=0, profile=0):
+        '''Store a batch of spikes.
+
+        Args:
+            ts (int or array): spike timestamps
+            channel (int or array): channel of each spike
+            unit (int or array): sorted unit ID of each spike, 0 for unsorted spikes
+            profile (int or array): threshold profile index of each spike
+        '''
+        ts = np.atleast_1d(np.asarray(ts, dtype=np.int64))
+        if len(ts) == 0:
+            return
+        columns = [np.broadcast_to(np.asarray(values, dtype=np.int32), ts.shape)
+                   for values in (channel, unit, profile)]
+        if len(ts) > 1 and np.any(ts[1:] < ts[:-1]):
+            order = np.argsort(ts, kind='mergesort')
+            ts = ts[order]
+            columns = [values[order] for values in columns]
+
+        if len(ts) > self.capacity:
+            ts = ts[-self.capacity:]
+            columns = [values[-self.capacity:] for values in columns]
+        overflow = len(self) + len(ts) - self.capacity
+        if overflow > 0:
+            self.drop(overflow)
+
+        if len(self) and ts[0] < self.ts[-1]:
+            self.ordered = False
+        self.ts.append(ts)
+        for column, values in zip((self.channel, self.unit, self.profile), columns):
+            column.append(values)
+
+    def drop(self, nof_elements):
+        '''Remove the oldest `nof_elements` spikes.'''
+        for column in (self.ts, self.channel, self.unit, self.profile):
+            column.drop(nof_elements)
+        if len(self) == 0:
+            self.ordered = True
+
+    def drop_before(self, timestamp):
+        '''Drop spikes stored before the first one with a timestamp not earlier than `timestamp`.'''
+        if len(self) == 0:
+            return
+        if self.ordered:
+            self.drop(np.searchsorted(self.ts[:], timestamp, 'left'))
+            return
+        keep = self.ts[:] >= timestamp
+        self.drop(np.argmax(keep) if keep.any() else len(self))
+
+    def clear(self):
+        self.drop(len(self))
+
+    def query(self, ts_min, ts_max, unit=None, profile=None):
+        '''Select the spikes within a timestamp range.
+
+        Args:
+            ts_min, ts_max: inclusive timestamp limits
+            unit (int): if given (and nonzero), only spikes of this sorted unit are returned
+            profile (int): if given, only spikes of this threshold profile are returned
+
+        Returns:
+            timestamps and channels of the selected spikes (two 1D numpy arrays)
+        '''
+        ts = self.ts[:]
+        if self.ordered:
+            # only the range is scanned, the cost does not depend on the store size
+            first, last = np.searchsorted(ts, ts_min, 'left'), np.searchsorted(ts, ts_max, 'right')
+            ts, channel = ts[first:last], self.channel[:][first:last]
+            sel = None
+            if unit:
+                sel = self.unit[:][first:last] == unit
+            if profile is not None:
+                match = self.profile[:][first:last] == profile
+                sel = match if sel is None else np.logical_and(sel, match)
+            if sel is None:
+                return ts.copy(), channel.copy()
+            return ts[sel], channel[sel]
+        sel = np.logical_and(ts >= ts_min, ts <= ts_max)
+        if unit:
+            sel = np.logical_and(sel, self.unit[:] == unit)
+        if profile is not None:
+            sel = np.logical_and(sel, self.profile[:] == profile)
+        return ts[sel], self.channel[:][sel]
+
 class Collector(object):
     '''Data storage class for raw analog data, timestamps and event timestamps.
     
@@ -48,12 +182,24 @@ class Collector(object):
         databuffer (2D CircularBuffer): The 2D data storage, each row representing a channel, each column a sample.
         tsbuffer (1D CircularBuffer): Timestamp buffer storing 1 time stamp value for each data column.
         timestamp: Sample number updated on timestamp event or when received explicitly with a set of data.
-        spikes (deque): Spike positions - stored if spikes are sent by OE.
+        spikestore (SpikeStore): Spike events - stored if spikes are sent by OE.
         ttls (deque): TTL positions as sent by OE.
         samples_per_sec (int): Sampling rate.
         prev_trigger_ts (defaultdict(int)): Used to detect backward jumping timestamps in TTL stamps.
         drop_aux (bool): Adjusted through :meth:`set_drop_aux`, affects whether auxiliary data (the
             3 gyroscope channels) is to be filtered or not.
+        retention (float): Amount of data kept in the buffers in seconds, see :meth:`set_retention`.
+        noise (noise.NoiseEstimator): Per-channel noise level estimates, updated by :meth:`add_data`.
+        lfp_decimator (filters.Decimator): Anti-alias filter and decimator producing the LFP data, its state
+            is carried between data packets.
+        lfpbuffer (2D CircularBuffer): Decimated data (:data:`LFP_SAMPLING_RATE`) of the last :data:`LFP_RETENTION` seconds.
+        lfptsbuffer (1D CircularBuffer): Timestamps (in original sample index) of the :attr:`lfpbuffer` columns.
+        keep_lfp (bool): Whether the LFP data is calculated, off until a consumer (the ERP window)
+            switches it on with :meth:`set_keep_lfp`.
+        prefilters (list): Filter stages (:class:`filters.SosFilter`, :class:`filters.Rereference`) applied
+            in place to the new data in :attr:`databuffer`, see :meth:`set_prefilter`.
+        recorder (recorder.SessionRecorder): Records the received data and events if not None,
+            see :meth:`start_recording`.
     '''
     
     def __init__(self):
@@ -63,12 +209,25 @@ class Collector(object):
         
         self.databuffer = None
         self.tsbuffer = None
+
+        self.lfp_decimator = None
+        self.lfpbuffer = None
+        self.lfptsbuffer = None
+        self.keep_lfp = False
+
+        self.prefilters = []
+        self.prefilter_settings = (None, None, 0)
+        self.recorder = None
         
-        self.spikes = deque()
+        self.spikestore = SpikeStore()
+        self.noise = NoiseEstimator()
         self.ttls = deque()
         self.prev_trigger_ts = defaultdict(int)
+        self.roi_end_offset = None  #: ROI end of the last :meth:`next_ttl` call, used for TTL latency stamps
+        self.flightrec = None       #: :class:`flightrec.FlightRecorder` of accepted and dropped TTLs, if set
         self.starttime = clock()
 
+        self.retention = DATA_RETENTION
         self.set_sampling_rate(1) # will be overridden when first data packet is received
 
         self.drop_aux = False
@@ -119,6 +278,9 @@ class Collector(object):
         
         # we accept only 2D arrays!
         assert(len(data.shape) == 2)
+
+        if self.recorder is not None:
+            self.recorder.add_data(data, self.timestamp)
         
         # we get rid of AUX data (gyroscope) if 35 or 70 channels are present
         if self.drop_aux:
@@ -142,17 +304,15 @@ class Collector(object):
 
         if self.databuffer is None:
             # first run: create circular buffer
-            itemcnt = 100000
-            shape = list(data.shape)
-            shape[1] = itemcnt * 2
-            self.databuffer = CircularBuffer(capacity=itemcnt, allocated=itemcnt*2, dtype=np.float32, initial_shape=shape, append_axis=1)
-            shape = [itemcnt * 2]
-            self.tsbuffer = CircularBuffer(capacity=itemcnt, allocated=itemcnt*2, dtype=np.int64, initial_shape=shape, append_axis=0)
+            self.create_buffers(data.shape[0])
         elif curr_ts[-1] < self.tsbuffer[0]:
             # timestamp jump
             logger.debug("Timestamp jump, dropping everything before")
             self.databuffer.drop(len(self.databuffer))
             self.tsbuffer.drop(len(self.tsbuffer))
+            self.spikestore.clear()
+            self.reset_lfp()
+            self.reset_prefilter()
         else:
             # normal append
             pass
@@ -160,9 +320,135 @@ class Collector(object):
         self.databuffer.append(data)
         self.tsbuffer.append(curr_ts)
 
+        # incoming data may be read-only (received buffer), so filtering happens in the storage
+        new_data = self.databuffer[:][:, -data.shape[1]:]
+        for stage in self.prefilters:
+            stage.process(new_data)
+        self.noise.add(new_data)
+
+        if self.ttls and self.roi_end_offset is not None:
+            self.stamp_ready_ttls()
+
         assert(self.databuffer.shape[1] == self.tsbuffer.shape[0])
 
         self.drop_before(self.timestamp - self.max_data_amount)
+        if self.keep_lfp:
+            self.add_lfp(data, curr_ts[0])
+
+    def add_lfp(self, data, first_ts):
+        '''Second pipeline stage of :meth:`add_data`: low-pass filter and decimate the new data
+        into :attr:`lfpbuffer`, keeping the last :data:`LFP_RETENTION` seconds.'''
+        lfp, lfp_ts = self.lfp_decimator.process(data, first_ts)
+
+        if self.lfpbuffer is None:
+            itemcnt = int(LFP_RETENTION * self.samples_per_sec / self.lfp_decimator.factor) + 1
+            self.lfpbuffer = CircularBuffer(capacity=itemcnt, allocated=itemcnt*2, dtype=np.float32,
+                                            initial_shape=[data.shape[0], itemcnt * 2], append_axis=1)
+            self.lfptsbuffer = CircularBuffer(capacity=itemcnt, allocated=itemcnt*2, dtype=np.int64,
+                                              initial_shape=[itemcnt * 2], append_axis=0)
+        if lfp.shape[1] == 0:
+            return
+
+        # drop the oldest samples first if the buffer would overflow
+        overflow = len(self.lfptsbuffer) + len(lfp_ts) - self.lfptsbuffer.size()
+        if overflow > 0:
+            self.lfpbuffer.drop(overflow)
+            self.lfptsbuffer.drop(overflow)
+        self.lfpbuffer.append(lfp)
+        self.lfptsbuffer.append(lfp_ts)
+
+    def set_keep_lfp(self, keep):
+        '''Start or stop the LFP collection (see :meth:`lfp_data`). While the LFP is kept, TTLs are
+        released only when the LFP data of their region of interest is complete as well.'''
+        if keep != self.keep_lfp:
+            self.reset_lfp()
+        self.keep_lfp = keep
+
+    def roi_ready_until(self):
+        '''Last timestamp up to which the region of interest of a TTL is available: the last
+        received sample, minus the decimation filter delay if the LFP is kept.'''
+        last_ts = self.tsbuffer[-1]
+        if self.keep_lfp:
+            last_ts -= self.lfp_decimator.delay
+        return last_ts
+
+    def reset_lfp(self):
+        '''Restart LFP collection (e.g. after a timestamp jump or sampling rate change).'''
+        self.lfp_decimator = Decimator(max(1, self.samples_per_sec // LFP_SAMPLING_RATE))
+        self.lfpbuffer = None
+        self.lfptsbuffer = None
+
+    def start_recording(self, basename):
+        '''Start recording the received data (as received, before AUX channel removal and
+        filtering) and events to binary files, see :class:`recorder.SessionRecorder`.'''
+        self.stop_recording()
+        self.recorder = SessionRecorder(basename, self.samples_per_sec)
+
+    def stop_recording(self):
+        '''Write the pending data and close the recording (if any).'''
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def set_prefilter(self, band=None, reference=None, group_size=0):
+        '''Configure the filter stages applied to the incoming data before storage.
+
+        Args:
+            band (tuple): (low, high) pass band in Hz, None for no band-pass filtering
+            reference (str): :data:`filters.REREF_CAR`, :data:`filters.REREF_CMR` or None
+            group_size (int): number of consecutive channels sharing a reference, 0 for all channels
+        '''
+        self.prefilter_settings = (band, reference, group_size)
+        self.reset_prefilter()
+
+    def reset_prefilter(self):
+        '''(Re)create the prefilter stages (e.g. after a sampling rate change or a timestamp jump).'''
+        band, reference, group_size = self.prefilter_settings
+        self.prefilters = []
+        if band is not None and 0 < band[0] < band[1] < self.samples_per_sec / 2:
+            self.prefilters.append(SosFilter(bandpass_sos(band[0], band[1], self.samples_per_sec, PREFILTER_ORDER)))
+        elif band is not None:
+            logger.warning("Band-pass %s Hz is not valid at %d Hz sampling rate" % (band, self.samples_per_sec))
+        if reference is not None:
+            self.prefilters.append(Rereference(reference, group_size))
+
+    def lfp_data(self, tsrange_min, tsrange_max):
+        '''Return the decimated (LFP) data and timestamps within a timestamp range, see :meth:`roi_data`.
+
+        Returns:
+            2D numpy array of data (one row per channel) and 1D numpy array of timestamps
+            (in original sample index) within the range, empty if no LFP data is available.
+        '''
+        if self.lfptsbuffer is None or len(self.lfptsbuffer) == 0:
+            return np.zeros((self.channel_cnt(), 0), dtype=np.float32), np.zeros(0, dtype=np.int64)
+        ts = self.lfptsbuffer[:]
+        first = np.searchsorted(ts, tsrange_min, side='left')
+        last = np.searchsorted(ts, tsrange_max, side='right')
+        return self.lfpbuffer[:][:, first:last], ts[first:last]
+
+    def create_buffers(self, channels):
+        '''Allocate :attr:`databuffer` and :attr:`tsbuffer` with a capacity sufficient for
+        :attr:`max_data_amount` samples. Data already present is moved to the new buffers.'''
+        itemcnt = max(MIN_BUFFER_CAPACITY, 2 * int(self.max_data_amount))
+        databuffer = CircularBuffer(capacity=itemcnt, allocated=itemcnt*2, dtype=np.float32,
+                                    initial_shape=[channels, itemcnt * 2], append_axis=1)
+        tsbuffer = CircularBuffer(capacity=itemcnt, allocated=itemcnt*2, dtype=np.int64,
+                                  initial_shape=[itemcnt * 2], append_axis=0)
+        if self.databuffer is not None:
+            databuffer.append(self.databuffer[:])
+            tsbuffer.append(self.tsbuffer[:])
+        self.databuffer = databuffer
+        self.tsbuffer = tsbuffer
+
+    def set_retention(self, seconds):
+        '''Set the amount of data kept in the buffers, e.g. to fit the widest region of interest
+        around events. Buffers are reallocated if their capacity is not sufficient.
+
+        Args:
+            seconds (float): data older than this (relative to the last timestamp) is dropped
+        '''
+        self.retention = seconds
+        self.set_sampling_rate(self.samples_per_sec)
 
     def drop_before(self, timestamp):
         '''Drop old data which is not required for any of the various displays.
@@ -172,6 +458,7 @@ class Collector(object):
             amin = np.argmax(self.tsbuffer >= timestamp)
             self.tsbuffer.drop(amin)
             self.databuffer.drop(amin)
+            self.spikestore.drop_before(self.tsbuffer[0])
 
         assert(self.databuffer.shape[1] == self.tsbuffer.shape[0])
 
@@ -223,8 +510,14 @@ class Collector(object):
             return self.databuffer.shape[0]
 
     def add_spike(self, spike):
-        '''Store a new spike event. (Not used currently.)'''
-        self.spikes.append(spike)
+        '''Store a new spike event received from OE in :attr:`spikestore`.
+
+        Only the timestamp, the channel and the sorted unit ID are kept,
+        the waveform of the event is not decoded.
+        '''
+        self.spikestore.append(spike.timestamp, spike.channel, spike.sorted_id)
+        if self.recorder is not None:
+            self.recorder.add_event(spike.timestamp, EVENT_SPIKE, spike.channel, unit=spike.sorted_id)
 
     def add_ttl(self, ttl):
         '''Store a new TTL event.
@@ -237,44 +530,61 @@ class Collector(object):
         if ttl.timestamp is None:
             ttl.timestamp = self.timestamp + ttl.sample_num
         self.ttls.append(ttl)
+        if self.recorder is not None:
+            self.recorder.add_event(ttl.timestamp, EVENT_TTL, ttl.event_channel, ttl.event_id)
         if DBG_TEXT_DUMP:
             flog.write("TTL: %s\n" % str(ttl))
 
-    def process_ttl(self, start_offset=EVENT_ROI[0], end_offset=EVENT_ROI[1],
-                    ttl_ch=None, trigger_holdoff = 0.001, **kwargs):
-        '''Process a TTL (event), return data and timestamp around event on success
-        or (None, None) otherwise - using first TTL from ttl_ch.
-        
-        Drops all TTLs silently from channels other than ttl_ch.
-        Works on data accumulated by :meth:`add_data` calls (:attr:`dataarray` numpy array) 
+    def stamp_ready_ttls(self):
+        '''Store the time the ROI data of the pending TTLs became complete in ``ttl.roi_time``
+        (see :class:`debug.TriggerLatency`).'''
+        now = default_timer()
+        last_ts = self.roi_ready_until()
+        end_offset = self.roi_end_offset * self.timestamp_per_sec
+        for ttl in self.ttls:
+            if ttl.timestamp + end_offset >= last_ts:
+                break
+            if getattr(ttl, 'roi_time', None) is None:
+                ttl.roi_time = now
+
+    def next_ttl(self, start_offset=EVENT_ROI[0], end_offset=EVENT_ROI[1],
+                 ttl_ch=None, trigger_holdoff = 0.001, **kwargs):
+        '''Find the first TTL (event) from ttl_ch whose region of interest is already
+        entirely present in the data buffers, and remove it from the TTL queue.
+
+        Drops all TTLs silently from channels other than ttl_ch; if ttl_ch is None, TTLs of all
+        channels are returned (the channel is available as ``ttl.event_channel``).
+        Works on data accumulated by :meth:`add_data` calls (:attr:`tsbuffer`)
         and TTLs from :meth:`add_ttl` calls (self.ttls list). Too frequent pulses are filtered
         by `trigger_holdoff`
 
         Args:
-            start_offset (float): TTL-relative start offset in seconds, typically a small negative value to return data 
+            start_offset (float): TTL-relative start offset in seconds, typically a small negative value to return data
                 collected right before the TTL signal
             end_offset (float): TTL-relative end offset in seconds specifying end of data ROI
-            ttl_ch (int): channel whose TTL events are to be processed as trigger
+            ttl_ch (int): channel whose TTL events are to be processed as trigger, None for all channels
             trigger_holdoff (float): holdoff time in seconds until no new triggers are processed
-                (to protect the system against trigger bursts in case of broken cabling etc.)
+                (to protect the system against trigger bursts in case of broken cabling etc.),
+                applied separately for each TTL channel
         Returns:
-            2D numpy array of data (one row per channel) around the TTL ``[-start_offset .. +end_offset]``, 
-            1D numpy array of timestamps (same number of columns as data).
-            Timestamps are actually sample number (sort of).
+            a ``(ttl, tsrange_min, tsrange_max)`` tuple with the TTL event and the timestamp limits of its
+            region of interest, or None if no TTL is ready to be processed.
         '''
 
+        self.roi_end_offset = end_offset
         while 1:
             if len(self.tsbuffer) == 0:
                 logger.info("No data to perform operations on")
-                return None, None
+                return None
 
             if not self.ttls:
-                return None, None
+                return None
 
             ttl = self.ttls[0]
 
             if ttl_ch is not None and ttl.event_channel != ttl_ch:
                 self.ttls.popleft()
+                self.flightrec_ttl(ttl, TTL_DROP_CHANNEL)
                 continue
             elif ttl.timestamp > self.tsbuffer[-1] + self.samples_per_sec * 2:
                 # We have a TTL for the proper channel, let's check whether a timestamp jump has occured
@@ -282,6 +592,7 @@ class Collector(object):
                 #  a remainder of a previous OE play session
                 logger.info("Dropping TTL timestamp %d - last data ts: %d" % (ttl.timestamp, self.tsbuffer[-1]))
                 self.ttls.popleft()
+                self.flightrec_ttl(ttl, TTL_DROP_FUTURE)
                 continue
             else:
                 pass
@@ -289,17 +600,17 @@ class Collector(object):
             # check for ttl trigger ts
             # If the last timestamp is more than 1 sec ahead, then we had a timestamp jump,
             #  stop using old timeout values
-            if self.prev_trigger_ts[ttl_ch] > ttl.timestamp + 1:
+            if self.prev_trigger_ts[ttl.event_channel] > ttl.timestamp + 1:
                 logger.info("Timestamp jump detected during TTL processing")
                 for k in self.prev_trigger_ts.keys():
                     self.prev_trigger_ts[k] = 0
 
-            elif self.prev_trigger_ts[ttl_ch] > ttl.timestamp + trigger_holdoff:
+            elif (self.prev_trigger_ts[ttl.event_channel] and
+                  ttl.timestamp < self.prev_trigger_ts[ttl.event_channel] + trigger_holdoff * self.timestamp_per_sec):
                 # normal case, previous TTL was too near (within holdoff)
+                self.ttls.popleft()
+                self.flightrec_ttl(ttl, TTL_DROP_HOLDOFF)
                 continue
-            else:
-                # normal case, new valid TTL detected - keep its timestamp for timeout
-                self.prev_trigger_ts[ttl_ch] = ttl.timestamp
 
             tsrange_min = ttl.timestamp + start_offset * self.timestamp_per_sec
             tsrange_min = max(tsrange_min, 0)
@@ -310,21 +621,65 @@ class Collector(object):
 
             if tsrange_min < self.tsbuffer[0]: # corresponding data is already lost, drop this TTL
                 logger.info("TTL timestamp %d earlier than available data %d, skipping" % (tsrange_min, self.tsbuffer[0]))
+                self.prev_trigger_ts[ttl.event_channel] = ttl.timestamp
                 self.ttls.popleft()
+                self.flightrec_ttl(ttl, TTL_DROP_LOST)
                 continue
 
-            if tsrange_max < self.tsbuffer[-1]:
-                # the entire region of interest for the TTL is present -> returning the data
+            if tsrange_max < self.roi_ready_until():
+                # the entire region of interest for the TTL is present
+                # keep its timestamp for the holdoff (set only when the TTL leaves the queue,
+                # a TTL waiting for its data is checked again on the next call)
+                self.prev_trigger_ts[ttl.event_channel] = ttl.timestamp
                 self.ttls.popleft()
-                over_or_eq_min = self.tsbuffer >= tsrange_min
-                below_or_eq_max = self.tsbuffer <= tsrange_max
-                within_limits = np.logical_and(over_or_eq_min, below_or_eq_max)
-                data = self.databuffer[:, within_limits]
-                ts = self.tsbuffer[within_limits]
-                return data, ts
+                self.flightrec_ttl(ttl)
+                return ttl, tsrange_min, tsrange_max
             else:
-                return None, None
-                
+                return None
+
+    def flightrec_ttl(self, ttl, drop_reason=None):
+        '''Record an accepted (or dropped, with the ``TTL_DROP_*`` reason) TTL in :attr:`flightrec`.'''
+        if self.flightrec is not None:
+            if drop_reason is None:
+                self.flightrec.add(KIND_TTL_ACCEPTED, ttl.event_channel, ttl.timestamp)
+            else:
+                self.flightrec.add(KIND_TTL_DROPPED, ttl.event_channel, ttl.timestamp, drop_reason)
+
+    def roi_data(self, tsrange_min, tsrange_max):
+        '''Return the data and timestamps within a timestamp range.
+
+        Timestamps in :attr:`tsbuffer` are increasing, so the range is located by binary search
+        and returned as a view of the buffers (no copy is made). The view is valid only
+        until the next :meth:`add_data` call.
+
+        Args:
+            tsrange_min, tsrange_max: inclusive timestamp limits (e.g. as returned by :meth:`next_ttl`)
+        Returns:
+            2D numpy array of data (one row per channel) and 1D numpy array of timestamps within the range.
+        '''
+        ts = self.tsbuffer[:]
+        first = np.searchsorted(ts, tsrange_min, side='left')
+        last = np.searchsorted(ts, tsrange_max, side='right')
+        return self.databuffer[:][:, first:last], ts[first:last]
+
+    def process_ttl(self, start_offset=EVENT_ROI[0], end_offset=EVENT_ROI[1],
+                    ttl_ch=None, trigger_holdoff = 0.001, **kwargs):
+        '''Process a TTL (event), return data and timestamp around event on success
+        or (None, None) otherwise - using first TTL from ttl_ch.
+        
+        Combines :meth:`next_ttl` and :meth:`roi_data`, see there for the arguments.
+
+        Returns:
+            2D numpy array of data (one row per channel) around the TTL ``[-start_offset .. +end_offset]``, 
+            1D numpy array of timestamps (same number of columns as data).
+            Timestamps are actually sample number (sort of).
+        '''
+        roi = self.next_ttl(start_offset, end_offset, ttl_ch, trigger_holdoff)
+        if roi is None:
+            return None, None
+        _, tsrange_min, tsrange_max = roi
+        return self.roi_data(tsrange_min, tsrange_max)
+
     def set_drop_aux(self, should_drop):
         '''Update AUX channel settings (whether we'd like to search for spikes on them or not).'''
         self.drop_aux = should_drop
@@ -334,7 +689,15 @@ class Collector(object):
         assert(sampling_rate > 0)
         self.samples_per_sec = sampling_rate
         self.timestamp_per_sec = sampling_rate # current open ephys report timestamps as sample index
-        self.max_data_amount = 2 * self.timestamp_per_sec   #: Buffering limit (sample count)
+        self.max_data_amount = int(self.retention * self.timestamp_per_sec)   #: Buffering limit (sample count)
+        if self.databuffer is not None and self.databuffer.size() < 2 * self.max_data_amount:
+            self.create_buffers(self.databuffer.shape[0])
+        if self.lfp_decimator is None or self.lfp_decimator.factor != max(1, sampling_rate // LFP_SAMPLING_RATE):
+            self.reset_lfp()
+        if self.prefilters:
+            self.reset_prefilter()
+        if self.recorder is not None:
+            self.recorder.sampling_rate = sampling_rate
         
     def get_sampling_rate(self):
         return self.samples_per_sec
@@ -365,6 +728,9 @@ class DataProc(object):
 
         self.autottl_holdoff_until = 0
 
+        self.spikes = SpikeStore()  #: Spikes found by :meth:`detect_range`
+        self.reset_detection()
+
     def compress(self, data, rate, timestamps=None):
         '''Compress a 2D matrix column-wise by keeping the min and max values of the compressed chunks.
         
@@ -411,6 +777,80 @@ class DataProc(object):
         else:
             return compressed, compts
 
+    def find_spikes(self, data, threshold, rising_edge=False, disabled=[], start=None, continued=None):
+        """Vectorized threshold crossing search, the core of :meth:`spikedetect` and :meth:`detect_range`.
+
+        Continuous blocks of samples over threshold are located for all channels at once,
+        then each block is evaluated according to the rules described in :meth:`spikedetect`.
+
+        Several threshold profiles can be evaluated on the same data in a single call by passing
+        a 3D threshold array (one 2D channel threshold array per profile). In this case the
+        results refer to rows of ``profile * channels + channel``.
+
+        Args:
+            data (2D ndarray): samples, one row per channel
+            threshold (scalar, vector or 3D array): must have the same number of channels as data.
+            rising_edge (bool): false if threshold level should be considered a negative threshold
+            disabled (list): channels excluded from spike search
+            start (1D int array): per row sample index where the search starts, e.g. to continue
+                the censoring period of a previous block of data. Defaults to 0.
+            continued (1D bool array): rows whose first block over threshold started in a previous
+                block of data (already evaluated there), skipped when the data starts over threshold.
+
+        Returns:
+            rows (channels) and sample positions of the detected spikes (1D int arrays ordered by row,
+            then position) and the per-row sample index where a next search could start.
+        """
+        nch, nsamples = data.shape
+
+        if rising_edge:
+            thresholded = data >= threshold
+        else:
+            thresholded = data <= threshold
+        thresholded = thresholded.reshape(-1, nsamples)
+        nrows = thresholded.shape[0]
+
+        # block starts/ends are the rising/falling edges of the thresholded signal
+        padded = np.zeros((nrows, nsamples + 2), dtype=np.int8)
+        padded[:, 1:-1] = thresholded
+        edges = np.diff(padded, axis=1)
+        block_row, block_start = np.nonzero(edges == 1)
+        block_end = np.nonzero(edges == -1)[1]
+
+        offsets = np.zeros(nrows, dtype=int) if start is None else np.array(start, dtype=int)
+        skip = np.zeros((nrows // nch, nch), dtype=bool)
+        skip[:, [ch for ch in disabled if ch < nch]] = True
+        skip = skip.ravel()
+        if continued is None:
+            continued = np.zeros(nrows, dtype=bool)
+
+        rows, positions = [], []
+        for row, first_over, next_within in zip(block_row, block_start, block_end):
+            if skip[row] or next_within <= offsets[row]:
+                continue
+            if first_over == 0 and continued[row]:
+                offsets[row] = max(offsets[row], next_within)
+                continue
+
+            # a block starting within the censoring period is evaluated from its end
+            first_over = max(first_over, offsets[row])
+            ch_data = data[row % nch, first_over:next_within]
+            if rising_edge:
+                spike_tip_pos = np.argmax(ch_data) + first_over
+            else:
+                spike_tip_pos = np.argmin(ch_data) + first_over
+            rows.append(row)
+            positions.append(spike_tip_pos)
+
+            # Continue processing after current spike
+            # - if spike is 'flat' (too many samples over threshold) then immediately when it's again
+            #   below threshold
+            # - if spike is normal (shorter than spike_holdoff_samples) then not earlier than holdoff
+            #   (measured from first sample where spike is over threshold)
+            offsets[row] = max(first_over + self.spike_holdoff_samples, next_within)
+
+        return np.array(rows, dtype=int), np.array(positions, dtype=int), offsets
+
     def spikedetect(self, data, timestamps, threshold = SPIKE_THRESHOLD, rising_edge = False, disabled = []):
         """Detect spikes based on threshold level.
 
@@ -431,70 +871,76 @@ class DataProc(object):
             a list of spike positions (sample index) and another list of the same position as timestamp.
         """
 
-        if rising_edge:
-            thresholded = data >= threshold
+        channels, positions, _ = self.find_spikes(data, threshold, rising_edge, disabled)
+
+        # spike positions are returned per channel
+        spikepositions = [[] for i in range(data.shape[0])]
+        spikestamps = [[] for i in range(data.shape[0])]
+        for ch, pos in zip(channels, positions):
+            spikepositions[ch].append(pos)
+            spikestamps[ch].append(timestamps[pos])
+
+        return spikepositions, spikestamps
+
+    def detect_range(self, tsrange_min, tsrange_max, threshold, rising_edge=False, disabled=[]):
+        """Detect spikes in the collected data within a timestamp range and store them in :attr:`spikes`.
+
+        Detection is incremental: data already searched for an earlier, overlapping region of interest
+        is not processed again, the search continues where it stopped (with the censoring period
+        carried over). This way overlapping ROIs, e.g. of triggers on different TTL channels,
+        share the detected spikes. Query the results with :meth:`SpikeStore.query`.
+
+        With a 3D `threshold` array all threshold profiles are evaluated on the same data in one
+        pass (see :meth:`find_spikes`), spikes are stored with their profile index.
+        Changing the number of profiles restarts the incremental search.
+
+        Args:
+            tsrange_min, tsrange_max: inclusive timestamp limits of the region to be searched
+            threshold, rising_edge, disabled: see :meth:`spikedetect` and :meth:`find_spikes`
+        """
+        tsbuffer = self.coll.tsbuffer
+        if len(tsbuffer) == 0:
+            return
+
+        if self.detected_until is not None and self.detected_until > tsbuffer[-1]:
+            # timestamp jump: data restarted
+            self.reset_detection()
+
+        continuing = self.detected_until is not None and self.detected_until + 1 >= tsrange_min
+        search_from = self.detected_until + 1 if continuing else tsrange_min
+        if search_from > tsrange_max:
+            return
+
+        data, ts = self.coll.roi_data(search_from, tsrange_max)
+        if len(ts) == 0:
+            return
+
+        nch = data.shape[0]
+        nrows = nch * (np.shape(threshold)[0] if np.ndim(threshold) == 3 else 1)
+        if continuing and len(self.next_search) == nrows:
+            start = np.maximum(self.next_search - ts[0], 0)
+            continued = self.over_threshold
         else:
-            thresholded = data <= threshold
+            start, continued = None, None
 
-        # simplest spike detection: first index of signal over threshold 
-        #where = np.argmax(thresholded, axis = 1) 
-        #if type(threshold) != float:
-        #    print "T0", threshold, data.min(), data.max()
-        #    print "Where:", where
-        #    return [], []
+        rows, positions, offsets = self.find_spikes(data, threshold, rising_edge, disabled, start, continued)
 
-        # spike detection is per-channel
+        self.spikes.drop_before(tsbuffer[0])
+        self.spikes.append(ts[positions], rows % nch, profile=rows // nch)
 
-        spikepositions = []
-        spikestamps = []
+        self.detected_until = ts[-1]
+        self.next_search = offsets + ts[0]
+        last = data[:, -1:]
+        self.over_threshold = np.broadcast_to((last >= threshold) if rising_edge else (last <= threshold),
+                                              (nrows // nch, nch, 1)).ravel()
 
-        for i in range(data.shape[0]):
-            offset = 0  # next search position
-            # thresholded bool value for a single channel
-            ch_thresholded = thresholded[i,:]
-
-            # list of spike positions on a single channel
-            ch_pos, ch_time = [], []
-
-            if i not in disabled:
-                while len(ch_thresholded[offset:])>0:
-
-                    # get the index of the first element exceeding threshold
-                    first_over = np.argmax(ch_thresholded[offset:])
-
-                    # check whether the return value of argmax is valid
-                    # -> exit from inner loop if nothing over threshold limit left
-                    if first_over == 0 and ch_thresholded[offset] == False:
-                        break
-
-                    first_over += offset
-                    next_within = np.argmin(ch_thresholded[first_over:])
-                    if next_within == 0:  # end of data, still over threshold
-                        next_within = len(ch_thresholded)
-                    else:
-                        next_within += first_over
-
-                    drange = range(first_over, next_within)
-
-                    if rising_edge:
-                        spike_tip_pos = np.argmax(data[i, drange]) + first_over
-                    else:
-                        spike_tip_pos = np.argmin(data[i, drange]) + first_over
-                    ch_pos.append(spike_tip_pos)
-                    ch_time.append(timestamps[spike_tip_pos])
-
-                    # Continue processing after current spike
-                    # - if spike is 'flat' (too many samples over threshold) then immediately when it's again
-                    #   below threshold
-                    # - if spike is normal (shorter than spike_holdoff_samples) then not earlier than holdoff
-                    #   (measured from first sample where spike is over threshold)
-                    offset = max(first_over + self.spike_holdoff_samples, next_within)
-
-            spikepositions.append(ch_pos)
-            spikestamps.append(ch_time)
+    def reset_detection(self):
+        """Forget the spikes found by :meth:`detect_range`, e.g. after threshold changes."""
+        self.spikes.clear()
+        self.detected_until = None  # last timestamp searched by detect_range
+        self.next_search = []       # per channel timestamp where the censoring period ends
+        self.over_threshold = None  # per channel state of the last searched sample
 
-        return spikepositions, spikestamps
-        
     def set_sampling_rate(self, sampling_rate):
         logger.info("Data processor assumes sampling rate %d" % sampling_rate)
         self.spike_holdoff_samples = int(round(SPIKE_HOLDOFF * sampling_rate))
@@ -17,9 +17,12 @@ import uuid
 import json
 
 from .openephys import OpenEphysEvent, OpenEphysSpikeEvent
+from .flightrec import KIND_MESSAGE, KIND_MESSAGE_GAP
 from .colldata import Collector, SAMPLES_PER_SEC
+from .wirecap import WireCapture
 
 COMMPROCESS_MAX_POLLTIME = 0.1    # max amount of time that can be spent in the communication loop before returning
+WIRE_CAPTURE = None     #: If set to a file name, all received data socket messages are captured into it (see :mod:`wirecap`)
 
 class CommProcess(object):
     '''ZMQ communication process - stores data, called periodically from GUI process.
@@ -58,13 +61,32 @@ class CommProcess(object):
         self.isStats = False
         self.msgstat_start = None
         self.msgstat_size = []
+        self.received_messages = 0  #: Number of messages received on the data socket
+        self.received_bytes = 0     #: Total size of the received messages
+        self.message_gaps = 0       #: Number of messages missing from the message number sequence
+        self.heartbeat_sent = None  #: Send time of the last heartbeat
+        self.heartbeat_rtt = None   #: Round trip time of the last answered heartbeat in seconds
+        self.flightrec = None       #: :class:`flightrec.FlightRecorder` of received messages, if set
         self.collector = Collector()
+        self.capture = None
+        if WIRE_CAPTURE:
+            self.start_capture(WIRE_CAPTURE)
         
         self.samprate = -1
         self.channels = 0
 
         logger.debug("ZMQ: dataport %d, eventport %d" % (dataport, eventport))
 
+    def start_capture(self, fname):
+        '''Capture all messages received on the data socket to a file (see :class:`wirecap.WireCapture`).'''
+        self.stop_capture()
+        self.capture = WireCapture(fname)
+
+    def stop_capture(self):
+        if self.capture is not None:
+            self.capture.close()
+            self.capture = None
+
     def add_data(self, n_arr):
         '''Append data to our data `collector`.'''
         self.collector.add_data(n_arr,)
@@ -89,11 +111,8 @@ class CommProcess(object):
             self.channels = channels
             self.collector.update_channels(channels)
             
-    # noinspection PyMethodMayBeStatic
     def add_spike(self, spike):
-        '''Add spikes. Currently not used.'''
-        logger.info("Spike detected...")
-        logger.info(spike)
+        '''Add spikes detected by OE (Spike Detector/Sorter plugin placed before the ZMQ plugin).'''
         self.collector.add_spike(spike)
 
     def send_heartbeat(self):
@@ -103,6 +122,7 @@ class CommProcess(object):
         logger.info("sending heartbeat")
         self.event_socket.send(j_msg.encode('utf-8'))
         self.last_heartbeat_time = time.time()
+        self.heartbeat_sent = default_timer()
         self.socket_waits_reply = True
 
     def send_event(self, event_list=None, event_type=3, sample_num=0, event_id=2, event_channel=1):
@@ -196,10 +216,16 @@ class CommProcess(object):
 
                 try:
                     message = self.data_socket.recv_multipart(zmq.NOBLOCK)
+                    received = default_timer()
+                    self.received_messages += 1
+                    self.received_bytes += sum(len(frame) for frame in message)
                 except zmq.ZMQError as err:
                     logger.error("Got error: {0}".format(err))
                     break
 
+                if message and self.capture is not None:
+                    self.capture.add(message)
+
                 if message:
                     if len(message) < 2:
                         logger.info("No frames for message: ", message[0])
@@ -225,6 +251,11 @@ class CommProcess(object):
 
                     if self.message_no != -1 and header['message_no'] != self.message_no + 1:
                         logger.error("Missing a message at number %d", self.message_no)
+                        self.message_gaps += max(header['message_no'] - self.message_no - 1, 1)
+                        if self.flightrec is not None:
+                            self.flightrec.add(KIND_MESSAGE_GAP, 0, header['message_no'], header['message_no'] - self.message_no - 1)
+                    if self.flightrec is not None:
+                        self.flightrec.add(KIND_MESSAGE, 0, header['message_no'], sum(len(frame) for frame in message))
                     self.message_no = header['message_no']
                     if header['type'] == 'data':
                         c = header['content']
@@ -267,6 +298,7 @@ class CommProcess(object):
                             event = OpenEphysEvent(header['content'], message[2])
                         else:
                             event = OpenEphysEvent(header['content'])
+                        event.receive_time = received   # see debug.TriggerLatency
                         self.add_event(event)
                     elif header['type'] == 'spike':
                         spike = OpenEphysSpikeEvent(header['spike'], message[2])
@@ -289,11 +321,16 @@ class CommProcess(object):
                 logger.info(message.decode('utf-8'))
                 if self.socket_waits_reply:
                     self.socket_waits_reply = False
+                    if self.heartbeat_sent is not None:
+                        self.heartbeat_rtt = default_timer() - self.heartbeat_sent
                 else:
                     logger.info("???? Getting a reply before a send?")
         if events:
             pass  # TODO implement the event passing
 
+        if self.capture is not None:
+            self.capture.flush(if_due=True)
+
         if timeout < default_timer():
             logger.info("Abort due to timeout")
 
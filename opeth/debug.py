@@ -1,17 +1,143 @@
-from collections import defaultdict
+import math
+from collections import defaultdict, deque, OrderedDict
 from timeit import default_timer
 
+LATENCY_MIN = 1e-6              #: Upper edge of the lowest latency bucket (seconds)
+LATENCY_DECADES = 7             #: Latency buckets cover :data:`LATENCY_MIN` ... :data:`LATENCY_MIN` * 10 ** LATENCY_DECADES
+LATENCY_BUCKETS_PER_DECADE = 20 #: Logarithmic resolution of the latency buckets (about 12% wide buckets)
+
+TRIGGER_STAGES = ('roi_wait', 'queueing', 'binning', 'render', 'total')    #: Stages of :class:`TriggerLatency`
+TRIGGER_PENDING_MAX = 1000      #: Binned triggers waiting for a render stamp (older ones are dropped)
+
+def format_latency(name, stats):
+    '''One line text of a :meth:`LatencyHistogram.summary` (in ms).'''
+    return ("%15s: n=%d p50=%.3f p95=%.3f p99=%.3f max=%.3f ms" %
+            (str(name), stats['count'], stats['p50'] * 1000, stats['p95'] * 1000, stats['p99'] * 1000, stats['max'] * 1000))
+
+class LatencyHistogram(object):
+    '''Latency distribution in fixed, logarithmically spaced buckets.
+
+    Adding a sample is a single counter increment (no allocation), percentiles are estimated
+    as the upper edge of the bucket holding them (limited by the exact maximum).
+
+    Attributes:
+        counts (list): sample count of each bucket, first one for latencies up to :data:`LATENCY_MIN`,
+            last one for latencies beyond the range
+        count (int): number of samples
+        total (float): sum of samples in seconds
+        max (float): largest sample in seconds
+    '''
+
+    NBUCKETS = LATENCY_DECADES * LATENCY_BUCKETS_PER_DECADE + 2
+    LOG_MIN = math.log10(LATENCY_MIN)
+
+    def __init__(self):
+        self.counts = [0] * self.NBUCKETS
+        self.clear()
+
+    def clear(self):
+        for i in range(self.NBUCKETS):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, delta):
+        '''Add a latency sample (seconds).'''
+        if delta > LATENCY_MIN:
+            idx = min(int(math.ceil((math.log10(delta) - self.LOG_MIN) * LATENCY_BUCKETS_PER_DECADE)), self.NBUCKETS - 1)
+        else:
+            idx = 0
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += delta
+        if delta > self.max:
+            self.max = delta
+
+    def percentile(self, q):
+        '''Latency (seconds) below which `q` percent of the samples are.'''
+        if self.count == 0:
+            return 0.
+        target = q / 100.0 * self.count
+        cumulative = 0
+        for idx, n in enumerate(self.counts):
+            cumulative += n
+            if n and cumulative >= target:
+                break
+        return min(LATENCY_MIN * 10 ** (idx / float(LATENCY_BUCKETS_PER_DECADE)), self.max)
+
+    def summary(self):
+        '''Sample count, mean, p50, p95, p99 and max latency (seconds) in a dict.'''
+        return dict(count=self.count, mean=self.total / self.count if self.count else 0.,
+                    p50=self.percentile(50), p95=self.percentile(95), p99=self.percentile(99), max=self.max)
+
+class TriggerLatency(object):
+    '''Trigger-to-display latency distributions.
+
+    A TTL event is stamped (with :func:`timeit.default_timer` times) when received
+    (``receive_time``, :class:`comm.CommProcess`), when the data of its region of interest became
+    complete (``roi_time``, :class:`colldata.Collector`), when its processing started and ended
+    (``process_time``, ``binned_time``, :meth:`eventproc.EventProcessor.next_trial`), and when the
+    histograms were redrawn (:meth:`rendered`). Stages in :attr:`histograms`:
+
+    * *roi_wait*: receive until the ROI data arrived (zero if the TTL arrived later than the data),
+    * *queueing*: ROI complete until the processing started (update loop period, other triggers),
+    * *binning*: spike detection and histogram binning,
+    * *render*: binned until the histograms were redrawn (display rate limit),
+    * *total*: receive until redrawn.
+
+    Attributes:
+        histograms (OrderedDict): stage name -> :class:`LatencyHistogram`
+    '''
+
+    def __init__(self):
+        self.histograms = OrderedDict((stage, LatencyHistogram()) for stage in TRIGGER_STAGES)
+        self.pending = deque(maxlen=TRIGGER_PENDING_MAX)
+
+    def binned(self, ttl):
+        '''Register a processed trigger to be displayed by the next redraw.'''
+        if getattr(ttl, 'receive_time', None) is not None:
+            self.pending.append(ttl)
+
+    def rendered(self):
+        '''Stamp the triggers binned since the last redraw as displayed.'''
+        now = default_timer()
+        histograms = self.histograms
+        while self.pending:
+            ttl = self.pending.popleft()
+            roi_time = max(getattr(ttl, 'roi_time', None) or ttl.receive_time, ttl.receive_time)
+            histograms['roi_wait'].add(roi_time - ttl.receive_time)
+            histograms['queueing'].add(max(ttl.process_time - roi_time, 0.))
+            histograms['binning'].add(ttl.binned_time - ttl.process_time)
+            histograms['render'].add(now - ttl.binned_time)
+            histograms['total'].add(now - ttl.receive_time)
+
+    def summary(self):
+        '''Latency statistics of each stage, see :meth:`LatencyHistogram.summary`.'''
+        return OrderedDict((stage, histogram.summary()) for stage, histogram in self.histograms.items())
+
+    def clear(self):
+        for histogram in self.histograms.values():
+            histogram.clear()
+        self.pending.clear()
+
 class TimeMeasClass(object):
     '''Performance monitoring/profiling class. (Just for development.)
 
     Maintains a dictionary of elapsed times and number of calls with separate identifier strings
     to make it possible to measure multiple overlapping time segments.
+
+    Latency distributions of each identifier (:class:`LatencyHistogram`) are collected as well
+    if enabled by :meth:`enable_histograms`, this can be switched at runtime.
     '''
 
     def __init__(self):
         self.timespent = defaultdict(int) #: Measurement array for elapsed time
         self.timestart = defaultdict(int) #: Last measurement's start time (initialized in :meth:`tic`)
         self.timecount = defaultdict(int) #: Number of measurements collected in :attr:`timespent` (for averaging)
+        self.histograms = defaultdict(LatencyHistogram)  #: Latency distribution of each id
+        self.histograms_enabled = False   #: Collect :attr:`histograms` in :meth:`toc`
+        self.flightrec = None             #: :class:`flightrec.FlightRecorder` receiving the measurements, if set
 
     def tic(self, idstr):
         '''Start timer.
@@ -33,17 +159,42 @@ class TimeMeasClass(object):
         delta = default_timer() - self.timestart[idstr]
         self.timespent[idstr] += delta
         self.timecount[idstr] += 1
+        if self.histograms_enabled:
+            self.histograms[idstr].add(delta)
+        if self.flightrec is not None:
+            self.flightrec.stage(idstr, delta)
         return delta
 
+    def enable_histograms(self, enabled=True):
+        '''Start (restarting the distributions) or stop collecting latency histograms.'''
+        if enabled and not self.histograms_enabled:
+            self.reset_histograms()
+        self.histograms_enabled = enabled
+
+    def reset_histograms(self):
+        for histogram in self.histograms.values():
+            histogram.clear()
+
+    def latency_summary(self):
+        '''Latency statistics of each id.
+
+        Returns:
+            dict of id -> :meth:`LatencyHistogram.summary` (empty if histograms were never enabled)
+        '''
+        return dict((idstr, histogram.summary()) for idstr, histogram in self.histograms.items())
+
     def dump(self, logger):
         '''Display all timer results.'''
         for i in sorted(self.timestart.keys()):
             logger.debug("%15s: %f / %d" % (str(i), self.timespent[i], self.timecount[i]))
 
+    def dump_latencies(self, logger):
+        '''Display the latency statistics (in ms) of all ids.'''
+        for idstr, stats in sorted(self.latency_summary().items()):
+            logger.info(format_latency(idstr, stats))
+
     def reset(self):
         '''Restart all timers.'''
         for i in sorted(self.timestart.keys()):
             self.timespent[i] = 0
             self.timecount[i] = 0
-
-
@@ -0,0 +1,83 @@
+'''Event-triggered average of the analog signal (ERP) with running variance.
+
+The ROI of each trial is decimated by block averaging first, then mean and variance of
+every channel and time point are updated with Welford's algorithm, so no per-trial data
+is stored and the cost of a trial is proportional to the decimated window length.
+'''
+
+from __future__ import division
+import logging
+import numpy as np
+
+ERP_SAMPLING_RATE = 1000    #: Target sampling rate of the averaged signal (Hz)
+
+class EventAverage(object):
+    '''Running mean and variance of the event aligned signal of all channels.
+
+    Attributes:
+        count (int): number of averaged trials
+        mean (2D np.ndarray): running mean, one row per channel, one column per decimated sample
+        m2 (2D np.ndarray): running sum of squared deviations from the mean
+        ts (1D np.ndarray): time of the decimated samples relative to the event (as passed to :meth:`add`)
+    '''
+
+    def __init__(self, decimation):
+        '''
+        Args:
+            decimation (int): number of samples averaged into one ERP sample
+        '''
+        self.decimation = max(1, int(decimation))
+        self.reset()
+
+    def reset(self):
+        '''Drop all trials.'''
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+        self.ts = None
+
+    def add(self, data, data_ts):
+        '''Add the ROI of a new trial.
+
+        Args:
+            data (2D np.ndarray): one row per channel, one column per sample
+            data_ts (1D np.ndarray): time of each sample relative to the event
+        '''
+        npoints = data.shape[1] // self.decimation
+        if npoints == 0:
+            return
+        if self.mean is not None and self.mean.shape != (data.shape[0], npoints):
+            # ROI lengths may differ by a sample, which may change the decimated length by one
+            if self.mean.shape[0] != data.shape[0] or abs(self.mean.shape[1] - npoints) > 1:
+                self.reset()
+            else:
+                npoints = min(npoints, self.mean.shape[1])
+                self.mean, self.m2 = self.mean[:, :npoints], self.m2[:, :npoints]
+
+        n = npoints * self.decimation
+        x = data[:, :n].reshape(data.shape[0], npoints, self.decimation).mean(axis=2)
+
+        if self.mean is None:
+            self.mean = np.zeros_like(x)
+            self.m2 = np.zeros_like(x)
+            self.ts = np.asarray(data_ts[:n]).reshape(npoints, self.decimation).mean(axis=1)
+        else:
+            self.ts = self.ts[:npoints]
+
+        # Welford update
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+
+    def variance(self):
+        '''Sample variance of each channel and time point (zeros below two trials).'''
+        if self.count < 2:
+            return np.zeros_like(self.mean)
+        return self.m2 / (self.count - 1)
+
+    def sem(self):
+        '''Standard error of the mean.'''
+        return np.sqrt(self.variance() / max(self.count, 1))
+
+logger = logging.getLogger("logger")
@@ -0,0 +1,149 @@
+import sys
+if sys.version_info.major >= 3:
+    from time import perf_counter as clock
+else:
+    from time import clock
+
+import logging
+import numpy as np
+
+from pyqtgraph.Qt import QtGui, QtCore
+import pyqtgraph as pg
+from pyqtgraph.parametertree import Parameter, ParameterTree
+
+from opeth.erp import EventAverage, ERP_SAMPLING_RATE
+from opeth.colldata import LFP_SAMPLING_RATE
+
+class ErpGui(object):
+    '''Event-triggered average (ERP) of the selected channels with a standard error band.
+
+    The average of all channels is updated on each displayed trigger by an :class:`erp.EventAverage`
+    from the decimated (LFP) data of the collector (see :meth:`colldata.Collector.lfp_data`),
+    so changing the channel selection does not restart averaging.
+    '''
+
+    MAX_PLOT_PER_SEC = 4    #: ERP refresh rate limit
+    PENWIDTH = 2            #: Plot draw width
+
+    def __init__(self, parse_channels, sampling_rate):
+        '''GUI initialization
+
+        Args:
+            parse_channels (callable): converts a channel list string like ``1-4`` to a list of
+                1-based channel numbers (see :meth:`gui.GuiClass.convert_strlist_to_ints`)
+            sampling_rate (int): sampling rate of the incoming data
+
+        Attributes:
+            average (erp.EventAverage): running average of the event aligned signal
+        '''
+        self.parse_channels = parse_channels
+        self.set_sampling_rate(sampling_rate)
+        self.curves = []
+        self.dirty = False
+
+        self.erpwin = QtGui.QWidget()
+        self.erpwin.setWindowTitle("Event-triggered average")
+        vbox = QtGui.QVBoxLayout(self.erpwin)
+
+        splitter_horiz = QtGui.QSplitter(QtCore.Qt.Horizontal)
+
+        self.plotwidget = pg.PlotWidget(title="Average signal around event")
+        self.plotwidget.setLabel('bottom', 'Time rel. to event', units='ms')
+        self.plotwidget.setLabel('left', 'Signal level', units='V')
+        splitter_horiz.addWidget(self.plotwidget)
+
+        # right side control panel
+        rightside = QtGui.QWidget()
+        l = QtGui.QVBoxLayout(rightside)
+        rightside.setLayout(l)
+        l.addWidget(QtGui.QLabel("Control Panel"))
+
+        self.erpparams = Parameter.create(name='erpparams', type='group')
+        self.par_channels = Parameter.create(name='Channels', type='str', value="1-4")
+        self.par_sem = Parameter.create(name='Show SEM band', type='bool', value=True)
+        self.erpparams.addChild(self.par_channels)
+        self.erpparams.addChild(self.par_sem)
+        self.erpparams.sigTreeStateChanged.connect(self.onParamChange)
+        t = ParameterTree()
+        t.setParameters(self.erpparams, showTop=False)
+        l.addWidget(t)
+
+        splitter_horiz.addWidget(rightside)
+        splitter_horiz.setSizes([30, 10])
+
+        vbox.addWidget(splitter_horiz)
+        self.erpwin.setLayout(vbox)
+        self.erpwin.show()
+        logger.info("ERP win created")
+
+        self.update_channels()
+        self.earliest_plot = clock()   #: timestamp until new plot is created to limit update frequency
+
+    def set_sampling_rate(self, sampling_rate):
+        '''Restart averaging with the decimation matching the LFP rate of the new sampling rate.'''
+        lfp_rate = sampling_rate // max(1, sampling_rate // LFP_SAMPLING_RATE)
+        self.average = EventAverage(lfp_rate // ERP_SAMPLING_RATE)
+        self.dirty = True
+
+    def onParamChange(self, param, changes):
+        self.update_channels()
+
+    def update_channels(self):
+        '''Recreate the curves for a new channel selection.'''
+        self.plotwidget.clear()
+
+        self.channels = [ch - 1 for ch in self.parse_channels(self.par_channels.value()) if ch > 0]
+        self.curves = []
+        for idx, ch in enumerate(self.channels):
+            color = pg.mkColor((idx, max(len(self.channels), 1) * 1.3))
+            mean = self.plotwidget.plot([0], [0], pen=pg.mkPen(color, width=self.PENWIDTH))
+            lower = pg.PlotDataItem([0], [0], pen=None)
+            upper = pg.PlotDataItem([0], [0], pen=None)
+            color.setAlpha(60)
+            band = pg.FillBetweenItem(lower, upper, brush=pg.mkBrush(color))
+            self.plotwidget.addItem(band)
+            self.curves.append((mean, lower, upper, band))
+        self.dirty = True
+        self.earliest_plot = clock()
+
+    def clear(self):
+        '''Restart averaging (e.g. when histograms are cleared).'''
+        self.average.reset()
+        self.dirty = True
+
+    def add_trial(self, data, data_ts):
+        '''Add the ROI of a new trial.
+
+        Args:
+            data (2D np.ndarray): event aligned LFP data, one row per channel (uV)
+            data_ts (1D np.ndarray): time of each sample relative to the event (s)
+        '''
+        self.average.add(data, data_ts)
+        self.dirty = True
+
+    def plot(self):
+        '''Redraw if new trials were added since last update.'''
+        if not self.dirty or self.earliest_plot > clock() or self.average.mean is None:
+            return
+
+        # convert to volts from uV, time to ms
+        ts = self.average.ts * 1000
+        mean = self.average.mean / 1000000.0
+        sem = self.average.sem() / 1000000.0 if self.par_sem.value() else np.zeros_like(mean)
+        for ch, (mean_curve, lower, upper, band) in zip(self.channels, self.curves):
+            if ch >= mean.shape[0]:
+                continue
+            mean_curve.setData(ts, mean[ch])
+            lower.setData(ts, mean[ch] - sem[ch])
+            upper.setData(ts, mean[ch] + sem[ch])
+            band.setVisible(self.par_sem.value())
+
+        self.plotwidget.setTitle("Average signal around event (%d trials)" % self.average.count)
+        self.dirty = False
+        self.earliest_plot = clock() + 1.0 / self.MAX_PLOT_PER_SEC
+
+    def close(self):
+        '''Called when main window is closed.'''
+        self.erpwin.close()
+
+logger = logging.getLogger("logger")
@@ -0,0 +1,167 @@
+'''Processing of the triggers (TTL events): spike detection in their region of interest and
+binning of the spikes into the PETHs of every event window, trigger channel and threshold profile.
+
+The same :class:`EventProcessor` is used by the GUI for the live data and by :mod:`replay`
+for recorded sessions, so offline results are produced by the same detection and binning code.
+'''
+
+from __future__ import division
+import logging
+import math
+from timeit import default_timer
+import numpy as np
+from collections import OrderedDict
+
+from .colldata import EVENT_ROI
+from .peth import PethSet, PETH_CUMULATIVE, PETH_WINDOW
+from .debug import TimeMeasClass
+
+HISTOGRAM_BINSIZE = 0.001   #: Histogram bin size in seconds
+TRIGGER_HOLDOFF = 0.001     #: Trigger holdoff in seconds
+MAIN_WINDOW = 'main'        #: Name of the event window set by the ROI before/after event parameters
+
+class EventProcessor(object):
+    '''Trigger processing on the data of a :class:`colldata.Collector`.
+
+    Attributes:
+        collector (colldata.Collector): data, TTL and OE spike storage
+        dataproc (colldata.DataProc): spike detection
+        event_windows (OrderedDict): event window name -> [start, end] offsets in seconds
+        peths (OrderedDict): event window name -> :class:`peth.PethSet` (created by :meth:`clear`)
+        last_trial (dict): ``(window name, profile index) -> (win_min, win_max, first_ts, spike_stamps, spike_chs)``
+            of the last processed trigger
+        trialcnt (int): number of processed triggers since :meth:`clear`
+        timeas (debug.TimeMeasClass): profiling of the processing steps
+    '''
+
+    def __init__(self, collector, dataproc, event_windows=None, timeas=None):
+        '''
+        Args:
+            collector (colldata.Collector): data source
+            dataproc (colldata.DataProc): spike detector working on `collector`
+            event_windows (OrderedDict): event windows, defaults to :data:`MAIN_WINDOW` with :data:`colldata.EVENT_ROI`
+            timeas (debug.TimeMeasClass): shared profiling object, a new one is created if None
+        '''
+        self.collector = collector
+        self.dataproc = dataproc
+        self.event_windows = event_windows if event_windows is not None else OrderedDict([(MAIN_WINDOW, list(EVENT_ROI))])
+        self.timeas = timeas if timeas is not None else TimeMeasClass()
+        self.peths = None
+        self.last_trial = {}
+        self.trialcnt = 0
+
+    def union_window(self):
+        '''Return the [start, end] range covering all event windows.'''
+        return [min(roi[0] for roi in self.event_windows.values()),
+                max(roi[1] for roi in self.event_windows.values())]
+
+    @staticmethod
+    def roi_bincount(roi):
+        '''Number of histogram bins of an event window.'''
+        return int(round( (roi[1] - roi[0]) / HISTOGRAM_BINSIZE)) + 1
+
+    def window_range(self, ttl, roi):
+        '''Timestamp limits of an event window around a TTL.'''
+        sampling_rate = self.collector.get_sampling_rate()
+        return (max(ttl.timestamp + roi[0] * sampling_rate, 0),
+                ttl.timestamp + roi[1] * sampling_rate)
+
+    def clear(self, nchannels, mode=PETH_CUMULATIVE, window=PETH_WINDOW):
+        '''Restart the histograms of all event windows (and trigger channels).
+
+        Args:
+            nchannels (int): number of channels
+            mode, window: PETH accumulation mode, see :class:`peth.PethAccumulator`
+
+        Returns:
+            the new :attr:`peths`
+        '''
+        self.peths = OrderedDict((name, PethSet(nchannels, self.roi_bincount(roi), mode, window))
+                                 for name, roi in self.event_windows.items())
+        self.last_trial = {}
+        self.trialcnt = 0
+        return self.peths
+
+    def add_spikes_to_histogram(self, peth, channels, offsets, disabled_channels=[]):
+        '''Add the spikes of a trial to a PETH.
+
+        Spikes on disabled channels or outside of the histogram range are ignored.
+
+        Arguments:
+            peth (peth.PethAccumulator): histogram to be updated
+            channels (1D np.ndarray of ints): channel of each spike
+            offsets (1D np.ndarray): spike times in seconds relative to the start of the event ROI
+            disabled_channels (list): channels to be ignored
+        '''
+        binpos = np.round(np.asarray(offsets) / HISTOGRAM_BINSIZE).astype(int)
+        channels = np.asarray(channels, dtype=int)
+        nrows, ncols = peth.bins.shape
+        valid = (channels >= 0) & (channels < nrows) & (binpos >= 0) & (binpos < ncols)
+        channels, binpos = channels[valid], binpos[valid]
+
+        enabled = np.ones(nrows, dtype=bool)
+        enabled[disabled_channels] = False
+        valid = enabled[channels]
+        peth.add_trial(channels[valid], binpos[valid])
+
+    def next_trial(self, thresholds=None, disabled_channels=[], ttl_ch=None, unit=0, rising_edge=False,
+                   holdoff=TRIGGER_HOLDOFF):
+        '''Process the first TTL whose region of interest (the union of all event windows) is present.
+
+        Spikes are detected over the union of the event windows once for all threshold profiles,
+        results are shared between triggers with overlapping windows (see :meth:`colldata.DataProc.detect_range`).
+
+        Args:
+            thresholds (3D np.ndarray): signed threshold levels (uV), one ``(channels, 1)`` array per threshold
+                profile, None to use the spikes detected by Open Ephys
+            disabled_channels (list): channels excluded from detection and from the histograms
+            ttl_ch (int): trigger channel to be processed, None for all channels
+            unit (int): sorted unit of OE spikes (0: all), used only if `thresholds` is None
+            rising_edge (bool): positive threshold crossings if True
+            holdoff (float): trigger holdoff in seconds
+
+        Returns:
+            the processed TTL event or None if no TTL is ready; spikes of the trigger are in :attr:`last_trial`
+        '''
+        union_roi = self.union_window()
+        self.timeas.tic("05-process_ttl")
+        roi = self.collector.next_ttl(ttl_ch=ttl_ch, start_offset=union_roi[0], end_offset=union_roi[1],
+                                      trigger_holdoff=holdoff)
+        self.timeas.toc("05-process_ttl")
+        if roi is None:
+            return None
+
+        ttl, tsrange_min, tsrange_max = roi
+        ttl.process_time = default_timer()     # latency stamps, see debug.TriggerLatency
+
+        if thresholds is None:
+            # Spikes were already detected by OE, no thresholding necessary
+            spikestore, profiles = self.collector.spikestore, [None]
+        else:
+            self.timeas.tic("06-spikedetect")
+            self.dataproc.detect_range(tsrange_min, tsrange_max, threshold=thresholds,
+                                       rising_edge=rising_edge, disabled=disabled_channels)
+            self.timeas.toc("06-spikedetect")
+            spikestore, unit, profiles = self.dataproc.spikes, None, range(len(thresholds))
+
+        # Calculate spike times in seconds from spike offsets
+        # and increment the proper histogram bins based on that value.
+        self.timeas.tic("06-spikehist")
+        sampling_rate = float(self.collector.get_sampling_rate())
+        for name, window in self.event_windows.items():
+            win_min, win_max = self.window_range(ttl, window)
+            first_ts = int(math.ceil(win_min))
+            for profile in profiles:
+                spike_stamps, spike_chs = spikestore.query(win_min, win_max, unit=unit, profile=profile)
+                spike_offsets = (spike_stamps - first_ts) / sampling_rate
+                profile_idx = profile or 0
+                self.add_spikes_to_histogram(self.peths[name][(ttl.event_channel, profile_idx)],
+                                             spike_chs, spike_offsets, disabled_channels)
+                self.last_trial[(name, profile_idx)] = (win_min, win_max, first_ts, spike_stamps, spike_chs)
+        self.timeas.toc("06-spikehist")
+        ttl.binned_time = default_timer()
+
+        self.trialcnt += 1
+        return ttl
+
+logger = logging.getLogger("logger")
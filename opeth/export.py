@@ -0,0 +1,229 @@
+'''Incremental export of the results of a session: trigger timestamps, per-trial spike counts
+and periodic PETH snapshots, appended to flat binary files while the session runs.
+
+Records are queued by the GUI and written by a background thread, which flushes the files
+every :data:`EXPORT_FLUSH_PERIOD` seconds, so a crash loses at most the last few seconds.
+Files of an export named ``base``:
+
+* ``base_trials.dat``: :data:`TRIAL_DTYPE` record of each processed trigger,
+* ``base_counts.dat``: spike count of each channel in each event window and threshold profile
+  of each trigger (:func:`counts_dtype` records),
+* ``base_peth_<window>_<bins>.dat``: PETH snapshots of an event window (:func:`peth_dtype` records),
+* ``base.json``: channel count, sampling rate, event windows (the ``window`` fields index
+  ``window_names``) and threshold profiles.
+
+All files are fixed size records, :func:`load_results` maps them into memory.
+'''
+
+from __future__ import division
+import sys
+if sys.version_info.major >= 3:
+    import queue
+    from time import perf_counter as clock
+else:
+    import Queue as queue
+    from time import clock
+
+import os
+import re
+import json
+import threading
+import logging
+import numpy as np
+
+EXPORT_QUEUE_SIZE = 10000       #: Number of records waiting for the writer thread before dropping new ones
+EXPORT_FLUSH_PERIOD = 2.0       #: File flush period of the writer thread in seconds
+
+TRIAL_DTYPE = np.dtype([('trial', '<i4'), ('ttl_channel', '<i4'), ('timestamp', '<i8')])  #: Trigger record
+
+def counts_dtype(nchannels):
+    '''Per-trial spike count record of a given channel count.'''
+    return np.dtype([('trial', '<i4'), ('window', '<i2'), ('profile', '<i2'), ('counts', '<u2', (nchannels,))])
+
+def peth_dtype(nchannels, nbins):
+    '''PETH snapshot record: capture time (seconds since export start), trial count (weight), trigger channel,
+    threshold profile and the histogram bins (see :class:`peth.PethAccumulator`).'''
+    return np.dtype([('time', '<f8'), ('trials', '<f4'), ('ttl_channel', '<i2'), ('profile', '<i2'),
+                     ('bins', '<f4', (nchannels, nbins))])
+
+class ResultsExporter(object):
+    '''Appends results to binary files on a writer thread.
+
+    Attributes:
+        basename (str): path prefix of the export files
+        trials (int): number of triggers exported
+        dropped (int): number of records dropped because the queue was full
+    '''
+
+    def __init__(self, basename, nchannels, sampling_rate, event_windows, profiles=(1.0,),
+                 queue_size=EXPORT_QUEUE_SIZE):
+        '''
+        Args:
+            basename (str): path prefix of the export files
+            nchannels (int): number of channels
+            sampling_rate (int): sampling rate (timestamp units per second)
+            event_windows (OrderedDict): event window name -> [start, end] in seconds
+            profiles (sequence): threshold multipliers
+            queue_size (int): number of records buffered for the writer thread
+        '''
+        self.basename = basename
+        self.nchannels = nchannels
+        self.counts_dtype = counts_dtype(nchannels)
+        self.header = dict(channels=int(nchannels), sampling_rate=int(sampling_rate), window_names=[], windows=[],
+                           profiles=[float(p) for p in profiles])
+        self.update_windows(event_windows)
+        self.start = clock()
+        self.trials = 0
+        self.dropped = 0
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.writer, name="ResultsExporter")
+        self.thread.daemon = True
+        self.thread.start()
+        self.put(('.json', self.header_json()))
+        logger.info("Exporting results to %s*" % basename)
+
+    def header_json(self):
+        return json.dumps(self.header, indent=1).encode('utf-8')
+
+    def update_windows(self, event_windows, profiles=None):
+        '''Register new event windows (names are never removed, so earlier records stay valid)
+        and threshold profiles.'''
+        changed = False
+        for name, roi in event_windows.items():
+            if name not in self.header['window_names']:
+                self.header['window_names'].append(name)
+                self.header['windows'].append([float(t) for t in roi])
+                changed = True
+            else:
+                idx = self.header['window_names'].index(name)
+                if self.header['windows'][idx] != [float(t) for t in roi]:
+                    self.header['windows'][idx] = [float(t) for t in roi]
+                    changed = True
+        if profiles is not None and [float(p) for p in profiles] != self.header['profiles']:
+            self.header['profiles'] = [float(p) for p in profiles]
+            changed = True
+        if changed and hasattr(self, 'queue'):
+            self.put(('.json', self.header_json()))
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def add_trial(self, ttl, last_trial):
+        '''Export a processed trigger.
+
+        Args:
+            ttl (OpenEphysEvent): the trigger
+            last_trial (dict): spikes of the trigger, see :attr:`eventproc.EventProcessor.last_trial`
+        '''
+        trial = np.zeros(1, dtype=TRIAL_DTYPE)
+        trial['trial'] = self.trials
+        trial['ttl_channel'] = ttl.event_channel
+        trial['timestamp'] = ttl.timestamp
+        self.put(('_trials.dat', trial))
+
+        counts = np.zeros(len(last_trial), dtype=self.counts_dtype)
+        for row, ((name, profile), spikes) in zip(counts, sorted(last_trial.items())):
+            chs = spikes[4]
+            row['trial'] = self.trials
+            row['window'] = self.header['window_names'].index(name)
+            row['profile'] = profile
+            row['counts'] = np.bincount(chs[(chs >= 0) & (chs < self.nchannels)], minlength=self.nchannels)
+        self.put(('_counts.dat', counts))
+        self.trials += 1
+
+    def add_snapshot(self, peths):
+        '''Export a copy of all PETHs (of the exported channel count).
+
+        Args:
+            peths (OrderedDict): event window name -> :class:`peth.PethSet`
+        '''
+        now = clock() - self.start
+        for name, pethset in peths.items():
+            keys = pethset.keys()
+            if not keys or pethset.nchannels != self.nchannels or name not in self.header['window_names']:
+                continue
+            nbins = pethset[keys[0]].bins.shape[1]
+            records = np.zeros(len(keys), dtype=peth_dtype(self.nchannels, nbins))
+            for record, (ttl_ch, profile) in zip(records, keys):
+                peth = pethset[(ttl_ch, profile)]
+                record['time'] = now
+                record['trials'] = peth.trials
+                record['ttl_channel'] = ttl_ch
+                record['profile'] = profile
+                record['bins'] = peth.bins
+            self.put(('_peth_%s_%d.dat' % (re.sub(r'[^\w.-]+', '_', name), nbins), records))
+
+    def writer(self):
+        '''Writer thread: appends queued records, flushes periodically, stops at the None sentinel.'''
+        files = {}
+        next_flush = clock() + EXPORT_FLUSH_PERIOD
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.01, next_flush - clock()))
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            try:
+                if item:
+                    suffix, data = item
+                    if suffix == '.json':
+                        # header is small, replaced atomically
+                        tmpname = self.basename + '.json.tmp'
+                        with open(tmpname, 'wb') as f:
+                            f.write(data)
+                        if os.path.exists(self.basename + '.json') and sys.platform.startswith('win'):
+                            os.remove(self.basename + '.json')
+                        os.rename(tmpname, self.basename + '.json')
+                    else:
+                        if suffix not in files:
+                            files[suffix] = open(self.basename + suffix, 'ab')
+                        data.tofile(files[suffix])
+                if clock() >= next_flush:
+                    for f in files.values():
+                        f.flush()
+                    next_flush = clock() + EXPORT_FLUSH_PERIOD
+            except (IOError, OSError) as e:
+                logger.error("Export to %s failed: %s" % (self.basename, str(e)))
+        for f in files.values():
+            f.close()
+
+    def close(self):
+        '''Write the queued records, stop the writer thread and close the files.'''
+        self.queue.put(None)
+        self.thread.join()
+        logger.info("Export %s closed: %d triggers, %d dropped records" % (self.basename, self.trials, self.dropped))
+
+def load_results(basename):
+    '''Map an export into memory.
+
+    Returns:
+        header (dict), trials (:data:`TRIAL_DTYPE` array), counts (:func:`counts_dtype` array) and
+        a dict of PETH snapshot arrays keyed by ``(window name, nbins)``
+    '''
+    with open(basename + '.json') as f:
+        header = json.load(f)
+
+    def mapped(fname, dtype):
+        if not os.path.exists(fname):
+            return np.zeros(0, dtype=dtype)
+        n = os.path.getsize(fname) // dtype.itemsize   # a partially written last record is ignored
+        return np.memmap(fname, dtype=dtype, mode='r', shape=(n,)) if n else np.zeros(0, dtype=dtype)
+
+    trials = mapped(basename + '_trials.dat', TRIAL_DTYPE)
+    counts = mapped(basename + '_counts.dat', counts_dtype(header['channels']))
+    peths = {}
+    prefix = os.path.basename(basename) + '_peth_'
+    for fname in sorted(os.listdir(os.path.dirname(os.path.abspath(basename)))):
+        match = re.match(re.escape(prefix) + r'(.*)_(\d+)\.dat$', fname)
+        if match:
+            name, nbins = match.group(1), int(match.group(2))
+            peths[(name, nbins)] = mapped(os.path.join(os.path.dirname(os.path.abspath(basename)), fname),
+                                          peth_dtype(header['channels'], nbins))
+    return header, trials, counts, peths
+
+logger = logging.getLogger("logger")
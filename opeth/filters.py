@@ -0,0 +1,316 @@
+'''Streaming filters working on consecutive chunks of multichannel data.
+
+Filter state is carried between chunks, so the output of a stream processed in arbitrary
+chunks equals the output of the whole stream processed at once.
+
+* :class:`Decimator`: anti-alias low-pass FIR filtering and decimation (e.g. for LFP)
+
+* :class:`SosFilter`: IIR filtering (second-order sections, e.g. Butterworth band-pass)
+
+* :class:`Rereference`: common average / median reference by channel group
+
+The latter two work in place on float32 data (e.g. directly in the buffers of
+:class:`colldata.Collector`), run ``python -m opeth.filters`` for a throughput benchmark
+and a check of the filter output on a DC offset.
+'''
+
+from __future__ import division, print_function
+import sys
+if sys.version_info.major >= 3:
+    from time import perf_counter as clock
+else:
+    from time import clock
+
+import logging
+import numpy as np
+
+DECIMATOR_TAPS_PER_FACTOR = 8   #: FIR length of :class:`Decimator` per decimation factor
+DECIMATOR_CUTOFF = 0.8          #: Low-pass cutoff relative to the Nyquist frequency of the decimated signal
+SOS_BLOCK = 32                  #: Number of samples processed by a single matrix product in :class:`SosFilter`
+
+REREF_CAR, REREF_CMR = 'CAR', 'CMR'
+
+def lowpass_fir(numtaps, cutoff):
+    '''Windowed-sinc (Hamming) low-pass FIR filter with unity DC gain.
+
+    Args:
+        numtaps (int): filter length
+        cutoff (float): cutoff frequency relative to the Nyquist frequency (0..1)
+
+    Returns:
+        1D np.ndarray of filter coefficients
+    '''
+    n = np.arange(numtaps) - (numtaps - 1) / 2
+    h = cutoff * np.sinc(cutoff * n) * np.hamming(numtaps)
+    return h / h.sum()
+
+class Decimator(object):
+    '''Stateful low-pass filtering and decimation of multichannel data.
+
+    Only every `factor`-th filter output is calculated: each output is the dot product of the
+    FIR coefficients with a window of the input, windows are strided views of the last
+    ``numtaps - 1`` input samples of the previous chunk concatenated with the new chunk.
+
+    Attributes:
+        factor (int): decimation factor
+        delay (int): group delay of the filter in input samples, subtracted from output timestamps
+    '''
+
+    def __init__(self, factor, numtaps=None):
+        '''
+        Args:
+            factor (int): decimation factor (e.g. 30 for 30 kHz -> 1 kHz)
+            numtaps (int): FIR length, defaults to :data:`DECIMATOR_TAPS_PER_FACTOR` times `factor` (odd)
+        '''
+        self.factor = max(1, int(factor))
+        if numtaps is None:
+            numtaps = DECIMATOR_TAPS_PER_FACTOR * self.factor + 1
+        self.taps = lowpass_fir(numtaps, DECIMATOR_CUTOFF / self.factor)[::-1].copy()
+        self.delay = (numtaps - 1) // 2
+        self.reset()
+
+    def reset(self):
+        '''Forget the filter state (e.g. after a timestamp jump).'''
+        self.history = None
+        self.phase = 0  # position of the next output sample in the next chunk
+
+    def process(self, data, first_ts):
+        '''Filter and decimate a new chunk of data.
+
+        Args:
+            data (2D np.ndarray): one row per channel, one column per sample
+            first_ts (int): timestamp of the first sample of `data`
+
+        Returns:
+            decimated data (2D np.ndarray, float32) and the timestamps of its samples (1D np.ndarray, int64),
+            timestamps are corrected for the filter delay.
+        '''
+        numtaps = len(self.taps)
+        if self.history is None or self.history.shape[0] != data.shape[0]:
+            # start without a transient: as if the first sample had been present forever
+            self.history = np.repeat(data[:, :1].astype(np.float32), numtaps - 1, axis=1)
+            self.phase = 0
+
+        x = np.concatenate((self.history, data.astype(np.float32)), axis=1)
+        n = data.shape[1]
+        count = max(0, (n - self.phase + self.factor - 1) // self.factor)
+
+        # windows of the input ending at each output position: x[:, j:j + numtaps] for j = phase, phase+factor, ...
+        start = x[:, self.phase:]
+        windows = np.lib.stride_tricks.as_strided(start, shape=(x.shape[0], count, numtaps),
+                                                  strides=(start.strides[0], start.strides[1] * self.factor, start.strides[1]))
+        out = np.dot(windows, self.taps).astype(np.float32)
+        out_ts = first_ts + self.phase + self.factor * np.arange(count, dtype='int64') - self.delay
+
+        self.history = x[:, x.shape[1] - (numtaps - 1):].copy()
+        self.phase = self.phase + count * self.factor - n
+        return out, out_ts
+
+def butter_sos(order, cutoff, fs, btype='lowpass'):
+    '''Butterworth low- or high-pass filter as second-order sections (bilinear transform).
+
+    Args:
+        order (int): filter order, must be even
+        cutoff (float): -3 dB frequency in Hz
+        fs (float): sampling rate in Hz
+        btype (str): 'lowpass' or 'highpass'
+
+    Returns:
+        2D np.ndarray, one ``[b0, b1, b2, 1, a1, a2]`` row per section
+    '''
+    assert order % 2 == 0, "only even filter orders are supported"
+    w0 = 2 * np.pi * cutoff / fs
+    cosw, sinw = np.cos(w0), np.sin(w0)
+    sos = []
+    for k in range(1, order // 2 + 1):
+        # quality factor of the k-th Butterworth pole pair
+        q = 1.0 / (2 * np.sin((2 * k - 1) * np.pi / (2 * order)))
+        alpha = sinw / (2 * q)
+        if btype == 'lowpass':
+            b = [(1 - cosw) / 2, 1 - cosw, (1 - cosw) / 2]
+        else:
+            b = [(1 + cosw) / 2, -(1 + cosw), (1 + cosw) / 2]
+        a = [1 + alpha, -2 * cosw, 1 - alpha]
+        sos.append([b[0] / a[0], b[1] / a[0], b[2] / a[0], 1.0, a[1] / a[0], a[2] / a[0]])
+    return np.array(sos)
+
+def bandpass_sos(low, high, fs, order=2):
+    '''Butterworth band-pass as a cascade of a high-pass and a low-pass filter.
+
+    Args:
+        low, high (float): pass band limits in Hz
+        fs (float): sampling rate in Hz
+        order (int): order of each edge (even)
+    '''
+    return np.vstack((butter_sos(order, low, fs, 'highpass'), butter_sos(order, high, fs, 'lowpass')))
+
+class SosFilter(object):
+    '''Streaming IIR filter of second-order sections working in place on multichannel float32 data.
+
+    The cascade is converted to a single state-space system (two states per section), and
+    :data:`SOS_BLOCK` samples are processed at once with matrix products: outputs of a block
+    are the block input multiplied by the (lower triangular) impulse response matrix plus the
+    contribution of the state, so the per-sample recursion runs in BLAS instead of Python.
+    The state is carried between chunks.
+
+    Matrices and state are float64: in float32 the rounding of the matrices loses the exact zero of
+    a band-pass at DC and the output drifts on a DC offset. Blocks of the float32 data are converted
+    in a preallocated work buffer and the result is cast back when written in place.
+    '''
+
+    def __init__(self, sos, block=SOS_BLOCK):
+        '''
+        Args:
+            sos (2D array): second-order sections as returned by :func:`butter_sos` or :func:`bandpass_sos`
+            block (int): samples per matrix product
+        '''
+        A, B, C, D = self.state_space(np.asarray(sos, dtype='float64'))
+        self.block = block
+        nstate = A.shape[0]
+
+        # powers of A: CA[i] = C A^i, AB[i] = A^i B
+        CA = np.zeros((block + 1, nstate))
+        AB = np.zeros((block + 1, nstate))
+        Ai = np.eye(nstate)
+        for i in range(block + 1):
+            CA[i] = C.dot(Ai)
+            AB[i] = Ai.dot(B)
+            if i < block:
+                Ai = A.dot(Ai)
+        # matrices and state are kept in float64: rounding them to float32 loses the exact zero
+        # of a band-pass at DC, and a DC offset then makes the output drift
+        self.Apow = [np.linalg.matrix_power(A, r).T for r in range(block + 1)]
+
+        # impulse response h[0] = D, h[k] = C A^(k-1) B
+        h = np.concatenate(([D], CA[:block - 1].dot(B)))
+        T = np.zeros((block, block))
+        for i in range(block):
+            T[i, :i + 1] = h[i::-1]
+        self.TT = T.T                   # input -> output
+        self.OT = CA[:block].T          # state -> output
+        self.ABr = AB[:block][::-1]     # input -> new state (last `r` rows for a block of r)
+        self.state = None
+
+    @staticmethod
+    def state_space(sos):
+        '''Series connection of the transposed direct form II sections as one state-space system.
+
+        Returns:
+            A, B, C, D matrices of ``s' = A s + B x``, ``y = C s + D x``
+        '''
+        A, B, C, D = np.zeros((0, 0)), np.zeros(0), np.zeros(0), 1.0
+        for b0, b1, b2, a0, a1, a2 in sos:
+            a = np.array([[-a1, 1.0], [-a2, 0.0]])
+            b = np.array([b1 - a1 * b0, b2 - a2 * b0])
+            c = np.array([1.0, 0.0])
+            d = b0
+            n = A.shape[0]
+            A = np.block([[A, np.zeros((n, 2))], [np.outer(b, C), a]]) if n else a
+            B = np.concatenate((B, b * D))
+            C = np.concatenate((d * C, c))
+            D = d * D
+        return A, B, C, D
+
+    def reset(self):
+        '''Forget the filter state.'''
+        self.state = None
+
+    def process(self, data):
+        '''Filter a new chunk of data in place.
+
+        Args:
+            data (2D np.ndarray, float32): one row per channel, one column per sample (may be a view)
+        '''
+        if self.state is None or self.state.shape[0] != data.shape[0]:
+            self.state = np.zeros((data.shape[0], self.OT.shape[0]))
+            self.work = np.empty((data.shape[0], self.block))
+            self.out = np.empty((data.shape[0], self.block))
+
+        for start in range(0, data.shape[1], self.block):
+            r = min(self.block, data.shape[1] - start)
+            x = self.work[:, :r]
+            x[...] = data[:, start:start + r]
+            if r == self.block:
+                out = np.dot(x, self.TT, out=self.out)
+            else:
+                out = np.dot(x, self.TT[:r, :r])
+            out += np.dot(self.state, self.OT[:, :r])
+            self.state = np.dot(self.state, self.Apow[r]) + np.dot(x, self.ABr[self.block - r:])
+            data[:, start:start + r] = out
+
+class Rereference(object):
+    '''Common average (CAR) or common median (CMR) reference by channel group, in place.'''
+
+    def __init__(self, mode=REREF_CAR, group_size=0):
+        '''
+        Args:
+            mode (str): :data:`REREF_CAR` or :data:`REREF_CMR`
+            group_size (int): number of consecutive channels sharing a reference, 0 for all channels
+        '''
+        self.mode = mode
+        self.group_size = group_size
+
+    def process(self, data):
+        '''Subtract the group reference from each channel of a chunk of data (in place).'''
+        group_size = self.group_size or data.shape[0]
+        for first in range(0, data.shape[0], group_size):
+            group = data[first:first + group_size]
+            if self.mode == REREF_CMR:
+                group -= np.median(group, axis=0)
+            else:
+                group -= group.mean(axis=0)
+
+def benchmark(nchannels=64, sampling_rate=30000, seconds=10, chunk=640):
+    '''Measure throughput of the band-pass + CAR stage on random data in chunks as sent by OE.
+
+    Returns:
+        speed relative to real time (e.g. 20 means 20x faster than the incoming data rate)
+    '''
+    data = np.random.randn(nchannels, sampling_rate * seconds).astype(np.float32)
+    stages = [SosFilter(bandpass_sos(300, 6000, sampling_rate)), Rereference(REREF_CAR)]
+    start = clock()
+    for pos in range(0, data.shape[1], chunk):
+        for stage in stages:
+            stage.process(data[:, pos:pos + chunk])
+    elapsed = clock() - start
+    speed = seconds / elapsed
+    print("%d channels @ %d Hz, %d s in %.3f s: %.1fx real time (%.1f%% CPU)" %
+          (nchannels, sampling_rate, seconds, elapsed, speed, 100.0 / speed))
+    return speed
+
+def sosfilt(sos, data):
+    '''Reference per-sample implementation of :class:`SosFilter` (slow, for checking).'''
+    y = np.array(data, dtype=np.float64)
+    for b0, b1, b2, a0, a1, a2 in sos:
+        z1, z2 = np.zeros(y.shape[0]), np.zeros(y.shape[0])
+        for i in range(y.shape[1]):
+            x = y[:, i].copy()
+            y[:, i] = b0 * x + z1
+            z1 = b1 * x - a1 * y[:, i] + z2
+            z2 = b2 * x - a2 * y[:, i]
+    return y
+
+def dc_offset_check(low=1, high=300, offset=1000., sampling_rate=30000, seconds=2, chunk=640):
+    '''Compare :class:`SosFilter` with :func:`sosfilt` on a constant DC offset (the output should
+    decay to 0 with a band-pass of low cutoff, e.g. for LFP).
+
+    Returns:
+        maximal absolute error (in the unit of `offset`)
+    '''
+    sos = bandpass_sos(low, high, sampling_rate)
+    data = np.full((4, sampling_rate * seconds), offset, dtype=np.float32)
+    reference = sosfilt(sos, data)
+    sosfilter = SosFilter(sos)
+    for pos in range(0, data.shape[1], chunk):
+        sosfilter.process(data[:, pos:pos + chunk])
+    error = np.abs(data - reference).max()
+    print("%g-%g Hz band-pass, %g DC offset: max error %.3g, last output %.3g (reference %.3g)" %
+          (low, high, offset, error, np.abs(data[:, -1]).max(), np.abs(reference[:, -1]).max()))
+    return error
+
+logger = logging.getLogger("logger")
+
+if __name__ == '__main__':
+    benchmark()
+    dc_offset_check(1, 300)
+    dc_offset_check(10, 300)
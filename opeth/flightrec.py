@@ -0,0 +1,173 @@
+'''Flight recorder: an always-on, fixed size ring of compact records of recent pipeline events,
+dumped to disk for post-mortem analysis of stutters and crashes.
+
+Records are kept in preallocated numpy columns (time, kind, code, value, extra), adding one is a
+few scalar stores, so recording costs a few microseconds per display update. Recorded kinds:
+
+* :data:`KIND_STAGE`: duration of a profiled stage of the display update (:class:`debug.TimeMeasClass`),
+* :data:`KIND_MESSAGE`: message received from Open Ephys (message number, size), :data:`KIND_MESSAGE_GAP`
+  for missing message numbers,
+* :data:`KIND_TTL_ACCEPTED` / :data:`KIND_TTL_DROPPED`: TTLs released for processing or dropped
+  (:meth:`colldata.Collector.next_ttl`, channel in `code`, timestamp in `value`, drop reason in `extra`),
+* :data:`KIND_COMPACTION`: data buffer moved to the start of its allocation (:class:`circbuff.CircularBuffer`),
+* :data:`KIND_OVERLOAD`: the display update time crossed the overload limit (value 1: entered, 0: left).
+
+The ring is dumped to an ``.npz`` file (:meth:`FlightRecorder.dump`) on demand, on unhandled
+exceptions of the display update and when it takes too long (see :mod:`gui`). Dumps can be listed with::
+
+    python -m opeth.flightrec opeth_flightrec_20200101_120000.npz
+'''
+
+from __future__ import division, print_function
+import os
+import json
+import argparse
+import threading
+import logging
+from timeit import default_timer
+import numpy as np
+
+FLIGHTREC_SIZE = 65536      #: Number of records kept
+
+KIND_STAGE, KIND_MESSAGE, KIND_MESSAGE_GAP, KIND_TTL_ACCEPTED, KIND_TTL_DROPPED, KIND_COMPACTION, KIND_OVERLOAD = range(1, 8)
+KIND_NAMES = {KIND_STAGE: 'stage', KIND_MESSAGE: 'message', KIND_MESSAGE_GAP: 'message_gap',
+              KIND_TTL_ACCEPTED: 'ttl_accepted', KIND_TTL_DROPPED: 'ttl_dropped',
+              KIND_COMPACTION: 'compaction', KIND_OVERLOAD: 'overload'}
+
+TTL_DROP_CHANNEL, TTL_DROP_FUTURE, TTL_DROP_HOLDOFF, TTL_DROP_LOST = range(4)  #: TTL drop reasons
+TTL_DROP_NAMES = ['other channel', 'far in the future', 'holdoff', 'data lost']
+
+RECORD_DTYPE = np.dtype([('time', '<f8'), ('kind', 'u1'), ('code', '<u2'), ('value', '<i8'), ('extra', '<f4')])  #: Dumped records
+
+class FlightRecorder(object):
+    '''Ring of the most recent pipeline event records.
+
+    Attributes:
+        count (int): number of records added since start (older ones are overwritten)
+        stages (dict): stage name -> code of :data:`KIND_STAGE` records
+    '''
+
+    def __init__(self, size=FLIGHTREC_SIZE):
+        self.size = size
+        self.time = np.zeros(size, dtype=np.float64)
+        self.kind = np.zeros(size, dtype=np.uint8)
+        self.code = np.zeros(size, dtype=np.uint16)
+        self.value = np.zeros(size, dtype=np.int64)
+        self.extra = np.zeros(size, dtype=np.float32)
+        self.pos = 0
+        self.count = 0
+        self.stages = {}
+        self.start = default_timer()
+        self.dump_thread = None
+
+    def add(self, kind, code=0, value=0, extra=0.):
+        '''Add a record.
+
+        Args:
+            kind (int): one of the ``KIND_*`` constants
+            code (int): kind specific small integer (stage, channel, buffer, reason)
+            value (int): kind specific integer (message number, timestamp, counter)
+            extra (float): kind specific value (duration, size)
+        '''
+        i = self.pos
+        self.time[i] = default_timer() - self.start
+        self.kind[i] = kind
+        self.code[i] = code
+        self.value[i] = value
+        self.extra[i] = extra
+        self.pos = i + 1 if i + 1 < self.size else 0
+        self.count += 1
+
+    def stage(self, name, duration):
+        '''Add the duration (seconds) of a named processing stage.'''
+        code = self.stages.get(name)
+        if code is None:
+            code = self.stages[name] = len(self.stages)
+        self.add(KIND_STAGE, code, 0, duration)
+
+    def records(self):
+        '''Copy of the stored records in chronological order (:data:`RECORD_DTYPE` array).'''
+        n = min(self.count, self.size)
+        order = np.arange(self.pos - n, self.pos) % self.size
+        records = np.zeros(n, dtype=RECORD_DTYPE)
+        for field in RECORD_DTYPE.names:
+            records[field] = getattr(self, field)[order]
+        return records
+
+    def dump(self, fname, reason='', wait=False):
+        '''Write the records to a file (on a background thread unless `wait` is set).
+
+        Args:
+            fname (str): ``.npz`` file name
+            reason (str): stored in the dump header
+            wait (bool): write on the calling thread, e.g. from an exception hook
+        '''
+        header = dict(reason=reason, stages=self.stages, count=self.count, time=default_timer() - self.start)
+        arrays = dict(records=self.records(),
+                      header=np.frombuffer(json.dumps(header).encode('utf-8'), dtype=np.uint8))
+        if wait:
+            self.write(fname, arrays)
+        elif self.dump_thread is None or not self.dump_thread.is_alive():
+            self.dump_thread = threading.Thread(target=self.write, args=(fname, arrays), name="FlightRecorder")
+            self.dump_thread.daemon = True
+            self.dump_thread.start()
+
+    def write(self, fname, arrays):
+        try:
+            with open(fname, 'wb') as f:
+                np.savez(f, **arrays)
+            logger.info("Flight recorder dumped to %s (%s)" % (fname, json.loads(arrays['header'].tobytes().decode('utf-8'))['reason']))
+        except (IOError, OSError) as e:
+            logger.error("Unable to write flight recorder dump %s: %s" % (fname, str(e)))
+
+def load_dump(fname):
+    '''Load a dump.
+
+    Returns:
+        header (dict with ``reason``, ``stages``...) and the records (:data:`RECORD_DTYPE` array)
+    '''
+    with np.load(fname, allow_pickle=False) as npz:
+        return json.loads(npz['header'].tobytes().decode('utf-8')), npz['records']
+
+def describe(record, stage_names):
+    '''Text description of a record.'''
+    kind, code, value, extra = int(record['kind']), int(record['code']), int(record['value']), float(record['extra'])
+    if kind == KIND_STAGE:
+        return "stage %s %.3f ms" % (stage_names.get(code, code), extra * 1000)
+    elif kind == KIND_MESSAGE:
+        return "message #%d %d bytes" % (value, extra)
+    elif kind == KIND_MESSAGE_GAP:
+        return "message gap before #%d: %d missing" % (value, extra)
+    elif kind in (KIND_TTL_ACCEPTED, KIND_TTL_DROPPED):
+        text = "TTL ch%d ts %d %s" % (code + 1, value, KIND_NAMES[kind].split('_')[1])
+        if kind == KIND_TTL_DROPPED:
+            text += " (%s)" % TTL_DROP_NAMES[int(extra)]
+        return text
+    elif kind == KIND_COMPACTION:
+        return "buffer %d compaction #%d" % (code, value)
+    elif kind == KIND_OVERLOAD:
+        return "overload %s, frame %.1f ms" % ('start' if value else 'end', extra * 1000)
+    return "kind %d code %d value %d extra %g" % (kind, code, value, extra)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List the records of a flight recorder dump.")
+    parser.add_argument('dump', help="dump file (.npz)")
+    parser.add_argument('--last', type=float, default=0, help="only the last N seconds")
+    parser.add_argument('--no-stages', action='store_true', help="omit the stage timing records")
+    args = parser.parse_args(argv)
+
+    header, records = load_dump(args.dump)
+    stage_names = dict((code, name) for name, code in header['stages'].items())
+    print("%s: %d records (%d since start), reason: %s" % (os.path.basename(args.dump), len(records),
+                                                           header['count'], header['reason']))
+    if args.last > 0 and len(records):
+        records = records[records['time'] >= records['time'][-1] - args.last]
+    if args.no_stages:
+        records = records[records['kind'] != KIND_STAGE]
+    for record in records:
+        print("%12.6f %s" % (record['time'], describe(record, stage_names)))
+
+logger = logging.getLogger("logger")
+
+if __name__ == '__main__':
+    main()
@@ -11,10 +11,11 @@ import pickle # for storing parameters
 from pprint import pprint
 import os.path
 import re
+import time
 import numpy as np
 import math
 from enum import Enum
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 
 # configparser: attempt for py3/py2.7 compatibility
 try:
@@ -33,28 +34,51 @@ sys.path.append( os.path.join( os.path.dirname(__file__), os.path.pardir ) )
 
 from opeth import logsetup
 from opeth.spike_gui import SpikeEvalGui
+from opeth.heatmap_gui import PethHeatmapGui
+from opeth.raster_gui import RasterGui
+from opeth.erp_gui import ErpGui
+from opeth.threshold_table import ThresholdEditor
 from opeth import pgext
 from opeth.comm import CommProcess
-from opeth.colldata import DataProc, EVENT_ROI, SAMPLES_PER_SEC, SPIKE_HOLDOFF
-from opeth.debug import TimeMeasClass     # used for DEBUG_TIMING
+from opeth.colldata import DataProc, EVENT_ROI, SAMPLES_PER_SEC, SPIKE_HOLDOFF, DATA_RETENTION
+from opeth.peth import PETH_MODES, PETH_CUMULATIVE, PETH_WINDOW
+from opeth.overlay import TrialOverlay, OVERLAY_MAX_TRIALS
+from opeth.filters import REREF_CAR, REREF_CMR
+from opeth.eventproc import EventProcessor, HISTOGRAM_BINSIZE, TRIGGER_HOLDOFF, MAIN_WINDOW
+from opeth.export import ResultsExporter
+from opeth.metrics import MetricsRegistry, MetricsServer
+from opeth.flightrec import FlightRecorder, KIND_COMPACTION, KIND_OVERLOAD
+from opeth.checkpoint import Checkpointer, analysis_state, load_checkpoint, restore_pethset, restore_spikestore, restore_detector
+from opeth.debug import TimeMeasClass, TriggerLatency, TRIGGER_STAGES, format_latency     # used for DEBUG_TIMING
 from opeth.version import __version__
 
 AUTOTRIGGER_CH = None       #: Set to None to disable, otherwise TTL pulses will be generated if given channel is over threshold
-HISTOGRAM_BINSIZE = 0.001   #: Histogram bin size in seconds
 CHANNELS_PER_HISTPLOT = 4   #: Channels per tetrode to be combined in histogram
 PARAMFNAME = "lastini.conf" #: Last used ini file name stored in a file, will default to :data:`DEFAULT_INI` if missing
 DEFAULT_INI = "default.ini" #: Config file name defaults
 DEFAULT_SPIKE_THRESHOLD = 0.00003 #: Spike threshold set as default parameter if no ini file found.
-TRIGGER_HOLDOFF = 0.001     #: Trigger holdoff in seconds
-RERECORD = False            #: True if data is to be saved for debug purposes
+AUTO_THRESHOLD_K = 4.0      #: Default multiplier of the noise level for automatic thresholds
+AUTO_THRESHOLD_PERIOD = 2.0 #: Automatic threshold update period in seconds
+RERECORD = False            #: True if the session is to be recorded from start (see :meth:`GuiClass.onRecord`)
+RECORDER_REPORT_PERIOD = 5.0 #: Recording backpressure check period in seconds
+EXPORT_SNAPSHOT_PERIOD = 10.0 #: PETH snapshot period of the results export in seconds
+CHECKPOINT_PERIOD = 30.0    #: Checkpoint period in seconds
+CHECKPOINT_MAX_AGE = 3600   #: Older checkpoints are not restored at startup (seconds)
 SPIKEWIN = False            #: Set to True if one spike analysis window is to be opened at start.
 HIDE_AUX_CHANNELS = True    #: Whether AUXiliary channels (in 35 channel case last 3 channels, in 70 channel case last 6) should be omitted.
 MAX_CHANNELS_PER_PLOT = 8   #: Maximal number of channels for a given histogram window/polytrode
 MAX_TRIGGER_CHANNEL = 8     #: TTL trigger channel is up to 8 for a BNC expansion board
 NEGATIVE_THRESHOLD = True   #: Inverted signal - positive threshold value in params mean negative threshold with falling edge detection
+RAWPLOT_LENGTH = 1          #: Length of the scrolling raw data display in seconds
+REREF_NONE = 'none'         #: Reference parameter value for no re-referencing
 
 DEBUG = False               #: Enable or disable debug mode
 DEBUG_TIMING = False        #: Enable timing prints
+LATENCY_REPORT_PERIOD = 10.0 #: Stage latency statistics log period in seconds (if enabled in the GUI)
+METRICS_PERIOD = 1.0        #: Update period of the metrics endpoint in seconds (see :mod:`metrics`)
+FLIGHTREC_OVERLOAD_FRAME = 0.1  #: Display update time (s) recorded as overload by the flight recorder (see :mod:`flightrec`)
+FLIGHTREC_DUMP_FRAME = 0.5  #: Display update time (s) triggering an automatic flight recorder dump
+FLIGHTREC_DUMP_HOLDOFF = 60.0   #: Minimal time between automatic flight recorder dumps in seconds
 DEBUG_FPS = False           #: Enable frame per sec debug prints
 DEBUG_FPSREPORT_PERIOD = 5  #: FPS debug print update frequency
 
@@ -69,11 +93,17 @@ DEBUG_FPSREPORT_PERIOD = 5  #: FPS debug print update frequency
 #      ..   ...
 # row x col: 3x1, 4x2, 4x3, 5x4, 5x5, 5x6, 6x7, 8x8, 10x9, 11x10...
 COLUMN_INCREMENTS = [3, 8, 12, 20, 25, 30, 42, 64, 90, 110, 120, 130, 1000] #: A value in a given index means maximum number of plots displayed for the index number of columns
+MAX_VISIBLE_PLOTS = 16      #: Histogram plot windows created at once, further plots are accessible by paging
 
 # Enumeration of the three different
 PLOT_FLAT, PLOT_AGGREGATE, PLOT_CHANNELS = 'flat', 'aggregate', 'channels'
 PLOT_TYPES = [PLOT_AGGREGATE, PLOT_FLAT, PLOT_CHANNELS]
 
+# Spike sources: threshold crossings detected by OPETH in the raw data or
+# spike events sent by an OE Spike Detector/Sorter placed before the ZMQ plugin
+SPIKESRC_THRESHOLD, SPIKESRC_OE = 'threshold', 'OE spike events'
+SPIKE_SOURCES = [SPIKESRC_THRESHOLD, SPIKESRC_OE]
+
 VOLT_TO_UVOLT_MULTIPLIER = 1000000
 
 # Histogram color assignments
@@ -122,29 +152,49 @@ class GuiClass(object):
         Attributes:
             rawdata_curves (list):  Top part waveforms of raw analog window
             ttlraw_curves (list):   Bottom part waveforms of raw analog window
+            overlay (overlay.TrialOverlay): Last trials of the selected channels for the bottom part of the raw window
+                (None if overlay mode is off)
             cp (comm.CommProcess):  Interface and data collector to OE
             dataproc (colldata.DataProc):  Data processor instance working on :attr:`cp`'s :class:`colldata.Collector` data
             mainwin (QtGui.QMainWindow): Main window with histogram and parameter setup window
             rawdatawin (pyqtgraph.GraphicsWindow): Real time raw analog data display with a continuously scrolling part and a 
                 TTL-aligned snapshot.
             debugwin (QtGui.QWidget): Opened only if :data:`DEBUG` is True, displays some internal variables for debugging
-            spike_bin_ms (2D np.ndarray): Histogram bins, one row per channel, each row contains 
-                :attr:`ttl_range_ms` + 1 number of bins for collecting spike offsets relative to event.
-            ttl_range_ms (int):     TTL range specified by start and end value in :attr:`event_roi`
+            heatmapwin (heatmap_gui.PethHeatmapGui): Single image PETH display of all channels, None until opened
+            rasterwin (raster_gui.RasterGui): Per-trial spike raster of the displayed PETH, None until opened
+            erpwin (erp_gui.ErpGui): Event-triggered average of the analog signal, None until opened
+            peths (OrderedDict of peth.PethSet): Histograms for each event window in :attr:`event_windows`,
+                collected separately for each (TTL trigger channel, threshold profile index) key.
+            spike_bin_ms (2D np.ndarray): Histogram bins of the displayed event window and trigger channel in :attr:`peths`,
+                one row per channel, each row contains :attr:`ttl_range_ms` + 1 number of bins for collecting
+                spike offsets relative to event.
+            ttl_range_ms (int):     TTL range specified by start and end value of the displayed event window
                 (warning: if :data:`HISTOGRAM_BINSIZE` modified, it is not ms any more!)
             event_roi (list of two float elements): Region of interest around event ([start, end] values in second around
                 TTL pulse for spike search region and plotting e.g. [-0.02, 0.05] for default 20 ms before, 50 ms after)
+            event_windows (OrderedDict): Named event windows ([start, end] lists as :attr:`event_roi`), each of them having
+                its own histograms. The first one is :data:`MAIN_WINDOW` referring to :attr:`event_roi`.
             configfname (str):       Name of config file for parameter setup storage. :data:`PARAMFNAME` points to the file
                 from where its initial value is read during program startup.
+            thresh_model (threshold_table.ThresholdModel): Per-channel threshold levels in V as edited in the GUI.
             threshold_levels (np.ndarray of floats):  One row per tetrode, threshold level in uV. 
                 Same sign both for negative and positive spikes as in GUI, will be adjusted afterwards for spike detection.
+            threshold_profiles (np.ndarray of floats): Threshold profiles as multipliers of :attr:`threshold_levels`, all of
+                them evaluated in a single detection pass with separate histograms. The first one is always 1.
             histplots (list of lists of plots): Histogram plot collection for data updates - each element is a 
-                collection of per-channel histograms for a given tetrode.
+                collection of per-channel histograms for a given display slot (see :meth:`visible_plots`).
+            hist_page (int): Index of the displayed page of histogram plots, only :data:`MAX_VISIBLE_PLOTS`
+                plot windows are created and reused for the displayed page.
         '''
         self.rawdata_curves = []
         self.ttlraw_curves = []
+        self.overlay = None
+        self.overlay_curves = []
+        self.overlay_mean_curves = []
         self.cp = CommProcess()
         self.dataproc = DataProc(self.cp.collector, HIDE_AUX_CHANNELS)
+        if RERECORD:
+            self.cp.collector.start_recording(time.strftime("opeth_%Y%m%d_%H%M%S"))
         self.initiated = False
         self.plotdistance = 0
         self.starttime = default_timer()
@@ -160,13 +210,17 @@ class GuiClass(object):
 
         # spike positions
         self.raw_spikepos = []
-        # todo: '_ms' depends on HISTOGRAM_BINSIZE, not necessarily ms!
-        self.spike_bin_ms = None
+        self.peths = None
+        self.heatmapwin = None
+        self.rasterwin = None
+        self.erpwin = None
 
         # parameters
         self.threshold_levels = None
+        self.threshold_profiles = np.ones(1)
         self.trigger_nearest_ts = 0.0
         self.channels_per_plot = CHANNELS_PER_HISTPLOT
+        self.hist_page = 0
         self.should_restore_params = True   #: Automatic parameter reload should happen only on startup.
         self.sampling_rate = SAMPLES_PER_SEC
         self.downsampling_rate = SAMPLES_PER_SEC // 1000 #: Downsampling rate is calculated from sampling rate, target is 1kHz for raw data window
@@ -175,22 +229,42 @@ class GuiClass(object):
         self.closing = False
 
         self.earliest_hist_plot = default_timer()   #: Next histogram update time for performance cap
+        self.next_auto_threshold = default_timer()  #: Next automatic threshold update time
 
         self.timing_start = default_timer() #: Debug: internal elapsed time measurement scheduler
+        self.next_latency_report = default_timer()  #: Next stage latency statistics log time
         self.timeas = TimeMeasClass()       #: Profiling class
+        self.trigger_latency = TriggerLatency() #: Trigger-to-display latency statistics
 
         self.disabled_channels = []         #: A list of disabled channels starting with 0
         self.disabled_channel_update_at = None  # pyqtgraph parameters can't be updated from within the change handler?
         self.disabled_channel_update_to = ''    # doing that instead from the update routine
 
         self.event_roi = list(EVENT_ROI)
+        self.event_windows = OrderedDict([(MAIN_WINDOW, self.event_roi)])
+        self.eventproc = EventProcessor(self.cp.collector, self.dataproc, self.event_windows, self.timeas)  #: Trigger processing and PETHs
 
         self.configfname = "default.ini"
         self.force_update = False           #: Keep track of programmatic parameter changes to prevent infinite loops.
 
-        if RERECORD:
-            self.datafile = open('data.txt', 'wt')
-            self.ttlfile = open('trigger.txt', 'wt')
+        self.next_recorder_report = default_timer()    #: Next recording backpressure check time
+        self.recorder_dropped = 0   #: Dropped packet count of the recording at the last check
+        self.exporter = None        #: Results export (see :mod:`export`), None if not exporting
+        self.next_export_snapshot = default_timer()    #: Next PETH snapshot time of the export
+        self.checkpointer = None    #: Periodic analysis state checkpoints (see :mod:`checkpoint`), None if disabled
+        self.next_checkpoint = default_timer() + CHECKPOINT_PERIOD  #: Next checkpoint time
+        self.pending_checkpoint = None  #: Checkpoint offered for restoring once the channel count is known
+        self.metrics_server = None  #: Metrics endpoint (see :mod:`metrics`), None if disabled
+        self.next_metrics = default_timer()     #: Next metrics update time
+        self.metrics_last = (default_timer(), 0, 0)    #: Time, message and byte count of the last metrics update
+        self.frame_time = 0.        #: Duration of the last complete display update in seconds
+        self.dropped_redraws = 0    #: Histogram redraws skipped by the :attr:`MAX_PLOT_PER_SEC` limit
+        self.flightrec = FlightRecorder()   #: Ring of recent pipeline events (see :mod:`flightrec`)
+        self.timeas.flightrec = self.cp.flightrec = self.cp.collector.flightrec = self.flightrec
+        self.flightrec_compactions = [0, 0]     #: Data and timestamp buffer compactions already recorded
+        self.flightrec_overload = False     #: Last display update was over :data:`FLIGHTREC_OVERLOAD_FRAME`
+        self.next_flightrec_dump = default_timer()  #: Earliest time of the next automatic dump
+        self.next_exception_dump = {}   #: Exception type name -> earliest time of its next dump
 
         # GUI colors
         # by default start off with dark colors
@@ -201,6 +275,12 @@ class GuiClass(object):
         self.initgraph()
         self.mainwin.show()
 
+    @property
+    def spike_bin_ms(self):
+        '''Histogram bins of the PETH of the selected trigger channel.'''
+        # todo: '_ms' depends on HISTOGRAM_BINSIZE, not necessarily ms!
+        return self.peths[self.displayed_window()][(self.par_ttl_src.value() - 1, self.displayed_profile())].bins
+
     def initgraph(self):
         '''Called at startup to set up the main window with the parameter setup
         and the raw data window.
@@ -233,6 +313,11 @@ class GuiClass(object):
         self.nPlotWindows =  int(math.ceil(nChannels / self.channels_per_plot)) #: Number of histogram plots, equals to ``self.nChannels/self.channels_per_plot``
         logger.info("Initializing for %d channel plots, %d histogram plots" % (nChannels, self.nPlotWindows))
         self.nChannels = nChannels
+        self.nVisiblePlots = min(self.nPlotWindows, MAX_VISIBLE_PLOTS) #: Number of histogram plot windows actually created
+        self.nHistPages = int(math.ceil(self.nPlotWindows / MAX_VISIBLE_PLOTS))
+        self.hist_page = min(self.hist_page, self.nHistPages - 1)
+        self.par_hist_page.setLimits((1, self.nHistPages))
+        self.par_hist_page.setValue(self.hist_page + 1)
 
         if self.channels_per_plot == 2:
             self.plottitle = "Stereotrode"
@@ -252,8 +337,11 @@ class GuiClass(object):
         self.sampling_rate = sampling_rate
         for w in self.spikewins:
             w.set_sampling_rate(sampling_rate)
+        if self.erpwin is not None:
+            self.erpwin.set_sampling_rate(sampling_rate)
         self.cp.collector.set_sampling_rate(sampling_rate)
         self.dataproc.set_sampling_rate(sampling_rate)
+        self.dataproc.reset_detection()
         
         if clear_plot:
             self.clear_plot()
@@ -266,7 +354,7 @@ class GuiClass(object):
         '''If the plot style changes from one of the histogram plots to channel plot
         or vica versa, the channel colors are to be updated.
         '''
-        self.populate_params()
+        self.update_param_colors()
 
     def init_rawwin(self):
         '''Real time display of current waveform for visible feedback even when signal thresholds may be off.
@@ -308,6 +396,33 @@ class GuiClass(object):
             self.ttlraw_curves.append(c)
             self.ttlplot.setLabel('bottom', 'Spike time relative to event', units='ms')
 
+        self.update_overlay()
+
+    def update_overlay(self):
+        '''(Re)create the trial overlay of the event-aligned raw display for the selected channels,
+        or switch it off if the number of overlaid trials is 0.'''
+        for c in self.overlay_curves + self.overlay_mean_curves:
+            self.ttlplot.removeItem(c)
+        self.overlay_curves = []
+        self.overlay_mean_curves = []
+        self.overlay = None
+
+        channels = [ch - 1 for ch in self.convert_strlist_to_ints(self.par_overlay_ch.value()) if 0 < ch <= self.nChannels]
+        if self.par_overlay_trials.value() == 0 or not channels:
+            return
+
+        self.overlay = TrialOverlay(self.par_overlay_trials.value(), channels)
+        for ch in channels:
+            color = pg.mkColor((ch, self.nChannels*1.3))
+            mean_curve = pg.PlotCurveItem(pen=pg.mkPen(color, width=2))
+            color.setAlpha(80)
+            trace_curve = pg.PlotCurveItem(pen=pg.mkPen(color))
+            for c in (trace_curve, mean_curve):
+                self.ttlplot.addItem(c)
+                c.setPos(0, -ch*6)
+            self.overlay_curves.append(trace_curve)
+            self.overlay_mean_curves.append(mean_curve)
+
     def init_histwin(self):
         '''Initialize main histogram window and parameters with defaults.
 
@@ -356,8 +471,9 @@ class GuiClass(object):
 
     def populate_histwin(self):
         '''Create an array of dockable/movable histograms.
-        The layout is determined by the number of necessary plot windows and the
-        :data:`COLUMN_INCREMENTS` variable.
+        The layout is determined by the number of necessary plot windows (at most
+        :data:`MAX_VISIBLE_PLOTS`) and the :data:`COLUMN_INCREMENTS` variable.
+        The windows are assigned to the plots of the displayed page in :meth:`set_hist_page`.
         '''
         if hasattr(self, 'histwidgets'):
             for h in self.histwidgets:
@@ -388,20 +504,20 @@ class GuiClass(object):
         self.hboxlayout.insertWidget(0, self.histplotarea)
 
         # Rebuild layout with new plots
-        self.docks = [Dock("%s %d" % (self.plottitle, idx + 1)) for idx in range(self.nPlotWindows)]
+        self.docks = [Dock("%s %d" % (self.plottitle, idx + 1)) for idx in range(self.nVisiblePlots)]
 
-        # Determine layout of plots depending on self.nPlotWindows according to COLUMN_INCREMENTS list.
+        # Determine layout of plots depending on self.nVisiblePlots according to COLUMN_INCREMENTS list.
         # Number of columns is directly derived from COLUMN_INCREMENTS, based on that the number of
         # rows is also determined.
         # Actual layout will be filled from left to right, then top to bottom.
 
-        cols = min(np.argwhere(np.array(COLUMN_INCREMENTS, dtype='int32') >= self.nPlotWindows))[0] + 1
-        rows = int(math.ceil(self.nPlotWindows / cols))
+        cols = min(np.argwhere(np.array(COLUMN_INCREMENTS, dtype='int32') >= self.nVisiblePlots))[0] + 1
+        rows = int(math.ceil(self.nVisiblePlots / cols))
 
-        logger.info("Histogram plots: %d x %d grid" % (rows, cols))
+        logger.info("Histogram plots: %d x %d grid, %d page(s)" % (rows, cols, self.nHistPages))
         hasdocks = np.ones((rows, cols), dtype='int32')
         # last row may not be filled...
-        empty = rows * cols - self.nPlotWindows
+        empty = rows * cols - self.nVisiblePlots
         self.docks += [Dock("") for idx in range(empty)]
 
         dockpos = np.argwhere(hasdocks)
@@ -435,7 +551,7 @@ class GuiClass(object):
                 docked_to_left = dock_order[row, col-1]
                 self.histplotarea.addDock(self.docks[todock], "right", self.docks[docked_to_left])
 
-        self.histwidgets = [pg.PlotWidget(viewBox=pgext.DisabledMouseViewBox()) for i in range(self.nPlotWindows)]
+        self.histwidgets = [pg.PlotWidget(viewBox=pgext.DisabledMouseViewBox()) for i in range(self.nVisiblePlots)]
 
         for idx, (d, w) in enumerate(zip(self.docks, self.histwidgets)):
             d.addWidget(w)
@@ -444,11 +560,10 @@ class GuiClass(object):
 
             # For each display window there is a set of plots to be shown
             # Flat, aggregate view: histogram with bar graphs (stepMode: True)
+            # (colors are set according to the displayed page in set_hist_page)
             histplots = []
             for i in range(self.channels_per_plot):
-                ch_id = idx * self.channels_per_plot + i
-                color = self.display_brushcolors[i] if ch_id not in self.disabled_channels else (255,255,255,0) # transparent
-                hp = w.plot(np.arange(2), np.arange(1), stepMode=True, fillLevel=0, brush=color)
+                hp = w.plot(np.arange(2), np.arange(1), stepMode=True, fillLevel=0, brush=self.display_brushcolors[i])
                 # Make it sure that later channels of an aggregate plot are behind first channel
                 # so first channel of a plot is at bottom of the stack.
                 hp.setZValue(self.channels_per_plot - i)
@@ -462,11 +577,7 @@ class GuiClass(object):
 
             channelplots = []
             for i in range(self.channels_per_plot):
-                ch_id = idx * self.channels_per_plot + i
-                
-                color = self.display_linecolors[i] if ch_id not in self.disabled_channels else (255,255,255,0) # transparent
-
-                pen = pg.mkPen(color=color, width=LINE_WIDTH)
+                pen = pg.mkPen(color=self.display_linecolors[i], width=LINE_WIDTH)
                 self.channel_line_pens.append(pen)
                 channelplots.append(w.plot(np.arange(1), np.arange(1), stepMode=False,
                             pen=pen, antialias=antialias))
@@ -474,24 +585,73 @@ class GuiClass(object):
             self.histplots.append(histplots)
             self.channelplots.append(channelplots)
 
-        self.hist_x = np.linspace(self.event_roi[0], self.event_roi[1], int(round(
-                (self.event_roi[1] - self.event_roi[0] + HISTOGRAM_BINSIZE) / HISTOGRAM_BINSIZE)))
+        self.set_hist_page(self.hist_page)
+        self.update_hist_x()
 
-    def update_plotcolors(self):
-        '''Called when channels get disabled - no need to remove plots'''
-        # channel colors update - piece of cake
-        for ch_id in range(self.nChannels):
-            color = self.display_linecolors[ch_id % self.channels_per_plot] if ch_id not in self.disabled_channels else (255,255,255,0)
-            self.channel_line_pens[ch_id].setColor(QtGui.QColor(*color))
+    def visible_plots(self):
+        '''Plots of the displayed page.
+
+        Returns:
+            list of (display slot, plot index) tuples, slot indexing :attr:`histplots`, :attr:`channelplots` and :attr:`docks`
+        '''
+        first = self.hist_page * MAX_VISIBLE_PLOTS
+        return [(slot, first + slot) for slot in range(min(self.nVisiblePlots, self.nPlotWindows - first))]
+
+    def set_hist_page(self, page):
+        '''Assign the existing plot windows to the plots of a new page: only titles, colors and
+        visibility are updated, no plots are created.'''
+        self.hist_page = page
+        visible = len(self.visible_plots())
+        first = page * MAX_VISIBLE_PLOTS
+        for slot, (d, w) in enumerate(zip(self.docks, self.histwidgets)):
+            d.label.setText("%s %d" % (self.plottitle, first + slot + 1) if slot < visible else "")
+            w.setVisible(slot < visible)
+        self.update_plotcolors()
+        self.force_update = True
 
-        for plot_idx, histplot in enumerate(self.histplots):
+    def channel_color(self, ch_id):
+        '''Display color of a channel according to the actual plot type.'''
+        if ch_id in self.disabled_channels:
+            return (255, 255, 255, 0) # transparent
+        if self.par_histcolor.value() == PLOT_CHANNELS:
+            return self.display_linecolors[ch_id % self.channels_per_plot]
+        elif self.par_histcolor.value() == PLOT_AGGREGATE:
+            return self.display_brushcolors[ch_id % self.channels_per_plot]
+        return self.display_brushcolors[0]
+
+    def update_param_colors(self):
+        '''Update channel colors of the threshold editor in place.'''
+        if not hasattr(self, 'nChannels') or len(self.thresh_model.values) != self.nChannels:
+            self.populate_params()
+            return
+        self.thresh_model.set_colors([self.channel_color(ch) for ch in range(self.nChannels)])
+
+    def apply_theme(self):
+        '''Apply background and foreground colors of :attr:`display_theme` to the existing histogram plots.'''
+        background, foreground = ('k', 'w') if self.display_theme == Theme.dark else ('w', 'k')
+        for w in self.histwidgets:
+            w.setBackground(background)
+            for name in ('left', 'bottom'):
+                axis = w.getAxis(name)
+                axis.setPen(foreground)
+                if hasattr(axis, 'setTextPen'):
+                    axis.setTextPen(foreground)
+            w.setLabel('bottom', 'Spike time rel. to event', units='ms', color=foreground)
+
+    def update_plotcolors(self):
+        '''Called when channels get disabled or the displayed page changes - no need to remove plots'''
+        for slot, plot_idx in self.visible_plots():
             startid = plot_idx * self.channels_per_plot
             for i in range(self.channels_per_plot):
                 ch_id = startid + i
+                # channel colors update - piece of cake
+                color = self.display_linecolors[i] if ch_id not in self.disabled_channels else (255,255,255,0)
+                self.channel_line_pens[slot * self.channels_per_plot + i].setColor(QtGui.QColor(*color))
+
                 color = self.display_brushcolors[i] if ch_id not in self.disabled_channels else (255,255,255,0)
                 #histplot[i].setFillBrush(color) # this would not work - creates a QColor???
                 # and causes a lot of exceptions
-                histplot[i].opts['fillBrush'] = color
+                self.histplots[slot][i].opts['fillBrush'] = color
 
     def init_params(self, paramcontainer, reset=False, **kwargs):
         '''Prepare parameter setup part of main histogram window.'''
@@ -504,11 +664,17 @@ class GuiClass(object):
         
         self.par_ttl_src = Parameter.create(name='Event trigger channel', type='int', limits=(1, MAX_TRIGGER_CHANNEL))
         self.param.addChild(self.par_ttl_src)
+
+        self.par_all_ttl = Parameter.create(name='Collect all trigger channels', type='bool', value=True)
+        self.param.addChild(self.par_all_ttl)
         
         self.par_ch_per_plot = Parameter.create(name='Channels per plot', type='int',  limits=(1, MAX_CHANNELS_PER_PLOT),
                                                 value=CHANNELS_PER_HISTPLOT)
         self.param.addChild(self.par_ch_per_plot)
 
+        self.par_hist_page = Parameter.create(name='Histogram page', type='int', value=1, limits=(1, 1))
+        self.param.addChild(self.par_hist_page)
+
         self.par_disabled_ch = Parameter.create(name="Disabled channels", type='str', value="")
         self.param.addChild(self.par_disabled_ch)
 
@@ -520,17 +686,71 @@ class GuiClass(object):
                                                  limits=(-500, 500), suffix='s')
         self.param.addChild(self.par_ttlroi_after)
 
+        self.par_extra_windows = Parameter.create(name='Extra event windows', type='str', value="")
+        self.param.addChild(self.par_extra_windows)
+
+        self.par_display_window = Parameter.create(name='Displayed window', type='list', values=[MAIN_WINDOW], value=MAIN_WINDOW)
+        self.param.addChild(self.par_display_window)
+
         self.par_histcolor = Parameter.create(name='Histogram color', type='list', values=dict([(p, p) for p in PLOT_TYPES]))
         self.param.addChild(self.par_histcolor)
 
+        self.par_peth_mode = Parameter.create(name='PETH mode', type='list', values=dict([(p, p) for p in PETH_MODES]),
+                                              value=PETH_CUMULATIVE)
+        self.param.addChild(self.par_peth_mode)
+
+        self.par_peth_window = Parameter.create(name='PETH trials (N)', type='int', value=PETH_WINDOW, limits=(1, 100000))
+        self.param.addChild(self.par_peth_window)
+
+        self.par_overlay_trials = Parameter.create(name='Overlay trials (N)', type='int', value=0, limits=(0, OVERLAY_MAX_TRIALS))
+        self.param.addChild(self.par_overlay_trials)
+
+        self.par_overlay_ch = Parameter.create(name='Overlay channels', type='str', value="1")
+        self.param.addChild(self.par_overlay_ch)
+
+        self.par_bandpass = Parameter.create(name='Band-pass filter (Hz)', type='str', value="")
+        self.param.addChild(self.par_bandpass)
+
+        self.par_reference = Parameter.create(name='Reference', type='list', values=[REREF_NONE, REREF_CAR, REREF_CMR],
+                                              value=REREF_NONE)
+        self.param.addChild(self.par_reference)
+
+        self.par_reference_group = Parameter.create(name='Reference group size', type='int', value=0, limits=(0, 1024))
+        self.param.addChild(self.par_reference_group)
+
+        self.par_spike_source = Parameter.create(name='Spike source', type='list', values=dict([(p, p) for p in SPIKE_SOURCES]),
+                                                 value=SPIKESRC_THRESHOLD)
+        self.param.addChild(self.par_spike_source)
+
+        self.par_sorted_unit = Parameter.create(name='Sorted unit (0: all)', type='int', value=0, limits=(0, 1000))
+        self.param.addChild(self.par_sorted_unit)
+
         self.par_common_thresh = Parameter.create(name='Spike threshold', type='float', value=DEFAULT_SPIKE_THRESHOLD, step=1e-3, siPrefix=True,
                                                   limits=(1e-6,5), suffix='V')
         self.param.addChild(self.par_common_thresh)
 
-        # Per-tetrode threshold settings are empty at start
-        self.par_tetrode_thresh = []
-        self.param_custom_thresh = Parameter.create(name='Custom threshold levels', type='group', children=self.par_tetrode_thresh)
-        self.param.addChild(self.param_custom_thresh)
+        self.par_auto_thresh = Parameter.create(name='Automatic threshold', type='bool', value=False)
+        self.param.addChild(self.par_auto_thresh)
+
+        self.par_auto_thresh_k = Parameter.create(name='Threshold / noise (k)', type='float', value=AUTO_THRESHOLD_K, step=0.5,
+                                                  limits=(0.5, 50))
+        self.param.addChild(self.par_auto_thresh_k)
+
+        self.par_thresh_profiles = Parameter.create(name='Extra threshold profiles', type='str', value="")
+        self.param.addChild(self.par_thresh_profiles)
+
+        self.par_display_profile = Parameter.create(name='Displayed profile', type='list', values=[self.profile_name(1)],
+                                                    value=self.profile_name(1))
+        self.param.addChild(self.par_display_profile)
+
+        self.par_latency_stats = Parameter.create(name='Stage latency statistics', type='bool', value=False)
+        self.param.addChild(self.par_latency_stats)
+
+        self.par_metrics_port = Parameter.create(name='Metrics port (0: off)', type='int', value=0, limits=(0, 65535))
+        self.param.addChild(self.par_metrics_port)
+
+        self.par_checkpoint_file = Parameter.create(name='Checkpoint file (empty: off)', type='str', value="")
+        self.param.addChild(self.par_checkpoint_file)
 
         paramTree = ParameterTree()
         paramTree.setParameters(self.param, showTop=False)
@@ -562,9 +782,21 @@ class GuiClass(object):
         change_theme_btn = QtGui.QPushButton('Invert colours')
 
         open_spikes_btn = QtGui.QPushButton('Open new spike win')
+        open_heatmap_btn = QtGui.QPushButton('Heatmap')
+        open_raster_btn = QtGui.QPushButton('Raster')
+        open_erp_btn = QtGui.QPushButton('ERP')
+        self.record_btn = QtGui.QPushButton('Stop rec' if self.cp.collector.recorder is not None else 'Record')
+        self.export_btn = QtGui.QPushButton('Export')
+        flightrec_btn = QtGui.QPushButton('Flight rec')
         h1.addWidget(clear_btn)
         h1.addWidget(change_theme_btn)
         h1.addWidget(open_spikes_btn)
+        h1.addWidget(open_heatmap_btn)
+        h1.addWidget(open_raster_btn)
+        h1.addWidget(open_erp_btn)
+        h1.addWidget(self.record_btn)
+        h1.addWidget(self.export_btn)
+        h1.addWidget(flightrec_btn)
         h2.addWidget(save_params_btn)
         h2.addWidget(save_as_params_btn)
         h2.addWidget(load_params_btn)
@@ -572,8 +804,14 @@ class GuiClass(object):
         buttonsLayout.addWidget(row1)
         buttonsLayout.addWidget(self.configbox)
 
+        # Per-channel threshold settings are empty at start
+        self.thresh_editor = ThresholdEditor(noise_thresholds=self.noise_thresholds)
+        self.thresh_model = self.thresh_editor.model
+        self.thresh_model.sigValuesChanged.connect(self.onThresholdsChanged)
+
         paramcontainer.addWidget(buttonsWidget)
         paramcontainer.addWidget(paramTree)
+        paramcontainer.addWidget(self.thresh_editor)
 
         save_params_btn.clicked.connect(self.onSaveParams)
         save_as_params_btn.clicked.connect(self.onSaveAsParams)
@@ -582,14 +820,18 @@ class GuiClass(object):
         clear_btn.clicked.connect(self.onClearPlot)
         change_theme_btn.clicked.connect(self.onChangeTheme)
         open_spikes_btn.clicked.connect(self.onOpenSpikeWin)
+        open_heatmap_btn.clicked.connect(self.onOpenHeatmap)
+        open_raster_btn.clicked.connect(self.onOpenRaster)
+        open_erp_btn.clicked.connect(self.onOpenErp)
+        self.record_btn.clicked.connect(self.onRecord)
+        self.export_btn.clicked.connect(self.onExport)
+        flightrec_btn.clicked.connect(self.onDumpFlightrec)
 
         self.param.sigTreeStateChanged.connect(self.onParamChange)
 
     def populate_params(self):
         '''Update parameter setup after channel count is known.'''
 
-        self.param_custom_thresh.clearChildren()
-
         if self.threshold_levels is not None and len(self.threshold_levels) == self.nChannels:
             thresholds = list((self.threshold_levels / VOLT_TO_UVOLT_MULTIPLIER).ravel())
         else:
@@ -602,32 +844,10 @@ class GuiClass(object):
             channel_names = ['Ch#%d (%s#%d):' % (ch + 1, self.plottitle, ch//self.channels_per_plot + 1)
                              for ch in range(self.nChannels)]
 
-        # fetch channel colors
-        ch_colors = []
-        if self.par_histcolor.value() == PLOT_CHANNELS:
-            for ch in range(self.nChannels):
-                channels = self.channelplots[ch // self.channels_per_plot]
-                plot = channels[ch % self.channels_per_plot]
+        # fetch channel colors (not all channels have plots, see MAX_VISIBLE_PLOTS)
+        ch_colors = [self.channel_color(ch) for ch in range(self.nChannels)]
 
-                ch_colors.append(plot.opts['pen'].brush().color().getRgb())
-        elif self.par_histcolor.value() == PLOT_AGGREGATE:
-            for ch in range(self.nChannels):
-                hplots = self.histplots[ch // self.channels_per_plot]
-                plot = hplots[ch % self.channels_per_plot]
-                ch_colors.append(plot.opts['fillBrush'])
-        else: # flat
-            ch_colors = [self.display_brushcolors[0]] * self.nChannels
-            for ch in range(self.nChannels):
-                if ch in self.disabled_channels:
-                    ch_colors[ch] = (255, 255, 255, 0)
-
-        # "channel" type parameter traslates to pgext.ChannelParameterItem
-        self.par_tetrode_thresh = [Parameter.create(name=channel_names[i], type='channel',
-                                   color=ch_colors[i], value=thresholds[i],
-                                   step=1e-3, siPrefix=True, limits=(1e-6,5), suffix='V'
-                                   ) for i in range(self.nChannels)]
-
-        self.param_custom_thresh.addChildren(self.par_tetrode_thresh)
+        self.thresh_model.set_channels(channel_names, thresholds, ch_colors)
 
         if self.should_restore_params:
             self.restore_params()
@@ -635,6 +855,13 @@ class GuiClass(object):
 
         self.update_threshold_levels()
 
+    def update_debug_latency(self):
+        '''Display the trigger-to-display latency statistics (p50 / p95 / p99 / max) in the debug window.'''
+        for stage, stats in self.trigger_latency.summary().items():
+            self.debug_latency.child(stage).setValue("%.1f / %.1f / %.1f / %.1f" %
+                                                     (stats['p50'] * 1000, stats['p95'] * 1000,
+                                                      stats['p99'] * 1000, stats['max'] * 1000))
+
     def init_debugwin(self):
         '''Open a new debug window - called only if :data:`DEBUG` is enabled.'''
         self.debugwin = QtGui.QWidget()
@@ -649,6 +876,9 @@ class GuiClass(object):
         self.debug_trigdatamax = self.debug_param.addChild(Parameter.create(name="Trig. data max", type="float", value=1e9))
         self.debug_trigdatamin = self.debug_param.addChild(Parameter.create(name="Trig. data min", type="float", value=-1e9))
         self.debug_channelcnt = self.debug_param.addChild(Parameter.create(name="Channel cnt", type="int", value=self.nChannels))
+        self.debug_latency = self.debug_param.addChild(Parameter.create(name="Trigger latency (ms)", type="group"))
+        for stage in TRIGGER_STAGES:
+            self.debug_latency.addChild(Parameter.create(name=stage, type="str", value="", readonly=True))
         t = ParameterTree()
         t.setParameters(self.debug_param)
         l.addWidget(t)
@@ -660,18 +890,84 @@ class GuiClass(object):
 
     def set_threshold_levels(self, value):
         '''Parameter setup: update all the tetrode threshold level values simultaneously.'''
-        if hasattr(self, "par_tetrode_thresh"):
-            for p in self.par_tetrode_thresh:
-                p.setValue(value)
-        else:
-            logger.debug("tetrode_tresh: Noattr")
+        self.thresh_model.set_values(np.arange(len(self.thresh_model.values)), value)
 
     def update_threshold_levels(self):
         '''Update the internal threshold levels based on the UI parameters.'''
-        if hasattr(self, "par_tetrode_thresh") and hasattr(self, "nChannels"):
-            vals = [p.value() for p in self.par_tetrode_thresh]
-            levels = np.array(vals)
-            self.threshold_levels = levels.reshape(self.nChannels, 1) * VOLT_TO_UVOLT_MULTIPLIER
+        if hasattr(self, "nChannels") and len(self.thresh_model.values) == self.nChannels:
+            self.threshold_levels = self.thresh_model.values.reshape(self.nChannels, 1) * VOLT_TO_UVOLT_MULTIPLIER
+            self.dataproc.reset_detection()
+
+    def onThresholdsChanged(self, channels):
+        '''Called by :attr:`thresh_model` with the indices of the modified channels.'''
+        if self.threshold_levels is None or len(self.threshold_levels) != len(self.thresh_model.values):
+            self.update_threshold_levels()
+            return
+        self.threshold_levels[channels, 0] = self.thresh_model.values[channels] * VOLT_TO_UVOLT_MULTIPLIER
+        self.dataproc.reset_detection()
+
+    def noise_thresholds(self):
+        '''Per channel thresholds (V) of k times the noise level estimated by :attr:`colldata.Collector.noise`,
+        None if no estimate is available.'''
+        sigma = self.cp.collector.noise.sigma
+        if sigma is None:
+            return None
+        return self.par_auto_thresh_k.value() * sigma / VOLT_TO_UVOLT_MULTIPLIER
+
+    def update_prefilter(self):
+        '''Pass the band-pass (``low-high`` in Hz, empty for none) and reference settings
+        to the data collector (see :meth:`colldata.Collector.set_prefilter`).'''
+        band = None
+        bandstr = self.par_bandpass.value().strip()
+        if bandstr:
+            try:
+                low, high = [float(v) for v in bandstr.split('-')]
+                band = (low, high)
+            except ValueError:
+                logger.warning("Band-pass filter range should be like 300-6000, got '%s'" % bandstr)
+        reference = self.par_reference.value()
+        self.cp.collector.set_prefilter(band, None if reference == REREF_NONE else reference,
+                                        self.par_reference_group.value())
+        self.dataproc.reset_detection()
+
+    def apply_auto_thresholds(self):
+        '''Set per channel thresholds to k times the noise level (if automatic thresholds are enabled).'''
+        thresholds = self.noise_thresholds()
+        if not self.par_auto_thresh.value() or thresholds is None or len(thresholds) != len(self.thresh_model.values):
+            return
+
+        # a single change notification for all channels
+        self.thresh_model.set_values(np.arange(len(thresholds)), thresholds)
+
+    def profile_name(self, factor):
+        '''Display name of a threshold profile.'''
+        return "x%g" % factor
+
+    def update_threshold_profiles(self):
+        '''Parse the extra threshold profiles entered as comma separated threshold multipliers
+        (e.g. ``0.75, 1.5``) and restart histogram collection with the new profile set.'''
+        factors = [1.0]
+        for entry in self.par_thresh_profiles.value().replace(',', ' ').split():
+            try:
+                factor = float(entry)
+            except ValueError:
+                logger.error("Invalid threshold profile: %s" % entry)
+                continue
+            if factor > 0 and factor not in factors:
+                factors.append(factor)
+
+        self.threshold_profiles = np.array(factors)
+        self.par_display_profile.setLimits([self.profile_name(f) for f in factors])
+        self.dataproc.reset_detection()
+        self.clear_plot()
+
+    def displayed_profile(self):
+        '''Index of the threshold profile selected for display (always 0 for OE spike events).'''
+        if self.par_spike_source.value() == SPIKESRC_OE:
+            return 0
+        names = [self.profile_name(f) for f in self.threshold_profiles]
+        name = self.par_display_profile.value()
+        return names.index(name) if name in names else 0
 
     def more_than_two_continuous(self, intlist):
         '''In order to reduce a string of '1, 2, 3, 4' to '1-4' return the longest
@@ -767,7 +1063,8 @@ class GuiClass(object):
         distr2 = ", ".join(results)
 
         self.update_plotcolors()
-        self.populate_params()
+        self.update_param_colors()
+        self.dataproc.reset_detection()
 
         if self.par_disabled_ch.value() != distr2:
             self.disabled_channel_update_at = default_timer()+.1
@@ -783,20 +1080,64 @@ class GuiClass(object):
         if new_roi[1]-new_roi[0] < 0.02:
             self.event_roi[1] = new_roi[0] + 0.02
 
-        self.ttl_range_ms = int(round( (self.event_roi[1] - self.event_roi[0]) / HISTOGRAM_BINSIZE))
+        self.update_event_windows(clear_plot)
+        logger.info("Stimulus roi updated:" + str(self.event_roi))
+
+    def parse_event_windows(self, str_in):
+        '''Parse the extra event windows entered in the format ``name:start:end, name2:start:end``
+        (start and end in seconds relative to the event, e.g. ``long:-0.5:1``).
+
+        Returns:
+            an OrderedDict of window names and [start, end] lists, invalid entries are skipped.
+        '''
+        windows = OrderedDict()
+        for entry in str_in.split(','):
+            if not entry.strip():
+                continue
+            try:
+                name, start, end = entry.split(':')
+                name, start, end = name.strip(), float(start), float(end)
+            except ValueError:
+                logger.error("Invalid event window entry: %s" % entry)
+                continue
+            if not name or name == MAIN_WINDOW:
+                logger.error("Invalid event window name: %s" % entry)
+                continue
+            windows[name] = [start, max(end, start + 0.02)]
+        return windows
+
+    def update_event_windows(self, clear_plot=True):
+        '''Rebuild :attr:`event_windows` after ROI or extra event window changes.
+
+        Data buffer retention is adjusted to fit the widest window.
+        '''
+        self.event_windows = OrderedDict([(MAIN_WINDOW, self.event_roi)])
+        self.event_windows.update(self.parse_event_windows(self.par_extra_windows.value()))
+        self.eventproc.event_windows = self.event_windows
+        self.par_display_window.setLimits(list(self.event_windows.keys()))
 
-        self.hist_x = np.linspace(self.event_roi[0], self.event_roi[1], int(round(
-                                  (self.event_roi[1] - self.event_roi[0] + HISTOGRAM_BINSIZE) / HISTOGRAM_BINSIZE)))
+        start, end = self.eventproc.union_window()
+        self.cp.collector.set_retention(max(DATA_RETENTION, end - start + 1))
 
+        self.update_hist_x()
         if clear_plot:
             self.clear_plot()
-        logger.info("Stimulus roi updated:" + str(self.event_roi))
+
+    def displayed_window(self):
+        '''Name of the event window selected for display.'''
+        name = self.par_display_window.value()
+        return name if name in self.event_windows else MAIN_WINDOW
+
+    def update_hist_x(self):
+        '''Set up the histogram x axis (and :attr:`ttl_range_ms`) for the displayed event window.'''
+        roi = self.event_windows[self.displayed_window()]
+        self.ttl_range_ms = self.eventproc.roi_bincount(roi) - 1
+        self.hist_x = np.linspace(roi[0], roi[1], int(round(
+                                  (roi[1] - roi[0] + HISTOGRAM_BINSIZE) / HISTOGRAM_BINSIZE)))
 
 
     def onParamChange(self, param, changes):
         '''Called on any parameter change.'''
-        need_threshupdate = False
-
         for param, change, data in changes:
             if change == 'value':
                 # sampling rate is now auto-updated, no manual changes possible / necessary
@@ -804,23 +1145,54 @@ class GuiClass(object):
                 #    self.update_samplingrate(data)
                 if param == self.par_common_thresh:
                     self.set_threshold_levels(data)
-                    need_threshupdate = True
                 elif param == self.par_ttlroi_before:
                     self.change_event_roi((data, self.event_roi[1]))
                 elif param == self.par_ttlroi_after:
                     self.change_event_roi((self.event_roi[0], data))
                 elif param == self.par_disabled_ch:
                     self.update_disabled_channels()
-                elif param in self.par_tetrode_thresh:
-                    need_threshupdate = True
                 elif param == self.par_ch_per_plot:
                     self.channels_per_plot = int(self.par_ch_per_plot.value())
                     self.update_channelcnt(self.cp.collector.channel_cnt())
+                elif param == self.par_hist_page:
+                    page = min(int(data), self.nHistPages) - 1
+                    # programmatic updates in update_channelcnt set the page in advance
+                    if page != self.hist_page:
+                        self.set_hist_page(page)
                 elif param == self.par_histcolor:
                     self.update_plotstyle()
-
-        if need_threshupdate:
-            self.update_threshold_levels()
+                elif param == self.par_ttl_src:
+                    # PETHs of all trigger channels are collected, just display the selected one
+                    self.clear_trial_views()
+                    self.force_update = True
+                elif param == self.par_extra_windows:
+                    self.update_event_windows()
+                elif param == self.par_thresh_profiles:
+                    self.update_threshold_profiles()
+                elif param == self.par_display_profile:
+                    self.clear_trial_views()
+                    self.force_update = True
+                elif param in (self.par_auto_thresh, self.par_auto_thresh_k):
+                    self.apply_auto_thresholds()
+                elif param in (self.par_bandpass, self.par_reference, self.par_reference_group):
+                    self.update_prefilter()
+                elif param in (self.par_spike_source, self.par_sorted_unit, self.par_peth_mode, self.par_peth_window):
+                    # histograms of different spike sources (or accumulation modes) are not to be mixed
+                    self.clear_plot()
+                elif param in (self.par_overlay_trials, self.par_overlay_ch):
+                    if self.initiated:
+                        self.update_overlay()
+                elif param == self.par_metrics_port:
+                    self.update_metrics_server()
+                elif param == self.par_checkpoint_file:
+                    self.update_checkpointer()
+                elif param == self.par_latency_stats:
+                    self.timeas.enable_histograms(data)
+                    self.next_latency_report = default_timer() + LATENCY_REPORT_PERIOD
+                elif param == self.par_display_window:
+                    self.update_hist_x()
+                    self.clear_trial_views()
+                    self.force_update = True
 
     def restore_params(self):
         '''Startup code performing parameter restoration.'''
@@ -891,16 +1263,34 @@ class GuiClass(object):
         cfg.set("plot", "histogram_type", self.par_histcolor.value())
         ch_per_plot = int(self.par_ch_per_plot.value())
         cfg.set("plot", "channels_per_plot", str(self.par_ch_per_plot.value()))
+        cfg.set("plot", "displayed_window", self.par_display_window.value())
+        cfg.set("plot", "displayed_profile", self.par_display_profile.value())
+        cfg.set("plot", "overlay_trials", str(self.par_overlay_trials.value()))
+        cfg.set("plot", "overlay_channels", self.par_overlay_ch.value())
 
         cfg.add_section("processing")
         #cfg.set("processing", "sampling_rate", str(self.par_sampling_rate.value()))
         cfg.set("processing", "ttl_trigger_channel", str(self.par_ttl_src.value()))
+        cfg.set("processing", "all_trigger_channels", str(self.par_all_ttl.value()))
         cfg.set("processing", "roi_before", str(self.par_ttlroi_before.value()))
         cfg.set("processing", "roi_after", str(self.par_ttlroi_after.value()))
+        cfg.set("processing", "extra_windows", self.par_extra_windows.value())
         cfg.set("processing", "spike_nthreshold", str(self.par_common_thresh.value()))
-        thresholds = [str(p.value()) for p in self.par_tetrode_thresh]
+        cfg.set("processing", "threshold_profiles", self.par_thresh_profiles.value())
+        cfg.set("processing", "auto_threshold", str(self.par_auto_thresh.value()))
+        cfg.set("processing", "auto_threshold_k", str(self.par_auto_thresh_k.value()))
+        cfg.set("processing", "bandpass", self.par_bandpass.value())
+        cfg.set("processing", "reference", self.par_reference.value())
+        cfg.set("processing", "reference_group_size", str(self.par_reference_group.value()))
+        thresholds = [str(v) for v in self.thresh_model.values]
         cfg.set("processing", "spike_nthreshold_channels", ",".join(thresholds))
         cfg.set("processing", "disabled_channels", str(self.par_disabled_ch.value()))
+        cfg.set("processing", "spike_source", self.par_spike_source.value())
+        cfg.set("processing", "sorted_unit", str(self.par_sorted_unit.value()))
+        cfg.set("processing", "peth_mode", self.par_peth_mode.value())
+        cfg.set("processing", "peth_trials", str(self.par_peth_window.value()))
+        cfg.set("processing", "metrics_port", str(self.par_metrics_port.value()))
+        cfg.set("processing", "checkpoint_file", self.par_checkpoint_file.value())
 
         # store config options
         with open(self.configfname, 'wt') as configfile:
@@ -949,8 +1339,22 @@ class GuiClass(object):
             self.par_ttlroi_after.setValue(after)
         else:
             after = self.par_ttlroi_after.value()
+
+        if cfg.has_option("processing", "extra_windows"):
+            self.par_extra_windows.setValue(cfg.get("processing", "extra_windows"))
         self.change_event_roi((before, after), clear_plot=False)
 
+        if cfg.has_option("plot", "overlay_channels"):
+            self.par_overlay_ch.setValue(cfg.get("plot", "overlay_channels"))
+
+        if cfg.has_option("plot", "overlay_trials"):
+            self.par_overlay_trials.setValue(cfg.getint("plot", "overlay_trials"))
+
+        if cfg.has_option("plot", "displayed_window"):
+            displayed_window = cfg.get("plot", "displayed_window")
+            if displayed_window in self.event_windows:
+                self.par_display_window.setValue(displayed_window)
+
         # Update system level threshold...
         if cfg.has_option("processing", "spike_nthreshold"):
             threshold = cfg.getfloat("processing", "spike_nthreshold")
@@ -961,19 +1365,66 @@ class GuiClass(object):
         if cfg.has_option("processing", "spike_nthreshold_channels"):
             ch_threshold = cfg.get("processing", "spike_nthreshold_channels")
             thr = ch_threshold.split(",")
-            common_size = min(len(self.par_tetrode_thresh), len(thr))
+            common_size = min(len(self.thresh_model.values), len(thr))
+            self.thresh_model.set_values(np.arange(common_size), [float(t) for t in thr[:common_size]])
+
+        if cfg.has_option("processing", "auto_threshold_k"):
+            self.par_auto_thresh_k.setValue(cfg.getfloat("processing", "auto_threshold_k"))
+
+        if cfg.has_option("processing", "auto_threshold"):
+            self.par_auto_thresh.setValue(cfg.getboolean("processing", "auto_threshold"))
+
+        if cfg.has_option("processing", "metrics_port"):
+            self.par_metrics_port.setValue(cfg.getint("processing", "metrics_port"))
+
+        if cfg.has_option("processing", "checkpoint_file"):
+            self.par_checkpoint_file.setValue(cfg.get("processing", "checkpoint_file"))
 
-            for par, thr in zip(self.par_tetrode_thresh[:common_size], thr[:common_size]):
-                par.setValue(float(thr))
+        if cfg.has_option("processing", "bandpass"):
+            self.par_bandpass.setValue(cfg.get("processing", "bandpass"))
+
+        if cfg.has_option("processing", "reference"):
+            self.par_reference.setValue(cfg.get("processing", "reference"))
+
+        if cfg.has_option("processing", "reference_group_size"):
+            self.par_reference_group.setValue(cfg.getint("processing", "reference_group_size"))
+
+        if cfg.has_option("processing", "threshold_profiles"):
+            self.par_thresh_profiles.setValue(cfg.get("processing", "threshold_profiles"))
+            self.update_threshold_profiles()
+
+        if cfg.has_option("plot", "displayed_profile"):
+            displayed_profile = cfg.get("plot", "displayed_profile")
+            if displayed_profile in [self.profile_name(f) for f in self.threshold_profiles]:
+                self.par_display_profile.setValue(displayed_profile)
 
         if cfg.has_option("processing", "ttl_trigger_channel"):
             triggerch = cfg.getint("processing", "ttl_trigger_channel")
             self.par_ttl_src.setValue(triggerch)
 
+        if cfg.has_option("processing", "all_trigger_channels"):
+            self.par_all_ttl.setValue(cfg.getboolean("processing", "all_trigger_channels"))
+
         if cfg.has_option("processing", "disabled_channels"):
             disabled = cfg.get("processing", "disabled_channels")
             self.par_disabled_ch.setValue(disabled)
 
+        if cfg.has_option("processing", "spike_source"):
+            spike_source = cfg.get("processing", "spike_source")
+            if spike_source in SPIKE_SOURCES:
+                self.par_spike_source.setValue(spike_source)
+
+        if cfg.has_option("processing", "sorted_unit"):
+            self.par_sorted_unit.setValue(cfg.getint("processing", "sorted_unit"))
+
+        if cfg.has_option("processing", "peth_trials"):
+            self.par_peth_window.setValue(cfg.getint("processing", "peth_trials"))
+
+        if cfg.has_option("processing", "peth_mode"):
+            peth_mode = cfg.get("processing", "peth_mode")
+            if peth_mode in PETH_MODES:
+                self.par_peth_mode.setValue(peth_mode)
+
         self.force_update = True
 
     def onResetParams(self):
@@ -983,6 +1434,8 @@ class GuiClass(object):
         if os.path.isfile(PARAMFNAME):
             os.remove(PARAMFNAME)
         self.init_params(self.paramdock, self.nChannels, reset=True)
+        if self.initiated:
+            self.populate_params()
 
         # todo: self.paramchange should be called but that requires some extra arguments...
         self.update_threshold_levels()
@@ -992,9 +1445,279 @@ class GuiClass(object):
         '''Open new spike analysis window on button press.'''
         self.spikewins.append(SpikeEvalGui(SAMPLES_PER_SEC))
 
+    def onOpenHeatmap(self):
+        '''Open (or bring to front) the PETH heatmap window on button press.'''
+        if self.heatmapwin is None:
+            self.heatmapwin = PethHeatmapGui(self.convert_strlist_to_ints)
+        else:
+            self.heatmapwin.heatmapwin.show()
+            self.heatmapwin.heatmapwin.raise_()
+        self.force_update = True
+
+    def onOpenRaster(self):
+        '''Open (or bring to front) the spike raster window on button press.'''
+        if self.rasterwin is None:
+            self.rasterwin = RasterGui(self.convert_strlist_to_ints)
+        else:
+            self.rasterwin.rasterwin.show()
+            self.rasterwin.rasterwin.raise_()
+
+    def onOpenErp(self):
+        '''Open (or bring to front) the event-triggered average window on button press.'''
+        if self.erpwin is None:
+            self.erpwin = ErpGui(self.convert_strlist_to_ints, self.sampling_rate)
+            self.cp.collector.set_keep_lfp(True)
+        else:
+            self.erpwin.erpwin.show()
+            self.erpwin.erpwin.raise_()
+
+    def onRecord(self):
+        '''Start or stop recording the session to binary files named after the start time
+        (``opeth_YYYYmmdd_HHMMSS.*`` in the working directory, see :mod:`recorder`).'''
+        if self.cp.collector.recorder is None:
+            self.cp.collector.start_recording(time.strftime("opeth_%Y%m%d_%H%M%S"))
+            self.recorder_dropped = 0
+            self.record_btn.setText('Stop rec')
+        else:
+            self.cp.collector.stop_recording()
+            self.record_btn.setText('Record')
+
+    def report_recording(self):
+        '''Warn if the recorder could not keep up with the incoming data since the last check.'''
+        recorder = self.cp.collector.recorder
+        if recorder is None:
+            return
+        stats = recorder.stats()
+        if stats['dropped'] > self.recorder_dropped:
+            logger.warning("Recording: %d packets dropped, max. %d of %d queued" %
+                           (stats['dropped'] - self.recorder_dropped, stats['max_queued'], stats['queue_size']))
+            self.recorder_dropped = stats['dropped']
+        if stats['error'] is not None:
+            logger.error("Recording stopped: %s" % stats['error'])
+            self.cp.collector.stop_recording()
+            self.record_btn.setText('Record')
+
+    def onExport(self):
+        '''Start or stop exporting the trial results and PETH snapshots to binary files named after
+        the start time (``opeth_results_YYYYmmdd_HHMMSS*`` in the working directory, see :mod:`export`).'''
+        if self.exporter is None:
+            if not self.initiated:
+                logger.warning("No data received yet, export not started")
+                return
+            self.exporter = ResultsExporter(time.strftime("opeth_results_%Y%m%d_%H%M%S"),
+                                            self.cp.collector.channel_cnt(), self.sampling_rate,
+                                            self.event_windows, self.threshold_profiles)
+            self.next_export_snapshot = default_timer() + EXPORT_SNAPSHOT_PERIOD
+            self.export_btn.setText('Stop export')
+        else:
+            self.stop_export()
+
+    def stop_export(self):
+        '''Write a final PETH snapshot and close the results export.'''
+        if self.exporter is None:
+            return
+        if self.peths is not None:
+            self.exporter.add_snapshot(self.peths)
+        self.exporter.close()
+        self.exporter = None
+        self.export_btn.setText('Export')
+
+    def update_checkpointer(self):
+        '''Start checkpointing to the file set in the parameters (stop if empty). A recent checkpoint
+        found in the file is offered for restoring (see :meth:`restore_checkpoint`).'''
+        fname = self.par_checkpoint_file.value().strip()
+        if self.checkpointer is not None:
+            if self.checkpointer.fname == fname:
+                return
+            self.save_checkpoint(wait=True)
+        self.checkpointer = Checkpointer(fname) if fname else None
+        self.pending_checkpoint = self.load_checkpoint(fname) if fname else None
+        self.next_checkpoint = default_timer() + CHECKPOINT_PERIOD
+
+    def load_checkpoint(self, fname):
+        '''Load the checkpoint of a previous run (if recent enough).'''
+        start = default_timer()
+        checkpoint = load_checkpoint(fname)
+        if checkpoint is None:
+            return None
+        header, arrays = checkpoint
+        age = time.time() - header['saved']
+        if age > CHECKPOINT_MAX_AGE:
+            logger.info("Checkpoint %s is %d seconds old, not restored" % (fname, age))
+            return None
+        logger.info("Checkpoint %s loaded in %.3f s" % (fname, default_timer() - start))
+        return checkpoint
+
+    def save_checkpoint(self, wait=False):
+        '''Save the histograms, stored spikes, thresholds and histogram settings (see :mod:`checkpoint`).
+
+        State is copied here, the file is written on a background thread unless `wait` is set.
+        '''
+        if self.checkpointer is None or not self.initiated or self.peths is None or self.threshold_levels is None:
+            return
+        if self.pending_checkpoint is not None:
+            return  # the checkpoint in the file is not overwritten before it is restored or declined
+        header = dict(channels=self.nChannels, sampling_rate=int(self.sampling_rate),
+                      roi=[float(t) for t in self.event_roi],
+                      extra_windows=self.par_extra_windows.value(),
+                      threshold_profiles=self.par_thresh_profiles.value(),
+                      spike_source=self.par_spike_source.value(),
+                      sorted_unit=int(self.par_sorted_unit.value()),
+                      peth_mode=self.par_peth_mode.value(),
+                      peth_window=int(self.par_peth_window.value()),
+                      trialcnt=self.eventproc.trialcnt)
+        state = analysis_state(header, self.peths, self.cp.collector.spikestore, self.dataproc,
+                               self.thresh_model.values)
+        if not self.checkpointer.save(state, wait):
+            logger.warning("Checkpoint skipped, previous one still being written")
+
+    def restore_checkpoint(self):
+        '''Offer restoring :attr:`pending_checkpoint`. If accepted, settings and thresholds are applied
+        first (these restart the histograms), then the histograms and stored spikes.'''
+        header, arrays = self.pending_checkpoint
+        self.pending_checkpoint = None
+        if header['channels'] != self.nChannels or header['sampling_rate'] != self.sampling_rate:
+            logger.info("Checkpoint of %d channels at %d Hz does not match the data, not restored" %
+                        (header['channels'], header['sampling_rate']))
+            return
+        answer = QtGui.QMessageBox.question(None, "Restore checkpoint",
+                                            "Restore the histograms of %d triggers saved %d minutes ago to %s?\n"
+                                            "Its settings (ROI, event windows, thresholds, spike source, PETH mode) "
+                                            "replace the current ones." %
+                                            (header['trialcnt'], (time.time() - header['saved']) // 60,
+                                             self.checkpointer.fname),
+                                            QtGui.QMessageBox.Yes | QtGui.QMessageBox.No, QtGui.QMessageBox.No)
+        if answer != QtGui.QMessageBox.Yes:
+            logger.info("Checkpoint %s not restored" % self.checkpointer.fname)
+            return
+        start = default_timer()
+        self.par_ttlroi_before.setValue(header['roi'][0])
+        self.par_ttlroi_after.setValue(header['roi'][1])
+        self.par_extra_windows.setValue(header['extra_windows'])
+        self.par_thresh_profiles.setValue(header['threshold_profiles'])
+        self.par_spike_source.setValue(header['spike_source'])
+        self.par_sorted_unit.setValue(header['sorted_unit'])
+        self.par_peth_mode.setValue(header['peth_mode'])
+        self.par_peth_window.setValue(header['peth_window'])
+        self.thresh_model.set_values(np.arange(self.nChannels), arrays['thresholds'])
+        self.update_threshold_levels()
+        self.clear_plot()
+
+        for idx, name in enumerate(header['windows']):
+            if name in self.peths and tuple(header['peth_modes'][idx]) == (self.peths[name].mode, self.peths[name].window):
+                if not restore_pethset(self.peths[name], 'peth%d_' % idx, arrays):
+                    logger.warning("Histograms of event window %s not restored: size mismatch" % name)
+        self.eventproc.trialcnt = header['trialcnt']
+        restore_spikestore(self.cp.collector.spikestore, arrays['oe_spikes'])
+        restore_detector(self.dataproc, header, arrays)
+        self.force_update = True
+        logger.info("Checkpoint restored (%d triggers) in %.3f s" % (header['trialcnt'], default_timer() - start))
+
+    def dump_flightrec(self, reason, wait=False):
+        '''Dump the flight recorder to ``opeth_flightrec_YYYYmmdd_HHMMSS.npz`` in the working directory.'''
+        self.flightrec.dump(time.strftime("opeth_flightrec_%Y%m%d_%H%M%S.npz"), reason, wait)
+
+    def onDumpFlightrec(self):
+        self.dump_flightrec("manual")
+
+    def timer_update(self):
+        '''Timer slot running :meth:`update`. Exceptions dump the flight recorder (at most once per
+        :data:`FLIGHTREC_DUMP_HOLDOFF` for each exception type) and are raised again, so the default
+        handling of unhandled slot exceptions (abort with PyQt5) is kept.'''
+        try:
+            self.update()
+        except Exception as e:
+            name = type(e).__name__
+            if self.next_exception_dump.get(name, 0) < default_timer():
+                self.next_exception_dump[name] = default_timer() + FLIGHTREC_DUMP_HOLDOFF
+                self.dump_flightrec("exception: %s" % name, wait=True)
+            raise
+
+    def check_flightrec(self):
+        '''Record buffer compactions and overload transitions, dump the flight recorder after a
+        too long display update.'''
+        collector = self.cp.collector
+        for code, buf in enumerate((collector.databuffer, collector.tsbuffer)):
+            if buf is not None and buf.compactions != self.flightrec_compactions[code]:
+                self.flightrec_compactions[code] = buf.compactions
+                self.flightrec.add(KIND_COMPACTION, code, buf.compactions)
+
+        overload = self.frame_time > FLIGHTREC_OVERLOAD_FRAME
+        if overload != self.flightrec_overload:
+            self.flightrec_overload = overload
+            self.flightrec.add(KIND_OVERLOAD, 0, int(overload), self.frame_time)
+
+        if self.frame_time > FLIGHTREC_DUMP_FRAME and self.next_flightrec_dump < default_timer():
+            self.next_flightrec_dump = default_timer() + FLIGHTREC_DUMP_HOLDOFF
+            logger.warning("Display update took %.3f s" % self.frame_time)
+            self.dump_flightrec("frame time %.3f s" % self.frame_time)
+
+    def update_metrics_server(self):
+        '''(Re)start the metrics endpoint on the port set in the parameters, stop it if the port is 0.'''
+        port = self.par_metrics_port.value()
+        if self.metrics_server is not None:
+            if self.metrics_server.port == port:
+                return
+            self.metrics_server.close()
+            self.metrics_server = None
+        if port:
+            try:
+                self.metrics_server = MetricsServer(port)
+            except (IOError, OSError) as e:
+                logger.error("Unable to start the metrics endpoint on port %d: %s" % (port, str(e)))
+            self.next_metrics = default_timer()
+
+    def publish_metrics(self):
+        '''Collect the current metrics into a :class:`metrics.MetricsRegistry` and publish them.'''
+        cp, collector = self.cp, self.cp.collector
+        now = default_timer()
+        last_time, last_messages, last_bytes = self.metrics_last
+        elapsed = max(now - last_time, 1e-6)
+        self.metrics_last = (now, cp.received_messages, cp.received_bytes)
+
+        m = MetricsRegistry()
+        m.counter('messages_total', cp.received_messages, 'Messages received from Open Ephys')
+        m.counter('bytes_total', cp.received_bytes, 'Bytes received from Open Ephys')
+        m.gauge('messages_per_second', (cp.received_messages - last_messages) / elapsed, 'Message rate since the last update')
+        m.gauge('bytes_per_second', (cp.received_bytes - last_bytes) / elapsed, 'Data rate since the last update')
+        m.counter('message_gaps_total', cp.message_gaps, 'Messages missing from the message number sequence')
+        if cp.heartbeat_rtt is not None:
+            m.gauge('heartbeat_rtt_seconds', cp.heartbeat_rtt, 'Round trip time of the last heartbeat')
+        for name, buf in (('databuffer', collector.databuffer), ('tsbuffer', collector.tsbuffer)):
+            if buf is not None:
+                m.gauge('buffer_fill_ratio', len(buf) / float(buf.size()), 'Used fraction of the buffer capacity', buffer=name)
+                m.counter('buffer_compactions_total', buf.compactions, 'Buffer contents moved to the start of the allocation', buffer=name)
+        m.gauge('ttl_queue_depth', len(collector.ttls), 'TTLs waiting for their ROI data')
+        m.counter('triggers_total', self.eventproc.trialcnt, 'Triggers processed since the histograms were cleared')
+        m.gauge('frame_seconds', self.frame_time, 'Duration of the last display update')
+        m.counter('dropped_redraws_total', self.dropped_redraws, 'Histogram redraws skipped by the redraw rate limit')
+        if collector.recorder is not None:
+            m.counter('recorder_dropped_total', collector.recorder.stats()['dropped'], 'Packets dropped by the recorder')
+        if self.exporter is not None:
+            m.counter('export_dropped_total', self.exporter.dropped, 'Records dropped by the results export')
+        for stage, stats in self.trigger_latency.summary().items():
+            m.summary('trigger_latency_seconds', stats, 'Trigger-to-display latency by stage', stage=stage)
+        for stage, stats in sorted(self.timeas.latency_summary().items()):
+            m.summary('stage_latency_seconds', stats, 'Display update stage latencies (if enabled)', stage=stage)
+        self.metrics_server.publish(m)
+
+    def clear_trial_views(self):
+        '''Restart the raster and the event-triggered average, e.g. when a different PETH is displayed.'''
+        if self.rasterwin is not None:
+            self.rasterwin.clear()
+        if self.erpwin is not None:
+            self.erpwin.clear()
+
     def clear_plot(self):
-        ''' Clear all displayed histograms '''
-        self.spike_bin_ms = np.zeros((self.cp.collector.channel_cnt(), self.ttl_range_ms + 1))
+        ''' Clear all histograms (of all event windows and trigger channels) '''
+        nChannels = self.cp.collector.channel_cnt()
+        if self.exporter is not None:
+            # keep the histograms collected since the last snapshot
+            if self.peths is not None:
+                self.exporter.add_snapshot(self.peths)
+            self.exporter.update_windows(self.event_windows, self.threshold_profiles)
+        self.peths = self.eventproc.clear(nChannels, self.par_peth_mode.value(), self.par_peth_window.value())
+        self.clear_trial_views()
         self.force_update = True
 
     def onClearPlot(self):
@@ -1022,8 +1745,11 @@ class GuiClass(object):
             pg.setConfigOption('foreground', 'w')
             self.display_linecolors = LINECOLORS
 
-        # force redrawing the plots to change colours
-        self.update_channelcnt(self.cp.collector.channel_cnt())
+        # recolor the existing plots, full rebuild is only necessary if channel count changes
+        self.apply_theme()
+        self.update_plotcolors()
+        self.update_param_colors()
+        self.force_update = True
 
     def update_histograms(self):
         '''Update displayed histogram plots.
@@ -1047,7 +1773,9 @@ class GuiClass(object):
         spike_bin_ms_disabled = self.spike_bin_ms.copy()
         spike_bin_ms_disabled[self.disabled_channels] = np.zeros((len(self.disabled_channels), spike_bin_ms_disabled.shape[1]))
 
-        for plot_idx, histplot in enumerate(self.histplots):
+        # only the plots of the displayed page are updated
+        for slot, plot_idx in self.visible_plots():
+            histplot = self.histplots[slot]
             if self.par_histcolor.value() == PLOT_AGGREGATE:
                 # In 4 channel case 4 histograms displayed per tetrode:
                 # One summing all 4 channels, one summing only first 3, first 2 and last one containing only ch#1
@@ -1073,7 +1801,8 @@ class GuiClass(object):
                     # clear plot
                     p.setData([0,0], [0])
 
-        for plot_idx, channelplot in enumerate(self.channelplots):
+        for slot, plot_idx in self.visible_plots():
+            channelplot = self.channelplots[slot]
             # Per channel histograms (overlapping -> using lines instead of bars)
             if self.par_histcolor.value() == PLOT_CHANNELS:
                 startid = plot_idx * self.channels_per_plot
@@ -1086,13 +1815,23 @@ class GuiClass(object):
                     # clear plot
                     p.setData([0], [0])
 
+    def split_by_channel(self, channels, values):
+        '''Group spike related values into one list per channel
+        (the layout returned by :meth:`colldata.DataProc.spikedetect`).'''
+        res = [[] for i in range(self.nChannels)]
+        for ch, value in zip(channels, values):
+            if 0 <= ch < self.nChannels:
+                res[ch].append(value)
+        return res
+
     def update_spikewins(self, data_ts, data, spike_ts, spike_pos):
-        '''Perform an update on spike windows.'''
+        '''Perform an update on spike windows (with the threshold of the displayed profile).'''
+        threshold_levels = self.threshold_levels * self.threshold_profiles[self.displayed_profile()]
         for spikewin in self.spikewins:
             if NEGATIVE_THRESHOLD:
-                spikewin.plot(data_ts, data, spike_ts, spike_pos, -self.threshold_levels)
+                spikewin.plot(data_ts, data, spike_ts, spike_pos, -threshold_levels)
             else:
-                spikewin.plot(data_ts, data, spike_ts, spike_pos, self.threshold_levels)
+                spikewin.plot(data_ts, data, spike_ts, spike_pos, threshold_levels)
 
     def update(self, **kwargs):
         ''' 
@@ -1105,8 +1844,6 @@ class GuiClass(object):
         
         * :meth:`comm.CommProcess.timer_callback` to fetch new data
         
-        * :meth:`colldata.Collector.keep_last` to drop old data
-        
         * :meth:`colldata.Collector.process_ttl` to fetch region of interest around TTL
         
         * :meth:`colldata.DataProc.compress` to reduce complexity of the real time plot
@@ -1118,8 +1855,8 @@ class GuiClass(object):
         and updates real time plot data via :attr:`rawdata_curves` and :attr:`ttlraw_curves`
         
         Attributes:
-            spike_bin_ms (2D numpy array): Histogram bins containing one row per channel of spike event 
-                counter bins (accumulating);
+            spike_bin_ms (2D numpy array): Histogram bins of the selected trigger channel containing one
+                row per channel of spike event counter bins (accumulating);
                 first item per row contains the bin corresponding to start of trigger area ( :attr:`event_roi` [0] )
                 and last one to the end ( :attr:`event_roi` [1] )
             data_at_ttl (2D numpy array): Each row contains the same number of samples from different channels
@@ -1146,6 +1883,22 @@ class GuiClass(object):
             self.disabled_channel_update_at = None
             self.par_disabled_ch.setValue(self.disabled_channel_update_to)
 
+        if self.next_recorder_report < default_timer():
+            self.next_recorder_report = default_timer() + RECORDER_REPORT_PERIOD
+            self.report_recording()
+
+        if self.metrics_server is not None and self.next_metrics < default_timer():
+            self.next_metrics = default_timer() + METRICS_PERIOD
+            self.publish_metrics()
+
+        if self.exporter is not None and self.peths is not None and self.next_export_snapshot < default_timer():
+            self.next_export_snapshot = default_timer() + EXPORT_SNAPSHOT_PERIOD
+            self.exporter.add_snapshot(self.peths)
+
+        if self.initiated and self.next_auto_threshold < default_timer():
+            self.next_auto_threshold = default_timer() + AUTO_THRESHOLD_PERIOD
+            self.apply_auto_thresholds()
+
         # statistics
         self.framecnt += 1
 
@@ -1178,8 +1931,8 @@ class GuiClass(object):
                 logger.error("Error in initgraph:" + str(e))
                 traceback.print_exc()
                 exit()
-            self.ttl_range_ms = int(round( (self.event_roi[1] - self.event_roi[0]) / HISTOGRAM_BINSIZE))
-            self.spike_bin_ms = np.zeros((self.cp.collector.channel_cnt(), self.ttl_range_ms + 1))
+            self.update_hist_x()
+            self.clear_plot()
 
 
         # check for possible sampling rate changes
@@ -1189,21 +1942,27 @@ class GuiClass(object):
             logger.info("Detected sampling rate change: %d -> %d" % (self.sampling_rate, new_samprate))
             self.update_samplingrate(new_samprate, clear_plot=True)
 
+        if self.initiated and self.pending_checkpoint is not None:
+            self.restore_checkpoint()
+
+        if self.next_checkpoint < default_timer():
+            self.next_checkpoint = default_timer() + CHECKPOINT_PERIOD
+            self.save_checkpoint()
+
         # wait until threshold params set up...
         if self.threshold_levels is None:
             return
 
-        self.timeas.tic("02-keeplast")
-        # periodic data display
-        self.cp.collector.keep_last(seconds=1)
-        self.timeas.toc("02-keeplast")
-
         self.timeas.tic("03-data")
         data = self.cp.collector.get_data()
         ts = self.cp.collector.get_ts()
         if data is None:
             return
 
+        # periodic data display: buffers may hold more data (for wide event windows) than displayed
+        nsamples = min(len(ts), int(RAWPLOT_LENGTH * self.sampling_rate))
+        data, ts = data[:, -nsamples:], ts[-nsamples:]
+
         dmin, dmax = data.min(), data.max()
         self.plotdistance = max(self.plotdistance, dmax - dmin)
 
@@ -1215,11 +1974,6 @@ class GuiClass(object):
         self.elapsed += default_timer() - start
         self.timeas.toc("03-data")
 
-        if RERECORD:
-            self.datafile.write('----- %d\n' % self.framecnt)
-            for timestamp, datapoint in zip(ts, data[0]):
-                self.datafile.write('%d, %.1f\n' % (timestamp, datapoint))
-
         self.timeas.tic("04-curves")
         for i in range(len(self.rawdata_curves)):
             self.rawdata_curves[i].setData(tscomp, datacomp[i] - 1.5 * i * self.plotdistance)
@@ -1242,37 +1996,43 @@ class GuiClass(object):
         #### TTL processing
         was_new_data = False
         data_ts_roi = None
+        use_oe_spikes = self.par_spike_source.value() == SPIKESRC_OE
+        selected_ttl_ch = self.par_ttl_src.value() - 1
+
+        displayed_window = self.displayed_window()
+        displayed_profile = 0 if use_oe_spikes else self.displayed_profile()
+        profile_thresh_levels = None if use_oe_spikes else self.threshold_profiles.reshape(-1, 1, 1) * thresh_levels
 
         while 1:
             # TTL processing loop: process as many TTLs as present then break.
-
-            self.timeas.tic("05-process_ttl")
-            data_at_ttl, data_ts = self.cp.collector.process_ttl(ttl_ch=self.par_ttl_src.value() - 1,
-                                                                 start_offset=self.event_roi[0],
-                                                                 end_offset=self.event_roi[1],
-                                                                 trigger_holdoff=TRIGGER_HOLDOFF)
-            self.timeas.toc("05-process_ttl")
-
-            #print "TTL SRC:", self.par_ttl_src.value()
-            #print "DATA_at_ttl:", data_at_ttl
-            #if data_at_ttl is not None:
-            #    print "DATA_at_ttl len:", len(data_at_ttl[0])
-            #    print "Data ts: ", data_ts[:2], "...", data_ts[-1]
-            #else:
-            #    print "No DATA"
-            #print "TTL ts", data_ts
-
-            if data_at_ttl is None:
+            # TTLs of all channels are processed if PETHs are collected for each trigger channel.
+            ttl = self.eventproc.next_trial(profile_thresh_levels, self.disabled_channels,
+                                            ttl_ch=None if self.par_all_ttl.value() else selected_ttl_ch,
+                                            unit=self.par_sorted_unit.value(),
+                                            rising_edge=not NEGATIVE_THRESHOLD, holdoff=TRIGGER_HOLDOFF)
+            if ttl is None:
                 break
 
+            if self.exporter is not None:
+                self.exporter.add_trial(ttl, self.eventproc.last_trial)
+
+            if ttl.event_channel != selected_ttl_ch:
+                continue
+
+            self.trigger_latency.binned(ttl)
+
+            win_min, win_max, first_ts, spike_stamps, spike_chs = self.eventproc.last_trial[(displayed_window, displayed_profile)]
+            if self.rasterwin is not None:
+                enabled = ~np.isin(spike_chs, self.disabled_channels)
+                self.rasterwin.add_trial(spike_chs[enabled], (spike_stamps[enabled] - first_ts) / float(self.sampling_rate)
+                                         + self.event_windows[displayed_window][0])
+
+            # raw data around the displayed trigger (for the raw window and the spike windows)
+            data_at_ttl, data_ts = self.cp.collector.roi_data(win_min, win_max)
+
             last_data_at_ttl = data_at_ttl
             last_data_ts = data_ts
 
-            if RERECORD:
-                self.ttlfile.write('----- %d\n' % self.framecnt)
-                for ttlstamp, ttldatapoint in zip(data_ts, data_at_ttl[0]):
-                    self.ttlfile.write('%d, %.1f\n' % (ttlstamp, ttldatapoint))
-
             self.displayed_ttlcnt += 1
 
             if DEBUG:
@@ -1280,34 +2040,27 @@ class GuiClass(object):
 
             if len(data_ts) == 0:
                 return
+            sample_ts = data_ts
             data_ts = data_ts / float(self.sampling_rate) # adjusted to seconds (instead of sample index)
 
             data_ts_0 = data_ts - data_ts[0]    # timestamps starting at 0 for first sample
-            data_ts_roi = data_ts_0 + self.event_roi[0]           # and to the TTL window (-20ms..+50ms)
-
-            self.timeas.tic("06-spikedetect")
-            # todo: check whether spike_ts can be used instead of data_ts[spike_pos[ch]]
+            data_ts_roi = data_ts_0 + self.event_windows[displayed_window][0]  # and to the TTL window (-20ms..+50ms)
 
-            spike_pos, spike_ts = self.dataproc.spikedetect(data_at_ttl, data_ts_roi,
-                                                            threshold=thresh_levels,
-                                                            rising_edge=not NEGATIVE_THRESHOLD,
-                                                            disabled = self.disabled_channels)
+            if self.overlay is not None:
+                self.overlay.add(data_at_ttl, data_ts_roi * 1000)
 
-            # Calculate spike times in millisec from sample positions
-            # and increment the proper histogram bins based on that value.
-            # todo: use vector operations instead of loop? - not a performance bottleneck right now
+            if self.erpwin is not None:
+                # averaged from the decimated (LFP) data
+                lfp, lfp_ts = self.cp.collector.lfp_data(win_min, win_max)
+                self.erpwin.add_trial(lfp, (lfp_ts - ttl.timestamp) / float(self.sampling_rate))
 
-            self.timeas.toc("06-spikedetect")
-            self.timeas.tic("06-spikehist")
-            all_spike_cnt = 0
-            for chnum, poslist in enumerate(spike_pos):
-                for pos in poslist:
-                    ts_binpos = round(data_ts_0[pos] / HISTOGRAM_BINSIZE)
-                    ti_binpos = int(ts_binpos)
-                    self.spike_bin_ms[chnum, ti_binpos] += 1
-                    all_spike_cnt += 1
-
-            self.timeas.toc("06-spikehist")
+            if self.spikewins:
+                # sample positions of the spikes in the ROI (spikes outside the ROI data or in a gap are dropped)
+                pos = np.searchsorted(sample_ts, spike_stamps)
+                found = pos < len(sample_ts)
+                found[found] = sample_ts[pos[found]] == spike_stamps[found]
+                spike_pos = self.split_by_channel(spike_chs[found], pos[found])
+                spike_ts = [list(data_ts_roi[pos]) for pos in spike_pos]
 
             #if all_spike_cnt == 0:
             if DEBUG:
@@ -1328,21 +2081,42 @@ class GuiClass(object):
                 self.earliest_rawttl_plot = default_timer() + 0.5 # update twice per sec
                 #datacomp, tscomp = self.dataproc.compress(last_data_at_ttl, 30, data_ts_roi)
 
+                overlaid = self.overlay.channels if self.overlay is not None else []
                 for i in range(len(self.ttlraw_curves)):
-                    if data_ts_roi is not None:
+                    if data_ts_roi is not None and i not in overlaid:
                         self.ttlraw_curves[i].setData(data_ts_roi * 1000, last_data_at_ttl[i] - 1.5*i*self.plotdistance)
 
+                # last N trials of the selected channels (single curve each) and their mean
+                if self.overlay is not None and self.overlay.count:
+                    for idx, ch in enumerate(self.overlay.channels):
+                        x, y, connect = self.overlay.traces(idx)
+                        self.overlay_curves[idx].setData(x, y - 1.5*ch*self.plotdistance, connect=connect)
+                        x, y = self.overlay.mean(idx)
+                        self.overlay_mean_curves[idx].setData(x, y - 1.5*ch*self.plotdistance)
+                        self.ttlraw_curves[ch].setData([], [])
+
             if self.spikewins:
                 if data_ts_roi is not None:
                     self.update_spikewins(data_ts_roi, last_data_at_ttl, spike_ts, spike_pos)
 
             if default_timer() > self.earliest_hist_plot:
                 self.update_histograms()
+                if self.heatmapwin is not None and self.heatmapwin.heatmapwin.isVisible():
+                    self.heatmapwin.plot(self.spike_bin_ms, self.hist_x, self.disabled_channels)
+                if self.rasterwin is not None and self.rasterwin.rasterwin.isVisible():
+                    self.rasterwin.plot()
+                if self.erpwin is not None and self.erpwin.erpwin.isVisible():
+                    self.erpwin.plot()
+                self.trigger_latency.rendered()
+                if DEBUG:
+                    self.update_debug_latency()
                 self.earliest_hist_plot = default_timer() + 1.0 / self.MAX_PLOT_PER_SEC
-            #else:
-            #    print "Histogram update skipped - too frequent"
+            else:
+                # histogram update skipped - too frequent
+                self.dropped_redraws += 1
         self.timeas.toc("07-plot")
-        self.timeas.toc("full")
+        self.frame_time = self.timeas.toc("full")
+        self.check_flightrec()
 
         if DEBUG_TIMING:
             if self.timing_start + 1 < default_timer():
@@ -1351,6 +2125,14 @@ class GuiClass(object):
                 self.timeas.reset()
                 self.timing_start = default_timer()
 
+        if self.timeas.histograms_enabled and self.next_latency_report < default_timer():
+            self.next_latency_report = default_timer() + LATENCY_REPORT_PERIOD
+            logger.info("Stage latencies since enabled:")
+            self.timeas.dump_latencies(logger)
+            logger.info("Trigger latencies:")
+            for stage, stats in self.trigger_latency.summary().items():
+                logger.info(format_latency(stage, stats))
+
     def onClose(self, event):
         '''Handler for closeEvent of main window (histogram window), should close all other windows 
         before closing the main window.'''
@@ -1366,6 +2148,22 @@ class GuiClass(object):
             for win in self.spikewins:
                 win.close()
 
+        if self.heatmapwin is not None:
+            self.heatmapwin.close()
+
+        if self.rasterwin is not None:
+            self.rasterwin.close()
+
+        if self.erpwin is not None:
+            self.erpwin.close()
+
+        self.cp.collector.stop_recording()
+        self.cp.stop_capture()
+        self.stop_export()
+        self.save_checkpoint(wait=True)
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+
         self.mainwin.closeEvtHnd(event)
 
 # exit on CTRL+C: https://stackoverflow.com/questions/4938723/what-is-the-correct-way-to-make-my-pyqt-application-quit-when-killed-from-the-co
@@ -1384,7 +2182,7 @@ def main():
     signal.signal(signal.SIGINT, sigint_handler) 
 
     timer = QtCore.QTimer()
-    timer.timeout.connect(ui.update)
+    timer.timeout.connect(ui.timer_update)
     timer.start(20)
 
     if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
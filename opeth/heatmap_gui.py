@@ -0,0 +1,147 @@
+import sys
+if sys.version_info.major >= 3:
+    from time import perf_counter as clock
+else:
+    from time import clock
+
+import logging
+import numpy as np
+
+from pyqtgraph.Qt import QtGui, QtCore
+import pyqtgraph as pg
+from pyqtgraph.parametertree import Parameter, ParameterTree
+
+class PethHeatmapGui(object):
+    '''PETH of all channels displayed as a single channels x bins image.
+
+    Meant for dense probes where per-tetrode histogram plots do not scale: a redraw is a
+    single :meth:`pyqtgraph.ImageItem.setImage` call on a preallocated buffer. Channels can
+    be normalized to their own peak and reordered (e.g. by depth according to the probe map).
+    '''
+
+    MAX_PLOT_PER_SEC = 4    #: Heatmap refresh rate limit
+
+    # black - red - yellow - white
+    COLORMAP_POS = [0.0, 0.33, 0.66, 1.0]
+    COLORMAP_COLORS = [(0, 0, 0, 255), (200, 0, 0, 255), (255, 220, 0, 255), (255, 255, 255, 255)]
+
+    MAX_CHANNEL_TICKS = 32  #: Label only every n-th channel above this number of rows
+
+    def __init__(self, parse_channels):
+        '''GUI initialization
+
+        Args:
+            parse_channels (callable): converts a channel list string like ``1-4, 17`` to a list of
+                1-based channel numbers (see :meth:`gui.GuiClass.convert_strlist_to_ints`)
+
+        Attributes:
+            image (2D np.ndarray): Preallocated image buffer, one row per histogram bin, one column per displayed channel
+            order (1D np.ndarray): 0-based channel index of each image column
+        '''
+        self.parse_channels = parse_channels
+        self.image = None
+        self.order = None
+        self.nchannels = 0
+        self.hist_x = None
+
+        self.heatmapwin = QtGui.QWidget()
+        self.heatmapwin.setWindowTitle("PETH heatmap")
+        vbox = QtGui.QVBoxLayout(self.heatmapwin)
+
+        splitter_horiz = QtGui.QSplitter(QtCore.Qt.Horizontal)
+
+        self.plotwidget = pg.PlotWidget(title="Peri-event time histograms")
+        self.plotwidget.setLabel('bottom', 'Spike time rel. to event', units='ms')
+        self.plotwidget.setLabel('left', 'Channel')
+        self.plotwidget.invertY(True)   # first channel of the order on top
+        self.imageitem = pg.ImageItem()
+        self.imageitem.setLookupTable(pg.ColorMap(self.COLORMAP_POS, self.COLORMAP_COLORS).getLookupTable())
+        self.plotwidget.addItem(self.imageitem)
+        splitter_horiz.addWidget(self.plotwidget)
+
+        # right side control panel
+        rightside = QtGui.QWidget()
+        l = QtGui.QVBoxLayout(rightside)
+        rightside.setLayout(l)
+        l.addWidget(QtGui.QLabel("Control Panel"))
+
+        self.heatmapparams = Parameter.create(name='heatmapparams', type='group')
+        self.par_normalize = Parameter.create(name='Normalize per channel', type='bool', value=True)
+        self.par_order = Parameter.create(name='Channel order', type='str', value="")
+        self.heatmapparams.addChild(self.par_normalize)
+        self.heatmapparams.addChild(self.par_order)
+        self.heatmapparams.sigTreeStateChanged.connect(self.onParamChange)
+        t = ParameterTree()
+        t.setParameters(self.heatmapparams, showTop=False)
+        l.addWidget(t)
+
+        splitter_horiz.addWidget(rightside)
+        splitter_horiz.setSizes([30, 10])
+
+        vbox.addWidget(splitter_horiz)
+        self.heatmapwin.setLayout(vbox)
+        self.heatmapwin.show()
+        logger.info("Heatmap win created")
+
+        self.earliest_plot = clock()   #: timestamp until new plot is created to limit update frequency
+
+    def onParamChange(self, param, changes):
+        '''Channel order changes reallocate the image buffer on next plot.'''
+        self.order = None
+        self.earliest_plot = clock()
+
+    def update_layout(self, nchannels, nbins, hist_x):
+        '''Allocate the image buffer and set up axes for the actual channel order and bin count.'''
+        order = [ch - 1 for ch in self.parse_channels(self.par_order.value()) if 0 < ch <= nchannels]
+        self.order = np.array(order if order else range(nchannels), dtype='int64')
+        self.nchannels = nchannels
+        self.image = np.zeros((nbins, len(self.order)), dtype='float32')
+        self.hist_x = hist_x
+
+        # image pixels to ms (x) and channel rows (y)
+        tr = QtGui.QTransform()
+        tr.translate(hist_x[0] * 1000, 0)
+        tr.scale((hist_x[-1] - hist_x[0]) * 1000 / max(nbins, 1), 1)
+        self.imageitem.setTransform(tr)
+
+        step = max(1, len(self.order) // self.MAX_CHANNEL_TICKS)
+        ticks = [(i + 0.5, str(ch + 1)) for i, ch in enumerate(self.order) if i % step == 0]
+        self.plotwidget.getAxis('left').setTicks([ticks])
+
+    def plot(self, bins, hist_x, disabled_channels):
+        '''Redraw the heatmap.
+
+        Args:
+            bins (2D np.ndarray): histogram bins, one row per channel (last bin column is not displayed
+                as for the histogram plots)
+            hist_x (1D np.ndarray): histogram bin edges in seconds
+            disabled_channels (list): 0-based indices of channels to be blanked
+        '''
+        if self.earliest_plot > clock():
+            return
+
+        nbins = bins.shape[1] - 1
+        if (self.order is None or self.nchannels != bins.shape[0] or self.image.shape[0] != nbins
+                or self.hist_x[0] != hist_x[0]):
+            self.update_layout(bins.shape[0], nbins, hist_x)
+
+        # reordered copy into the preallocated buffer (image is bins x channels)
+        np.take(bins[:, :nbins], self.order, axis=0, out=self.image.T, mode='clip')
+        if disabled_channels:
+            self.image[:, np.isin(self.order, disabled_channels)] = 0
+
+        if self.par_normalize.value():
+            peaks = self.image.max(axis=0)
+            np.divide(self.image, peaks, out=self.image, where=peaks > 0)
+            levels = (0, 1)
+        else:
+            levels = (0, max(self.image.max(), 1))
+
+        self.imageitem.setImage(self.image, autoLevels=False, levels=levels)
+        self.earliest_plot = clock() + 1.0 / self.MAX_PLOT_PER_SEC
+
+    def close(self):
+        '''Called when main window is closed.'''
+        self.heatmapwin.close()
+
+logger = logging.getLogger("logger")
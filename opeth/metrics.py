@@ -0,0 +1,124 @@
+'''Runtime metrics (throughput, drops, buffer fill, latencies) published on a local HTTP
+endpoint in the Prometheus text format, so that lab monitoring can scrape several OPETH
+instances (each on its own port)::
+
+    curl http://localhost:9450/metrics
+
+The GUI builds a :class:`MetricsRegistry` snapshot periodically (see :meth:`gui.GuiClass.publish_metrics`)
+from counters kept by the components as plain attributes, and hands the rendered text over
+to :class:`MetricsServer`. The server thread only serves the last published text, so scraping
+never touches or blocks the processing.
+'''
+
+from __future__ import division
+import sys
+if sys.version_info.major >= 3:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+import threading
+import logging
+from collections import OrderedDict
+
+METRICS_HOST = '127.0.0.1'      #: Interface of the metrics endpoint (local only by default)
+METRICS_PREFIX = 'opeth_'       #: Prefix of all metric names
+METRICS_QUANTILES = (('0.5', 'p50'), ('0.95', 'p95'), ('0.99', 'p99'), ('1', 'max'))  #: Summary quantiles
+
+COUNTER, GAUGE, SUMMARY = 'counter', 'gauge', 'summary'
+
+class MetricsRegistry(object):
+    '''A snapshot of metric values with their type and help text.'''
+
+    def __init__(self):
+        self.metrics = OrderedDict()    #: name -> (type, help, list of (labels, value))
+
+    def add(self, kind, name, value, help='', **labels):
+        name = METRICS_PREFIX + name
+        if name not in self.metrics:
+            self.metrics[name] = (kind, help, [])
+        self.metrics[name][2].append((labels, value))
+
+    def counter(self, name, value, help='', **labels):
+        '''Monotonic total, e.g. received bytes.'''
+        self.add(COUNTER, name, value, help, **labels)
+
+    def gauge(self, name, value, help='', **labels):
+        '''Current value, e.g. buffer fill ratio.'''
+        self.add(GAUGE, name, value, help, **labels)
+
+    def summary(self, name, stats, help='', **labels):
+        '''Latency distribution given as :meth:`debug.LatencyHistogram.summary` (seconds).'''
+        self.add(SUMMARY, name, stats, help, **labels)
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        return '{' + ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                              for k, v in sorted(labels.items())) + '}'
+
+    def render(self):
+        '''Prometheus text exposition format.'''
+        lines = []
+        for name, (kind, help, samples) in self.metrics.items():
+            if help:
+                lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for labels, value in samples:
+                if kind == SUMMARY:
+                    for quantile, key in METRICS_QUANTILES:
+                        lines.append('%s%s %r' % (name, self.format_labels(dict(labels, quantile=quantile)),
+                                                  float(value[key])))
+                    lines.append('%s_sum%s %r' % (name, self.format_labels(labels), float(value['mean'] * value['count'])))
+                    lines.append('%s_count%s %d' % (name, self.format_labels(labels), value['count']))
+                else:
+                    lines.append('%s%s %r' % (name, self.format_labels(labels), float(value)))
+        return '\n'.join(lines) + '\n'
+
+class MetricsServer(object):
+    '''HTTP endpoint serving the last published metrics on a background thread.'''
+
+    def __init__(self, port, host=METRICS_HOST):
+        '''
+        Args:
+            port (int): TCP port
+            host (str): interface to listen on
+
+        Raises:
+            socket.error: if the port can not be bound
+        '''
+        self.text = '' #: Last published metrics text
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = server.text.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = HTTPServer((host, port), Handler)
+        self.port = self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="MetricsServer")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Metrics endpoint: http://%s:%d/metrics" % (host, self.port))
+
+    def publish(self, registry):
+        '''Replace the served metrics with a new :class:`MetricsRegistry` snapshot.'''
+        self.text = registry.render()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+logger = logging.getLogger("logger")
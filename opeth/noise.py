@@ -0,0 +1,90 @@
+'''Streaming per-channel noise level estimation for automatic spike thresholds.
+
+Incoming data is decimated and kept in a small per-channel ring ("reservoir") of recent samples.
+The noise level is estimated from the reservoir with the median absolute deviation:
+``sigma = median(|x - median(x)|) / 0.6745``, which is robust against the spikes themselves.
+The estimate is recalculated only after a quarter of the reservoir has been refreshed, so the
+cost per incoming chunk is a strided copy of ``1/decimation`` of the samples.
+'''
+
+from __future__ import division
+import logging
+import numpy as np
+
+NOISE_DECIMATION = 8            #: Every n-th sample is stored in the reservoir
+NOISE_RESERVOIR_SIZE = 8192     #: Samples per channel in the reservoir (~2.2 s at 30 kHz with the default decimation)
+MAD_TO_SIGMA = 0.6745           #: Median absolute deviation of a unit normal distribution
+
+class NoiseEstimator(object):
+    '''Incremental noise level estimator, fed by :meth:`colldata.Collector.add_data`.
+
+    Attributes:
+        sigma (1D np.ndarray): Last per-channel noise estimates (data units, e.g. uV), None until
+            the reservoir is filled for the first time.
+        updates (int): Number of times :attr:`sigma` was recalculated.
+    '''
+
+    def __init__(self, decimation=NOISE_DECIMATION, reservoir_size=NOISE_RESERVOIR_SIZE):
+        '''
+        Args:
+            decimation (int): keep every n-th sample only
+            reservoir_size (int): number of samples kept per channel
+        '''
+        self.decimation = decimation
+        self.reservoir_size = reservoir_size
+        self.reset()
+
+    def reset(self):
+        '''Drop all samples and estimates, e.g. when channel count changes.'''
+        self.reservoir = None
+        self.write_pos = 0      # next write position in the reservoir
+        self.filled = 0         # number of valid samples per channel in the reservoir
+        self.phase = 0          # offset of the next sample to be kept in the next chunk
+        self.fresh = 0          # samples stored since last estimate
+        self.sigma = None
+        self.updates = 0
+
+    def add(self, data):
+        '''Store the decimated samples of a new chunk of data.
+
+        Args:
+            data (2D np.ndarray): one row per channel, one column per sample
+        '''
+        if self.reservoir is None or self.reservoir.shape[0] != data.shape[0]:
+            self.reset()
+            self.reservoir = np.zeros((data.shape[0], self.reservoir_size), dtype=np.float32)
+
+        samples = data[:, self.phase::self.decimation]
+        n = samples.shape[1]
+        self.phase = (self.phase - data.shape[1]) % self.decimation
+        if n == 0:
+            return
+        if n > self.reservoir_size:
+            samples = samples[:, -self.reservoir_size:]
+            n = self.reservoir_size
+
+        # ring write, possibly in two parts when wrapping around
+        first = min(n, self.reservoir_size - self.write_pos)
+        self.reservoir[:, self.write_pos:self.write_pos + first] = samples[:, :first]
+        self.reservoir[:, :n - first] = samples[:, first:]
+        self.write_pos = (self.write_pos + n) % self.reservoir_size
+        self.filled = min(self.filled + n, self.reservoir_size)
+        self.fresh += n
+
+        if self.filled == self.reservoir_size and (self.sigma is None or self.fresh >= self.reservoir_size // 4):
+            self.estimate()
+
+    def estimate(self):
+        '''Recalculate :attr:`sigma` from the reservoir.
+
+        Returns:
+            the per-channel noise estimates.
+        '''
+        valid = self.reservoir[:, :self.filled]
+        deviation = np.abs(valid - np.median(valid, axis=1)[:, np.newaxis])
+        self.sigma = np.median(deviation, axis=1) / MAD_TO_SIGMA
+        self.fresh = 0
+        self.updates += 1
+        return self.sigma
+
+logger = logging.getLogger("logger")
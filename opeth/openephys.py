@@ -55,6 +55,7 @@ class OpenEphysSpikeEvent(object):
         self.threshold = []
         self.color = []
         self.source = 0
+        self.sorted_id = 0
         self.__dict__.update(_d)
         self.data = _data
 
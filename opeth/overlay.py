@@ -0,0 +1,111 @@
+'''Overlay of the raw data of the last trials around the events.
+
+Each incoming ROI is reduced to a fixed number of columns (min/max pairs for the traces,
+means for the running average) before being stored in a preallocated ring of trials, so
+both memory and redraw cost depend only on the number of trials and columns, not on the
+sampling rate or the length of the event window.
+'''
+
+from __future__ import division
+import logging
+import numpy as np
+
+OVERLAY_POINTS = 400        #: Number of columns (approx. plot width in pixels) a ROI is decimated to
+OVERLAY_MAX_TRIALS = 50     #: Upper limit of overlaid trials (bounds redraw cost)
+
+class TrialOverlay(object):
+    '''Ring of min/max decimated ROIs of the selected channels with their running mean.
+
+    Attributes:
+        channels (list): channel indices kept
+        count (int): number of trials in the ring
+        x (1D np.ndarray): time of the min/max points (each column twice)
+        x_mean (1D np.ndarray): time of the mean points (column centers)
+    '''
+
+    def __init__(self, ntrials, channels, npoints=OVERLAY_POINTS):
+        '''
+        Args:
+            ntrials (int): number of trials to overlay (at most :data:`OVERLAY_MAX_TRIALS`)
+            channels (list): channel indices to be displayed
+            npoints (int): number of columns per ROI
+        '''
+        self.ntrials = max(1, min(int(ntrials), OVERLAY_MAX_TRIALS))
+        self.channels = list(channels)
+        self.npoints = npoints
+        self.nsamples = None
+        self.count = 0
+
+    def reset(self, nsamples):
+        '''Allocate the ring for ROIs of a given length.'''
+        nch, n, npoints = len(self.channels), self.ntrials, self.npoints
+        self.nsamples = nsamples
+        self.edges = np.linspace(0, nsamples, npoints + 1).astype('int64')
+        self.starts = np.minimum(self.edges[:-1], nsamples - 1)
+        self.counts = np.maximum(np.diff(self.edges), 1)
+
+        self.minmax = np.zeros((n, nch, 2 * npoints), dtype='float32')
+        self.means = np.zeros((n, nch, npoints))
+        self.mean_sum = np.zeros((nch, npoints))
+        self.write_pos = 0
+        self.count = 0
+
+        # trace separators for single-curve drawing of all trials of a channel
+        self.connect = np.ones(n * 2 * npoints, dtype=bool)
+        self.connect[2 * npoints - 1::2 * npoints] = False
+
+    def add(self, data, data_ts):
+        '''Add the ROI of a new trial.
+
+        Args:
+            data (2D np.ndarray): one row per channel, one column per sample
+            data_ts (1D np.ndarray): time of each sample relative to the event
+        '''
+        if len(data_ts) == 0 or data.shape[0] <= max(self.channels + [0]):
+            return
+        # ROI length may differ by a sample or two between trials, only a real change restarts the ring
+        if self.nsamples is None or abs(data.shape[1] - self.nsamples) > max(2, self.nsamples // 100):
+            self.reset(data.shape[1])
+
+        sel = data[self.channels, :self.nsamples]
+        if sel.shape[1] < self.nsamples:
+            sel = np.pad(sel, ((0, 0), (0, self.nsamples - sel.shape[1])), mode='edge')
+            data_ts = np.pad(data_ts, (0, self.nsamples - len(data_ts)), mode='edge')
+        mins = np.minimum.reduceat(sel, self.starts, axis=1)
+        maxs = np.maximum.reduceat(sel, self.starts, axis=1)
+        means = np.add.reduceat(sel, self.starts, axis=1) / self.counts
+
+        # replace the oldest trial in the ring and in the running sum
+        pos = self.write_pos
+        if self.count == self.ntrials:
+            self.mean_sum -= self.means[pos]
+        else:
+            self.count += 1
+        self.minmax[pos, :, 0::2] = mins
+        self.minmax[pos, :, 1::2] = maxs
+        self.means[pos] = means
+        self.mean_sum += means
+        self.write_pos = (pos + 1) % self.ntrials
+
+        # time axis of the latest trial (ROI length is fixed, start may differ by a sample)
+        col_ts = data_ts[self.starts]
+        self.x = np.repeat(col_ts, 2)
+        self.x_mean = (col_ts + data_ts[np.clip(self.edges[1:] - 1, self.starts, self.nsamples - 1)]) / 2
+
+    def traces(self, idx):
+        '''All overlaid trials of a channel as a single curve.
+
+        Args:
+            idx (int): index in :attr:`channels`
+
+        Returns:
+            x, y, connect arrays for :meth:`pyqtgraph.PlotCurveItem.setData`
+        '''
+        n = self.count * 2 * self.npoints
+        return np.tile(self.x, self.count), self.minmax[:self.count, idx].ravel(), self.connect[:n]
+
+    def mean(self, idx):
+        '''Running mean of the overlaid trials of a channel.'''
+        return self.x_mean, self.mean_sum[idx] / max(self.count, 1)
+
+logger = logging.getLogger("logger")
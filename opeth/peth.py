@@ -0,0 +1,164 @@
+'''Peri-event time histogram accumulation.
+
+A :class:`PethAccumulator` holds the histogram bins of a single PETH (one row per channel),
+while :class:`PethSet` keeps a separate accumulator for each trigger condition (e.g. TTL channel),
+so that PETHs of different conditions are collected in a single pass over the data and the
+displayed one can be switched without reprocessing.
+
+Besides accumulating all trials until cleared, an accumulator can follow slow changes of the
+responses by keeping only the last N trials (:data:`PETH_ROLLING`) or by weighting trials
+with an exponential decay (:data:`PETH_EXPONENTIAL`).
+'''
+
+from __future__ import division
+import logging
+import numpy as np
+
+PETH_CUMULATIVE, PETH_ROLLING, PETH_EXPONENTIAL = 'cumulative', 'last N trials', 'exponential'
+PETH_MODES = [PETH_CUMULATIVE, PETH_ROLLING, PETH_EXPONENTIAL]
+PETH_WINDOW = 100   #: Default number of trials (N) for rolling and exponential (time constant) modes
+
+class PethAccumulator(object):
+    '''Histogram bins of a single PETH.
+
+    Attributes:
+        bins (2D np.ndarray): spike counts, one row per channel, one column per histogram bin
+        trials (float): number of trials (triggers) in :attr:`bins`, for exponential mode the
+            sum of trial weights
+    '''
+
+    def __init__(self, nchannels, nbins, mode=PETH_CUMULATIVE, window=PETH_WINDOW):
+        '''
+        Args:
+            nchannels (int): number of channels (histogram rows)
+            nbins (int): number of histogram bins
+            mode (str): one of :data:`PETH_MODES`
+            window (int): number of trials kept in rolling mode, time constant (in trials) of exponential mode
+        '''
+        self.bins = np.zeros((nchannels, nbins))
+        self.mode = mode
+        self.window = max(1, int(window))
+        self.decay = 1.0 - 1.0 / self.window    #: Weight multiplier of previous trials in exponential mode
+        self.clear()
+
+    def add_trial(self, channels, binpos):
+        '''Add the spikes of a single trial.
+
+        Args:
+            channels (1D int array): channel of each spike
+            binpos (1D int array): histogram bin of each spike (must be valid bin indices)
+        '''
+        if self.mode == PETH_ROLLING:
+            # evict the oldest trial once the ring is full: only its spikes are subtracted
+            if self.trials == self.window:
+                old_channels, old_binpos = self.ring[self.ring_pos]
+                np.subtract.at(self.bins, (old_channels, old_binpos), 1)
+            else:
+                self.trials += 1
+            self.ring[self.ring_pos] = (channels, binpos)
+            self.ring_pos = (self.ring_pos + 1) % self.window
+        elif self.mode == PETH_EXPONENTIAL:
+            self.bins *= self.decay
+            self.trials = self.trials * self.decay + 1
+        else:
+            self.trials += 1
+
+        np.add.at(self.bins, (channels, binpos), 1)
+
+    def clear(self):
+        '''Reset the histogram.'''
+        self.bins[:] = 0
+        self.trials = 0
+        self.ring = [None] * self.window if self.mode == PETH_ROLLING else None  #: Spikes of the last trials (rolling mode)
+        self.ring_pos = 0
+
+class PethSet(object):
+    '''A collection of :class:`PethAccumulator` instances of the same size keyed by trigger
+    condition, an accumulator is created on first access of its key.'''
+
+    def __init__(self, nchannels, nbins, mode=PETH_CUMULATIVE, window=PETH_WINDOW):
+        '''
+        Args:
+            nchannels (int): number of channels (histogram rows)
+            nbins (int): number of histogram bins
+            mode (str): accumulation mode, see :class:`PethAccumulator`
+            window (int): trial count parameter of the accumulation mode
+        '''
+        self.nchannels = nchannels
+        self.nbins = nbins
+        self.mode = mode
+        self.window = window
+        self.peths = {}
+
+    def __getitem__(self, key):
+        if key not in self.peths:
+            self.peths[key] = PethAccumulator(self.nchannels, self.nbins, self.mode, self.window)
+        return self.peths[key]
+
+    def __contains__(self, key):
+        return key in self.peths
+
+    def keys(self):
+        '''Conditions collected so far.'''
+        return sorted(self.peths.keys())
+
+    def clear(self):
+        '''Reset all histograms.'''
+        for peth in self.peths.values():
+            peth.clear()
+
+class RasterStore(object):
+    '''Fixed capacity columnar store of raster dots (trial index, channel, offset) records.
+
+    Records are kept in a ring: once :attr:`capacity` is reached the oldest trials are overwritten,
+    so memory use is bounded regardless of the number of trials.
+
+    Attributes:
+        trial (1D np.ndarray): trial index of each record
+        channel (1D np.ndarray): channel of each record
+        offset (1D np.ndarray): spike time relative to the event in seconds
+        next_trial (int): index of the next trial to be added
+    '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.trial = np.zeros(capacity, dtype='int64')
+        self.channel = np.zeros(capacity, dtype='int32')
+        self.offset = np.zeros(capacity, dtype='float32')
+        self.clear()
+
+    def clear(self):
+        '''Drop all records.'''
+        self.write_pos = 0
+        self.count = 0
+        self.next_trial = 0
+
+    def add_trial(self, channels, offsets):
+        '''Append the spikes of a new trial.
+
+        Args:
+            channels (1D int array): channel of each spike
+            offsets (1D array): spike times relative to the event in seconds
+
+        Returns:
+            ring positions of the new records (1D int array)
+        '''
+        channels = np.asarray(channels)[-self.capacity:]
+        offsets = np.asarray(offsets)[-self.capacity:]
+        positions = (self.write_pos + np.arange(len(channels))) % self.capacity
+        self.trial[positions] = self.next_trial
+        self.channel[positions] = channels
+        self.offset[positions] = offsets
+
+        self.write_pos = (self.write_pos + len(channels)) % self.capacity
+        self.count = min(self.count + len(channels), self.capacity)
+        self.next_trial += 1
+        return positions
+
+    def valid(self):
+        '''Boolean mask of the ring positions holding records.'''
+        mask = np.zeros(self.capacity, dtype=bool)
+        mask[:self.count] = True
+        return mask
+
+logger = logging.getLogger("logger")
@@ -24,6 +24,12 @@ class ChannelParameterItem(WidgetParameterItem):
     def colorChange(self):
         pass # todo: color adjustment support
 
+    def optsChanged(self, param, opts):
+        '''Follow color changes of the channel (e.g. theme change) without recreating the item.'''
+        WidgetParameterItem.optsChanged(self, param, opts)
+        if 'color' in opts and hasattr(self, 'colorBtn'):
+            self.colorBtn.setColor(opts['color'])
+
     def makeWidget(self):
         '''Extended SimpleParameter widget - float values only, additionally displaying 
         corresponding channel's color.
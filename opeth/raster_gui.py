@@ -0,0 +1,152 @@
+import sys
+if sys.version_info.major >= 3:
+    from time import perf_counter as clock
+else:
+    from time import clock
+
+import logging
+import numpy as np
+
+from pyqtgraph.Qt import QtGui, QtCore
+import pyqtgraph as pg
+from pyqtgraph.parametertree import Parameter, ParameterTree
+
+from opeth.peth import RasterStore
+
+class RasterGui(object):
+    '''Per-trial spike raster (trial x time dots) of a group of channels.
+
+    Spikes of the displayed PETH are kept in a fixed capacity :class:`peth.RasterStore`.
+    Display coordinates are kept in arrays aligned with the store ring and are calculated only
+    for the new records of each trial, or for the whole ring when the channel selection changes.
+    The ring is split into :attr:`SEGMENTS` equal parts drawn by separate scatter items, and only
+    the segments written since the last redraw are updated (new trials overwrite the oldest ones
+    in the same segments), so redraw cost does not grow with the raster size.
+    '''
+
+    MAX_PLOT_PER_SEC = 4    #: Raster refresh rate limit
+    CAPACITY = 50000        #: Number of spikes kept, older trials are evicted
+    DOTSIZE = 3             #: Dot size in pixels
+    SEGMENTS = 16           #: Number of separately drawn parts of the ring
+
+    def __init__(self, parse_channels):
+        '''GUI initialization
+
+        Args:
+            parse_channels (callable): converts a channel list string like ``1-4`` to a list of
+                1-based channel numbers (see :meth:`gui.GuiClass.convert_strlist_to_ints`)
+
+        Attributes:
+            store (peth.RasterStore): Spikes of the last trials
+            x, y (1D np.ndarray): Dot coordinates (ms, trial row) aligned with :attr:`store`
+            shown (1D np.ndarray): Records on the selected channels
+            dirty_segments (set): Ring segments changed since the last redraw
+        '''
+        self.parse_channels = parse_channels
+        self.store = RasterStore(self.CAPACITY)
+        self.x = np.zeros(self.CAPACITY, dtype='float32')
+        self.y = np.zeros(self.CAPACITY, dtype='float32')
+        self.shown = np.zeros(self.CAPACITY, dtype=bool)
+        self.row_of_channel = None
+        self.segment_size = -(-self.CAPACITY // self.SEGMENTS)
+        self.dirty_segments = set()
+
+        self.rasterwin = QtGui.QWidget()
+        self.rasterwin.setWindowTitle("Spike raster")
+        vbox = QtGui.QVBoxLayout(self.rasterwin)
+
+        splitter_horiz = QtGui.QSplitter(QtCore.Qt.Horizontal)
+
+        self.plotwidget = pg.PlotWidget(title="Spikes of each trial")
+        self.plotwidget.setLabel('bottom', 'Spike time rel. to event', units='ms')
+        self.plotwidget.setLabel('left', 'Trial')
+        self.scatters = []
+        for i in range(self.SEGMENTS):
+            scatter = pg.ScatterPlotItem(size=self.DOTSIZE, pen=None, brush=pg.mkBrush(255, 255, 255, 200), pxMode=True)
+            self.plotwidget.addItem(scatter)
+            self.scatters.append(scatter)
+        splitter_horiz.addWidget(self.plotwidget)
+
+        # right side control panel
+        rightside = QtGui.QWidget()
+        l = QtGui.QVBoxLayout(rightside)
+        rightside.setLayout(l)
+        l.addWidget(QtGui.QLabel("Control Panel"))
+
+        self.rasterparams = Parameter.create(name='rasterparams', type='group')
+        self.par_channels = Parameter.create(name='Channels', type='str', value="1-4")
+        self.rasterparams.addChild(self.par_channels)
+        self.rasterparams.sigTreeStateChanged.connect(self.onParamChange)
+        t = ParameterTree()
+        t.setParameters(self.rasterparams, showTop=False)
+        l.addWidget(t)
+
+        splitter_horiz.addWidget(rightside)
+        splitter_horiz.setSizes([30, 10])
+
+        vbox.addWidget(splitter_horiz)
+        self.rasterwin.setLayout(vbox)
+        self.rasterwin.show()
+        logger.info("Raster win created")
+
+        self.update_channels()
+        self.earliest_plot = clock()   #: timestamp until new plot is created to limit update frequency
+
+    def onParamChange(self, param, changes):
+        self.update_channels()
+
+    def update_channels(self):
+        '''Recalculate display coordinates of all stored records for a new channel selection.'''
+        channels = [ch - 1 for ch in self.parse_channels(self.par_channels.value()) if ch > 0]
+        self.nrows = max(1, len(channels))
+        self.row_of_channel = -np.ones(max(channels + [0]) + 1, dtype='int64')
+        self.row_of_channel[channels] = np.arange(len(channels))
+
+        self.update_coords(np.flatnonzero(self.store.valid()))
+        self.dirty_segments.update(range(self.SEGMENTS))
+
+    def update_coords(self, positions):
+        '''Display coordinates of the records at the given ring positions.'''
+        channel = self.store.channel[positions]
+        known = channel < len(self.row_of_channel)
+        row = np.where(known, self.row_of_channel[np.where(known, channel, 0)], -1)
+        self.shown[positions] = row >= 0
+        self.x[positions] = self.store.offset[positions] * 1000
+        # channels of a trial are stacked within the trial's row
+        self.y[positions] = self.store.trial[positions] + row / float(self.nrows)
+        if len(positions):
+            self.dirty_segments.update(np.unique(positions // self.segment_size).tolist())
+
+    def clear(self):
+        '''Drop all trials (e.g. when histograms are cleared).'''
+        self.store.clear()
+        self.shown[:] = False
+        self.dirty_segments.update(range(self.SEGMENTS))
+
+    def add_trial(self, channels, offsets):
+        '''Add the spikes of the displayed PETH of a new trial.
+
+        Args:
+            channels (1D int array): channel of each spike
+            offsets (1D array): spike times relative to the event in seconds
+        '''
+        positions = self.store.add_trial(channels, offsets)
+        self.update_coords(positions)
+
+    def plot(self):
+        '''Redraw the segments changed since last update.'''
+        if not self.dirty_segments or self.earliest_plot > clock():
+            return
+
+        for segment in self.dirty_segments:
+            part = slice(segment * self.segment_size, (segment + 1) * self.segment_size)
+            shown = self.shown[part]
+            self.scatters[segment].setData(x=self.x[part][shown], y=self.y[part][shown])
+        self.dirty_segments.clear()
+        self.earliest_plot = clock() + 1.0 / self.MAX_PLOT_PER_SEC
+
+    def close(self):
+        '''Called when main window is closed.'''
+        self.rasterwin.close()
+
+logger = logging.getLogger("logger")
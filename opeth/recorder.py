@@ -0,0 +1,259 @@
+'''Binary recording of the incoming session: raw data chunks, sample timestamps and events.
+
+Data packets are queued by the receiving code (:meth:`colldata.Collector.add_data`) and written
+to disk by a background thread, so disk latency does not delay data processing or display.
+The queue is bounded: if the disk can not keep up, new packets are dropped and counted
+(see :meth:`SessionRecorder.stats`) instead of blocking the caller or growing memory without limit.
+Gaps are visible in the recorded timestamps.
+
+A recording named ``base`` consists of
+
+* ``base.dat``: float32 samples (uV), one row of all channels per sample (``(nsamples, nchannels)``),
+* ``base.ts``: int64 timestamp (sample index) of each sample,
+* ``base.events``: table of :data:`EVENT_DTYPE` records (TTL rising edges, Open Ephys spikes),
+* ``base.json``: channel count, sampling rate and record counts.
+
+Files are preallocated in large steps during recording and truncated to the recorded size
+when the recording is closed. The header is rewritten every :data:`RECORDER_HEADER_PERIOD`
+seconds with the record counts already flushed to disk, so after a crash the recording
+is readable up to the last header update (the zero-filled preallocated tail is ignored).
+They are flat binary arrays, :func:`load_recording` maps them into memory without reading them.
+'''
+
+from __future__ import division
+import sys
+if sys.version_info.major >= 3:
+    import queue
+else:
+    import Queue as queue
+
+import os
+import json
+from timeit import default_timer
+import threading
+import logging
+import numpy as np
+
+RECORDER_QUEUE_SIZE = 1000          #: Number of packets waiting for the writer thread before dropping new ones
+RECORDER_PREALLOC_SECONDS = 60      #: File space allocated at once (seconds of data)
+RECORDER_HEADER_PERIOD = 5.0        #: Header (record counts) update period during recording in seconds
+
+EVENT_TTL, EVENT_SPIKE = 1, 2       #: Event kinds in the event table
+
+EVENT_DTYPE = np.dtype([('timestamp', '<i8'), ('kind', '<i4'), ('channel', '<i4'),
+                        ('event_id', '<i4'), ('unit', '<i4')])  #: Event table record
+
+DATA_DTYPE = np.dtype('<f4')
+TS_DTYPE = np.dtype('<i8')
+
+class PreallocatedFile(object):
+    '''Sequentially written binary file allocated in large steps, truncated to the written size on close.'''
+
+    def __init__(self, path, step):
+        '''
+        Args:
+            path (str): file name, existing files are overwritten
+            step (int): allocation step in bytes
+        '''
+        self.file = open(path, 'w+b')
+        self.step = max(1, int(step))
+        self.allocated = 0
+        self.written = 0
+
+    def write(self, arr):
+        '''Append the bytes of a contiguous array.'''
+        nbytes = arr.nbytes
+        if self.written + nbytes > self.allocated:
+            self.allocated = self.written + nbytes + self.step
+            fallocate = getattr(os, 'posix_fallocate', None)
+            if fallocate is not None:
+                fallocate(self.file.fileno(), 0, self.allocated)
+            else:
+                self.file.truncate(self.allocated)
+        arr.tofile(self.file)
+        self.written += nbytes
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.truncate(self.written)
+        self.file.close()
+
+class SessionRecorder(object):
+    '''Records data packets, timestamps and events to binary files on a writer thread.
+
+    Attributes:
+        basename (str): path of the recording without extension
+        channels (int): number of channels, set by the first data packet
+        samples (int): number of samples written
+        events (int): number of events written
+        dropped (int): number of packets (data or events) dropped because the queue was full
+        error (str): message of the write error that stopped the recording, None if OK
+        max_queued (int): highest number of packets waiting in the queue (backpressure indicator)
+    '''
+
+    def __init__(self, basename, sampling_rate, queue_size=RECORDER_QUEUE_SIZE):
+        '''Create the files and start the writer thread.
+
+        Args:
+            basename (str): path of the recording without extension
+            sampling_rate (int): sampling rate stored in the header
+            queue_size (int): number of packets buffered for the writer thread
+        '''
+        self.basename = basename
+        self.sampling_rate = sampling_rate
+        self.channels = 0
+        self.samples = 0
+        self.events = 0
+        self.dropped = 0
+        self.max_queued = 0
+        self.error = None
+        self.datafile = None
+        self.tsfile = None
+        self.eventfile = PreallocatedFile(basename + '.events', EVENT_DTYPE.itemsize * 4096)
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.writer, name="SessionRecorder")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Recording to %s.*" % basename)
+
+    def put(self, item):
+        '''Queue a packet without blocking, count it as dropped if the queue is full.'''
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.max_queued = max(self.max_queued, self.queue.qsize())
+
+    def add_data(self, data, first_ts):
+        '''Queue a data packet.
+
+        Args:
+            data (2D np.ndarray): one row per channel, one column per sample (uV). Read-only
+                arrays (as received from the network) are queued without copying.
+            first_ts (int): timestamp of the first sample
+        '''
+        if data.flags.writeable:
+            data = data.copy()
+        self.put((data, first_ts))
+
+    def add_event(self, timestamp, kind, channel, event_id=0, unit=0):
+        '''Queue an event (e.g. :data:`EVENT_TTL` with channel and event ID, :data:`EVENT_SPIKE` with channel and unit).'''
+        self.put((None, (timestamp, kind, channel, event_id, unit)))
+
+    def stats(self):
+        '''Backpressure report.
+
+        Returns:
+            dict with the current (``queued``) and highest (``max_queued``) queue length, the queue
+            capacity (``queue_size``), ``dropped`` packets, the ``samples`` and ``events`` written
+            and the write ``error`` if any
+        '''
+        return dict(queued=self.queue.qsize(), max_queued=self.max_queued, queue_size=self.queue.maxsize,
+                    dropped=self.dropped, samples=self.samples, events=self.events, error=self.error)
+
+    def writer(self):
+        '''Writer thread: writes queued packets until the None sentinel of :meth:`close` arrives,
+        updates the header periodically.'''
+        next_header = default_timer() + RECORDER_HEADER_PERIOD
+        while True:
+            try:
+                item = self.queue.get(timeout=max(0.01, next_header - default_timer()))
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if self.error is not None:
+                continue    # keep draining the queue so that callers are never blocked
+            try:
+                if item:
+                    data, info = item
+                    if data is None:
+                        self.eventfile.write(np.array([info], dtype=EVENT_DTYPE))
+                        self.events += 1
+                    else:
+                        self.write_data(data, info)
+                if default_timer() >= next_header:
+                    next_header = default_timer() + RECORDER_HEADER_PERIOD
+                    self.flush()
+            except (IOError, OSError) as e:
+                self.error = str(e)
+                logger.error("Recording %s stopped: %s" % (self.basename, self.error))
+        self.close_files()
+
+    def write_data(self, data, first_ts):
+        '''Append a data packet to the data and timestamp files (called on the writer thread).'''
+        if self.datafile is None:
+            self.channels = data.shape[0]
+            step = RECORDER_PREALLOC_SECONDS * self.sampling_rate
+            self.datafile = PreallocatedFile(self.basename + '.dat', step * self.channels * DATA_DTYPE.itemsize)
+            self.tsfile = PreallocatedFile(self.basename + '.ts', step * TS_DTYPE.itemsize)
+            self.write_header()
+        elif data.shape[0] != self.channels:
+            logger.warning("Recording: packet of %d channels dropped (recording %d channels)" %
+                           (data.shape[0], self.channels))
+            self.dropped += 1
+            return
+        self.datafile.write(np.ascontiguousarray(data.T, dtype=DATA_DTYPE))
+        self.tsfile.write(np.arange(first_ts, first_ts + data.shape[1], dtype=TS_DTYPE))
+        self.samples += data.shape[1]
+
+    def write_header(self):
+        header = dict(channels=self.channels, sampling_rate=self.sampling_rate, samples=self.samples,
+                      events=self.events, dropped=self.dropped, data_dtype=DATA_DTYPE.str, ts_dtype=TS_DTYPE.str,
+                      event_dtype=EVENT_DTYPE.descr)
+        # replaced atomically, a crash while writing leaves the previous header
+        tmpname = self.basename + '.json.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(header, f, indent=1)
+        if sys.platform.startswith('win') and os.path.exists(self.basename + '.json'):
+            os.remove(self.basename + '.json')
+        os.rename(tmpname, self.basename + '.json')
+
+    def flush(self):
+        '''Flush the files, then record their sizes in the header (called on the writer thread).'''
+        for f in (self.datafile, self.tsfile, self.eventfile):
+            if f is not None:
+                f.flush()
+        self.write_header()
+
+    def close_files(self):
+        for f in (self.datafile, self.tsfile, self.eventfile):
+            if f is not None:
+                f.close()
+        self.write_header()
+
+    def close(self):
+        '''Write the packets still queued, stop the writer thread and close the files.'''
+        self.queue.put(None)
+        self.thread.join()
+        logger.info("Recording %s closed: %d samples, %d events, %d dropped packets, max. %d queued" %
+                    (self.basename, self.samples, self.events, self.dropped, self.max_queued))
+
+def load_recording(basename):
+    '''Map a recording into memory.
+
+    Args:
+        basename (str): path of the recording without extension
+
+    Returns:
+        header (dict), data (2D memmap, samples x channels), timestamps (1D memmap), events (1D memmap of :data:`EVENT_DTYPE`)
+    '''
+    with open(basename + '.json') as f:
+        header = json.load(f)
+
+    def mapped(ext, dtype, shape):
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(basename + ext, dtype=dtype, mode='r', shape=shape)
+
+    n = header['samples']
+    data = mapped('.dat', DATA_DTYPE, (n, max(header['channels'], 1)))
+    timestamps = mapped('.ts', TS_DTYPE, (n,))
+    events = mapped('.events', EVENT_DTYPE, (header['events'],))
+    return header, data, timestamps, events
+
+logger = logging.getLogger("logger")
@@ -0,0 +1,187 @@
+'''Offline replay of a recorded session (see :mod:`recorder`) faster than real time.
+
+The recording is memory-mapped and fed in packets to a :class:`colldata.Collector` directly
+(no ZMQ/JSON decoding), triggers are processed by the same :class:`eventproc.EventProcessor`
+as in the GUI, so a session can be reprocessed e.g. with new thresholds as fast as the CPU allows.
+
+Example::
+
+    from opeth.replay import Replay
+    replay = Replay('opeth_20200101_120000')
+    peths = replay.run(thresholds=40e-6)
+    bins = peths['main'][(0, 0)].bins    # first trigger channel, first threshold profile
+'''
+
+from __future__ import division
+import sys
+if sys.version_info.major >= 3:
+    from time import perf_counter as clock
+else:
+    from time import clock
+
+import logging
+import numpy as np
+from collections import OrderedDict
+
+from .colldata import Collector, DataProc, DATA_RETENTION, EVENT_ROI
+from .openephys import OpenEphysEvent, OpenEphysSpikeEvent
+from .recorder import load_recording, EVENT_TTL, EVENT_SPIKE
+from .eventproc import EventProcessor, MAIN_WINDOW, TRIGGER_HOLDOFF
+from .peth import PETH_CUMULATIVE, PETH_WINDOW
+
+REPLAY_PACKET = 640         #: Samples per replayed data packet (as sent by Open Ephys)
+REPLAY_GAP_BLOCK = 1 << 20  #: Timestamps read at once when looking for gaps (limits memory use of long recordings)
+VOLT_TO_UVOLT_MULTIPLIER = 1000000
+
+class Replay(object):
+    '''Replays a recording into a new collector, detector and event processor.
+
+    Attributes:
+        header (dict): recording header (channels, sampling rate, ...)
+        data (2D np.memmap): recorded samples, one row per sample
+        timestamps (1D np.memmap): timestamp of each sample
+        events (1D np.memmap): recorded TTL and spike events
+        collector (colldata.Collector): data storage of the replay
+        dataproc (colldata.DataProc): spike detector
+        eventproc (eventproc.EventProcessor): trigger processing and PETHs
+        stats (dict): results of the last :meth:`run`: ``samples``, ``trials``, recorded ``duration``
+            and ``elapsed`` time in seconds, ``speedup`` over real time
+    '''
+
+    def __init__(self, basename, event_windows=None, drop_aux=True):
+        '''
+        Args:
+            basename (str): recording path without extension
+            event_windows (OrderedDict): event window name -> [start, end] in seconds,
+                defaults to :data:`eventproc.MAIN_WINDOW` with :data:`colldata.EVENT_ROI`
+            drop_aux (bool): drop the AUX channels of 35/70 channel recordings (see :meth:`colldata.Collector.add_data`)
+        '''
+        self.load(basename)
+        self.event_windows = event_windows if event_windows is not None else OrderedDict([(MAIN_WINDOW, list(EVENT_ROI))])
+        self.drop_aux = drop_aux
+        self.stats = {}
+
+    def load(self, basename):
+        '''Map the recording into memory (sets :attr:`header`, :attr:`data`, :attr:`timestamps` and :attr:`events`).'''
+        self.header, self.data, self.timestamps, self.events = load_recording(basename)
+
+    def packet_data(self, start, end):
+        '''Data of a packet as received by :meth:`colldata.Collector.add_data` (channels x samples, uV).'''
+        return np.asarray(self.data[start:end]).T
+
+    def reset(self, band=None, reference=None, group_size=0):
+        '''Create a new collector, detector and event processor (prefilter arguments: see
+        :meth:`colldata.Collector.set_prefilter`).'''
+        sampling_rate = self.header['sampling_rate']
+        self.collector = Collector()
+        self.collector.keep_lfp = False     # not used by the trigger processing
+        self.collector.set_sampling_rate(sampling_rate)
+        self.dataproc = DataProc(self.collector, self.drop_aux)
+        self.dataproc.set_sampling_rate(sampling_rate)
+        self.eventproc = EventProcessor(self.collector, self.dataproc, self.event_windows)
+        start, end = self.eventproc.union_window()
+        self.collector.set_retention(max(DATA_RETENTION, end - start + 1))
+        if band is not None or reference is not None:
+            self.collector.set_prefilter(band, reference, group_size)
+
+    def packets(self, packet=REPLAY_PACKET, block=REPLAY_GAP_BLOCK):
+        '''Yield ``(start, end)`` sample ranges of the replayed packets, a packet does not span a gap
+        (dropped data) in the recorded timestamps. Gaps are searched block by block while streaming,
+        so memory use does not depend on the recording length.'''
+        n = len(self.timestamps)
+        start = 0
+        for block_start in range(0, n, block):
+            block_end = min(block_start + block, n)
+            # timestamps of the block, preceded by the last one of the previous block
+            ts = np.asarray(self.timestamps[max(block_start - 1, 0):block_end])
+            gaps = np.flatnonzero(np.diff(ts) != 1) + max(block_start, 1)
+            for seg_end in gaps:
+                for pos in range(start, seg_end, packet):
+                    yield pos, min(pos + packet, seg_end)
+                start = seg_end
+            # full packets of the block, the rest is continued in the next block
+            limit = block_end if block_end == n else block_end - packet + 1
+            while start < limit:
+                yield start, min(start + packet, block_end)
+                start += packet
+
+    def run(self, thresholds=None, profiles=(1.0,), disabled_channels=[], ttl_ch=None, unit=0,
+            rising_edge=False, peth_mode=PETH_CUMULATIVE, peth_window=PETH_WINDOW, packet=REPLAY_PACKET,
+            on_trial=None, **prefilter):
+        '''Replay the whole recording and collect the PETHs of all triggers.
+
+        Args:
+            thresholds (float or 1D array): spike threshold (V, absolute value) for all or for each channel,
+                None to use the spikes recorded from Open Ephys
+            profiles (sequence): threshold multipliers, one PETH set per profile
+            disabled_channels (list): channels (0-based) excluded from detection and the histograms
+            ttl_ch (int): trigger channel (0-based) to be processed, None for all channels
+            unit (int): sorted unit of OE spikes (0: all)
+            rising_edge (bool): detect positive threshold crossings instead of negative ones
+            peth_mode, peth_window: PETH accumulation, see :class:`peth.PethAccumulator`
+            packet (int): samples per replayed data packet
+            on_trial (callable): called with the TTL event after each processed trigger, the spikes of the
+                trigger are in :attr:`eventproc.EventProcessor.last_trial`
+            prefilter: `band`, `reference`, `group_size` passed to :meth:`colldata.Collector.set_prefilter`
+
+        Returns:
+            the PETHs (:attr:`eventproc.EventProcessor.peths`, window name -> :class:`peth.PethSet`)
+        '''
+        self.reset(**prefilter)
+        level_sets = None
+        if thresholds is not None:
+            nch = self.header['channels']
+            if self.drop_aux and nch in (35, 70):
+                nch = nch // 35 * 32
+            levels = np.broadcast_to(np.asarray(thresholds, dtype=float), (nch,)).reshape(nch, 1) * VOLT_TO_UVOLT_MULTIPLIER
+            if not rising_edge:
+                levels = -levels
+            level_sets = np.asarray(profiles, dtype=float).reshape(-1, 1, 1) * levels
+
+        events = self.events
+        event_order = np.argsort(events['timestamp'], kind='mergesort')
+        next_event = 0
+
+        start_time = clock()
+        samples = 0
+        for start, end in self.packets(packet):
+            self.collector.update_ts(int(self.timestamps[start]))
+            self.collector.add_data(self.packet_data(start, end))
+            samples += int(end - start)
+            if self.eventproc.peths is None:
+                self.eventproc.clear(self.collector.channel_cnt(), peth_mode, peth_window)
+
+            # events up to the end of the packet
+            last_ts = self.timestamps[end - 1]
+            while next_event < len(event_order) and events['timestamp'][event_order[next_event]] <= last_ts:
+                self.add_event(events[event_order[next_event]])
+                next_event += 1
+
+            while 1:
+                ttl = self.eventproc.next_trial(level_sets, disabled_channels, ttl_ch=ttl_ch, unit=unit,
+                                                rising_edge=rising_edge, holdoff=TRIGGER_HOLDOFF)
+                if ttl is None:
+                    break
+                if on_trial is not None:
+                    on_trial(ttl)
+
+        elapsed = clock() - start_time
+        duration = samples / float(self.header['sampling_rate'])
+        self.stats = dict(samples=samples, trials=self.eventproc.trialcnt, duration=duration, elapsed=elapsed,
+                          speedup=duration / elapsed if elapsed > 0 else float('inf'))
+        logger.info("Replayed %.1f s (%d triggers) in %.2f s: %.1fx real time" %
+                    (duration, self.stats['trials'], elapsed, self.stats['speedup']))
+        return self.eventproc.peths
+
+    def add_event(self, event):
+        '''Pass a recorded event to the collector as if it was received from Open Ephys.'''
+        if event['kind'] == EVENT_TTL:
+            ttl = OpenEphysEvent({'type': 3, 'event_id': int(event['event_id']),
+                                  'event_channel': int(event['channel']), 'timestamp': int(event['timestamp'])})
+            self.collector.add_ttl(ttl)
+        elif event['kind'] == EVENT_SPIKE:
+            spike = OpenEphysSpikeEvent({'timestamp': int(event['timestamp']), 'channel': int(event['channel']),
+                                         'sorted_id': int(event['unit'])})
+            self.collector.add_spike(spike)
+
+logger = logging.getLogger("logger")
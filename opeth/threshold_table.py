@@ -0,0 +1,170 @@
+'''Table based per-channel threshold editor.
+
+Thresholds of all channels are kept in a single NumPy array (:attr:`ThresholdModel.values`)
+shown through a Qt table model instead of one parameter widget per channel, so the editor
+stays fast with hundreds of channels. Bulk operations work on the selected rows (or on all
+channels if nothing is selected) and result in a single change notification listing only
+the modified channels.
+'''
+
+import logging
+import numpy as np
+
+from pyqtgraph.Qt import QtGui, QtCore
+import pyqtgraph as pg
+
+THRESHOLD_LIMITS = (1e-6, 5)    #: Accepted threshold range in volts
+
+class ThresholdModel(QtCore.QAbstractTableModel):
+    '''Table model of per-channel thresholds backed by a NumPy array.
+
+    Attributes:
+        values (1D np.ndarray): Threshold level of each channel in volts
+        names (list of str): Channel names displayed in the first column
+        colors (list of tuples): RGBA channel colors displayed next to the names
+    '''
+
+    sigValuesChanged = QtCore.Signal(object)    #: Emitted with the array of modified channel indices
+
+    COLUMNS = ['Channel', 'Threshold']
+
+    def __init__(self, parent=None):
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self.values = np.zeros(0)
+        self.names = []
+        self.colors = []
+
+    def set_channels(self, names, values, colors):
+        '''Replace all channels (e.g. when channel count changes), no value change is signalled.'''
+        self.beginResetModel()
+        self.names = list(names)
+        self.values = np.clip(np.array(values, dtype='float64'), *THRESHOLD_LIMITS)
+        self.colors = list(colors)
+        self.endResetModel()
+
+    def set_values(self, channels, values):
+        '''Set thresholds of some channels.
+
+        Args:
+            channels (1D int array): channel indices
+            values (float or 1D array): new threshold(s) in volts, clipped to :data:`THRESHOLD_LIMITS`
+        '''
+        channels = np.asarray(channels, dtype='int64')
+        values = np.clip(np.broadcast_to(np.asarray(values, dtype='float64'), channels.shape), *THRESHOLD_LIMITS)
+        changed = self.values[channels] != values
+        channels, values = channels[changed], values[changed]
+        if len(channels) == 0:
+            return
+
+        self.values[channels] = values
+        self.dataChanged.emit(self.index(int(channels.min()), 1), self.index(int(channels.max()), 1))
+        self.sigValuesChanged.emit(channels)
+
+    def set_colors(self, colors):
+        '''Update channel colors (e.g. on theme change).'''
+        self.colors = list(colors)
+        if self.colors:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self.colors) - 1, 0))
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.values)
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.COLUMNS)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role == QtCore.Qt.DisplayRole and orientation == QtCore.Qt.Horizontal:
+            return self.COLUMNS[section]
+        return None
+
+    def flags(self, index):
+        flags = QtCore.Qt.ItemIsEnabled | QtCore.Qt.ItemIsSelectable
+        if index.column() == 1:
+            flags |= QtCore.Qt.ItemIsEditable
+        return flags
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        row = index.row()
+        if index.column() == 0:
+            if role == QtCore.Qt.DisplayRole:
+                return self.names[row]
+            elif role == QtCore.Qt.DecorationRole:
+                return QtGui.QColor(*self.colors[row])
+        elif role in (QtCore.Qt.DisplayRole, QtCore.Qt.EditRole):
+            return pg.siFormat(self.values[row], suffix='V')
+        return None
+
+    def setData(self, index, value, role=QtCore.Qt.EditRole):
+        '''Manual edit of a single threshold, accepts values like ``50uV`` or ``5e-5``.'''
+        if role != QtCore.Qt.EditRole or index.column() != 1:
+            return False
+        try:
+            value = float(pg.siEval(str(value)))
+        except (ValueError, TypeError, AttributeError):
+            logger.warning("Invalid threshold level: %s" % value)
+            return False
+        self.set_values([index.row()], value)
+        return True
+
+class ThresholdEditor(QtGui.QWidget):
+    '''Threshold table with bulk operation controls.'''
+
+    def __init__(self, noise_thresholds=None, parent=None):
+        '''
+        Args:
+            noise_thresholds (callable): returns k times the per-channel noise levels in volts
+                or None if no estimate is available (used by the k*sigma button)
+        '''
+        QtGui.QWidget.__init__(self, parent)
+        self.noise_thresholds = noise_thresholds
+        self.model = ThresholdModel(self)
+
+        l = QtGui.QVBoxLayout(self)
+        l.setContentsMargins(0, 0, 0, 0)
+        l.addWidget(QtGui.QLabel("Custom threshold levels (bulk operations apply to selected channels, or all):"))
+
+        self.table = QtGui.QTableView()
+        self.table.setModel(self.model)
+        self.table.setSelectionBehavior(QtGui.QAbstractItemView.SelectRows)
+        self.table.verticalHeader().setVisible(False)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        l.addWidget(self.table)
+
+        ops = QtGui.QHBoxLayout()
+        self.value_spin = pg.SpinBox(value=1e-4, bounds=THRESHOLD_LIMITS, step=1e-3, siPrefix=True, suffix='V', dec=True)
+        set_btn = QtGui.QPushButton('Set')
+        self.factor_spin = pg.SpinBox(value=1.1, bounds=(0.01, 100), step=0.1)
+        scale_btn = QtGui.QPushButton('Scale')
+        noise_btn = QtGui.QPushButton(u'k\u00b7\u03c3')
+        for w in (self.value_spin, set_btn, self.factor_spin, scale_btn, noise_btn):
+            ops.addWidget(w)
+        l.addLayout(ops)
+
+        set_btn.clicked.connect(self.onSet)
+        scale_btn.clicked.connect(self.onScale)
+        noise_btn.clicked.connect(self.onNoise)
+
+    def selected_channels(self):
+        '''Indices of the selected channels, all channels if there is no selection.'''
+        rows = sorted(set(index.row() for index in self.table.selectionModel().selectedRows()))
+        return np.array(rows, dtype='int64') if rows else np.arange(len(self.model.values))
+
+    def onSet(self):
+        '''Set the selected channels to a common threshold.'''
+        self.model.set_values(self.selected_channels(), self.value_spin.value())
+
+    def onScale(self):
+        '''Scale thresholds of the selected channels.'''
+        channels = self.selected_channels()
+        self.model.set_values(channels, self.model.values[channels] * self.factor_spin.value())
+
+    def onNoise(self):
+        '''Set thresholds of the selected channels to k times their noise level.'''
+        thresholds = self.noise_thresholds() if self.noise_thresholds is not None else None
+        if thresholds is None or len(thresholds) != len(self.model.values):
+            logger.warning("No noise estimate available for k*sigma thresholds")
+            return
+        channels = self.selected_channels()
+        self.model.set_values(channels, thresholds[channels])
+
+logger = logging.getLogger("logger")
@@ -0,0 +1,213 @@
+'''Capture of the raw ZMQ messages received from Open Ephys and their replay on local ports.
+
+:class:`WireCapture` appends every multipart message with its receive time to a binary file
+(see :meth:`comm.CommProcess.start_capture`). Records are collected in memory and written in
+batches, so there is no system call per message. :class:`WireReplay` acts as the Open Ephys
+ZMQ plugin: it publishes the captured messages on the data port at the original pace (or
+faster) and answers the heartbeats on the event port, so OPETH can be debugged on exactly
+the same message sequence (gaps, timestamps, sampling rate changes)::
+
+    python -m opeth.wirecap capture.zmq --speed 2
+
+File layout: :data:`WIRECAP_MAGIC`, then one record per message: receive time (float64,
+seconds from capture start) and frame count (uint32), then the length (uint32) and the
+bytes of each frame (little endian).
+'''
+
+from __future__ import division, print_function
+import sys
+if sys.version_info.major >= 3:
+    from time import perf_counter as clock
+else:
+    from time import clock
+
+import time
+import struct
+import argparse
+import logging
+import zmq
+
+WIRECAP_MAGIC = b'OPETHZMQ\x01\x00\x00\x00'   #: File signature and format version
+WIRECAP_FLUSH_BYTES = 1 << 20   #: Pending data size that triggers a write
+WIRECAP_FLUSH_PERIOD = 1.0      #: Maximal age of pending data in seconds (checked by :meth:`WireCapture.flush`)
+
+RECORD_HEADER = struct.Struct('<dI')
+FRAME_HEADER = struct.Struct('<I')
+
+class WireCapture(object):
+    '''Append-only capture file of multipart messages with batched writes.
+
+    Attributes:
+        messages (int): number of captured messages
+        written (int): number of bytes written to the file
+    '''
+
+    def __init__(self, fname):
+        '''
+        Args:
+            fname (str): capture file name, an existing file is overwritten
+        '''
+        self.file = open(fname, 'wb')
+        self.file.write(WIRECAP_MAGIC)
+        self.start = clock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.next_flush = self.start + WIRECAP_FLUSH_PERIOD
+        self.messages = 0
+        self.written = len(WIRECAP_MAGIC)
+        logger.info("Capturing ZMQ messages to %s" % fname)
+
+    def add(self, frames):
+        '''Capture a received multipart message (list of bytes frames).'''
+        now = clock()
+        self.pending.append(RECORD_HEADER.pack(now - self.start, len(frames)))
+        for frame in frames:
+            self.pending.append(FRAME_HEADER.pack(len(frame)))
+            self.pending.append(frame)
+            self.pending_bytes += len(frame)
+        self.messages += 1
+        if self.pending_bytes >= WIRECAP_FLUSH_BYTES:
+            self.flush()
+
+    def flush(self, if_due=False):
+        '''Write the pending records with a single write call.
+
+        Args:
+            if_due (bool): write only if the oldest pending data is older than :data:`WIRECAP_FLUSH_PERIOD`
+        '''
+        if not self.pending or (if_due and clock() < self.next_flush):
+            return
+        data = b''.join(self.pending)
+        self.file.write(data)
+        self.file.flush()
+        self.written += len(data)
+        self.pending = []
+        self.pending_bytes = 0
+        self.next_flush = clock() + WIRECAP_FLUSH_PERIOD
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        logger.info("ZMQ capture closed: %d messages, %d bytes" % (self.messages, self.written))
+
+def read_capture(fname):
+    '''Iterate over the messages of a capture file.
+
+    A truncated last record (e.g. after a crash) is ignored.
+
+    Yields:
+        receive time (seconds from capture start) and the list of frames of each message
+    '''
+    with open(fname, 'rb') as f:
+        if f.read(len(WIRECAP_MAGIC)) != WIRECAP_MAGIC:
+            raise ValueError("%s is not a ZMQ capture file" % fname)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            t, nframes = RECORD_HEADER.unpack(header)
+            frames = []
+            for i in range(nframes):
+                size = f.read(FRAME_HEADER.size)
+                if len(size) < FRAME_HEADER.size:
+                    return
+                length = FRAME_HEADER.unpack(size)[0]
+                frame = f.read(length)
+                if len(frame) < length:
+                    return
+                frames.append(frame)
+            yield t, frames
+
+class WireReplay(object):
+    '''Mock Open Ephys ZMQ plugin publishing a capture file.'''
+
+    def __init__(self, fname, dataport=5556, eventport=5557, speed=1.0):
+        '''
+        Args:
+            fname (str): capture file
+            dataport, eventport (int): local ports (as set in OPETH / the ZMQ plugin)
+            speed (float): pace relative to the original, 0 to publish as fast as possible
+        '''
+        self.fname = fname
+        self.speed = speed
+        self.context = zmq.Context()
+        self.data_socket = self.context.socket(zmq.PUB)
+        self.data_socket.bind("tcp://*:%d" % dataport)
+        self.event_socket = self.context.socket(zmq.REP)
+        self.event_socket.bind("tcp://*:%d" % eventport)
+        self.poller = zmq.Poller()
+        self.poller.register(self.event_socket, zmq.POLLIN)
+
+    def serve_events(self, timeout_ms=0):
+        '''Reply to the heartbeats (and events) of the clients.
+
+        Returns:
+            True if a request was answered
+        '''
+        answered = False
+        while dict(self.poller.poll(timeout_ms)).get(self.event_socket):
+            self.event_socket.recv()
+            self.event_socket.send(b'heartbeat received')
+            answered = True
+            timeout_ms = 0
+        return answered
+
+    def wait_for_client(self):
+        '''Wait for the first heartbeat, so that the subscriber receives the first messages.'''
+        logger.info("Waiting for a client heartbeat...")
+        while not self.serve_events(100):
+            pass
+        time.sleep(0.5)     # let the data socket subscription settle
+
+    def run(self, wait_client=True):
+        '''Publish all captured messages.
+
+        Returns:
+            number of published messages
+        '''
+        if wait_client:
+            self.wait_for_client()
+        count = 0
+        start = None
+        for t, frames in read_capture(self.fname):
+            if start is None:
+                start = clock() - t / self.speed if self.speed > 0 else clock()
+            if self.speed > 0:
+                # sleep until the original (scaled) receive time while serving heartbeats
+                while True:
+                    remaining = start + t / self.speed - clock()
+                    if remaining <= 0:
+                        break
+                    self.serve_events(int(min(remaining, 0.1) * 1000))
+            else:
+                self.serve_events()
+            self.data_socket.send_multipart(frames)
+            count += 1
+        logger.info("Replayed %d messages" % count)
+        return count
+
+    def close(self):
+        self.data_socket.close()
+        self.event_socket.close()
+        self.context.term()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a ZMQ capture as a mock Open Ephys ZMQ plugin.")
+    parser.add_argument('capture', help="capture file")
+    parser.add_argument('--speed', type=float, default=1.0, help="pace relative to the original, 0: as fast as possible")
+    parser.add_argument('--dataport', type=int, default=5556)
+    parser.add_argument('--eventport', type=int, default=5557)
+    parser.add_argument('--no-wait', action='store_true', help="start publishing without waiting for a client")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    replay = WireReplay(args.capture, args.dataport, args.eventport, args.speed)
+    try:
+        replay.run(wait_client=not args.no_wait)
+    finally:
+        replay.close()
+
+logger = logging.getLogger("logger")
+
+if __name__ == '__main__':
+    main()
@@ -28,7 +28,7 @@ setuptools.setup(
         'Source': 'https://github.com/hangyabalazs/opeth',
     },
     entry_points = {
-        'console_scripts': ['opeth=opeth.gui:main'],
+        'console_scripts': ['opeth=opeth.gui:main', 'opeth-batch=opeth.batch:main'],
     },
 
     install_requires=[